@@ -0,0 +1,297 @@
+import asyncio
+import os
+import shutil
+import time
+import logging
+from typing import Dict, Optional
+from . import crud
+
+logger = logging.getLogger(__name__)
+
+# Presupuestos de admisión (0 = sin límite)
+# Streams con FFmpeg en este nodo (todos los workers del host)
+MAX_STREAMS = int(os.getenv("ADMISSION_MAX_STREAMS", "64"))
+# Streams activos por dispositivo (en todo el cluster); protege el uplink del NVR
+MAX_STREAMS_PER_DEVICE = int(os.getenv("ADMISSION_MAX_STREAMS_PER_DEVICE", "16"))
+# Bitrate de salida por dispositivo en kbps, medido por `-progress` de FFmpeg
+MAX_DEVICE_BITRATE_KBPS = int(os.getenv("ADMISSION_MAX_DEVICE_BITRATE_KBPS", "0"))
+# Uso de CPU del nodo (% de la capacidad total) a partir del cual no se admiten streams
+MAX_CPU_PERCENT = float(os.getenv("ADMISSION_MAX_CPU_PERCENT", "85"))
+# Memoria disponible mínima en el nodo
+MIN_FREE_MEMORY_MB = int(os.getenv("ADMISSION_MIN_FREE_MEMORY_MB", "256"))
+# Espacio libre mínimo en HLS_ROOT
+MIN_FREE_DISK_MB = int(os.getenv("ADMISSION_MIN_FREE_DISK_MB", "512"))
+# Descriptores de archivo libres mínimos en el worker (cada FFmpeg usa dos pipes)
+MIN_FREE_FDS = int(os.getenv("ADMISSION_MIN_FREE_FDS", "64"))
+
+# Cola de espera: segundos que una petición espera capacidad antes de rechazarse
+QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Peticiones en espera como máximo; el resto se rechaza de inmediato
+MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+# Intervalo de re-evaluación de una petición en cola
+RECHECK_INTERVAL = 1.0
+
+# Coste estimado de CPU (% de un core) de un stream aún sin muestrear
+DEFAULT_STREAM_CPU_PERCENT = float(os.getenv("ADMISSION_STREAM_CPU_PERCENT", "5"))
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+CPU_COUNT = os.cpu_count() or 1
+
+class AdmissionRejected(Exception):
+    """
+    Petición de stream rechazada por falta de capacidad
+    
+    `scope` indica qué presupuesto se agotó: "device" (límite del dispositivo)
+    o "node" (recursos del nodo); `retry_after` sugiere cuándo reintentar.
+    """
+    def __init__(self, reason: str, scope: str = "node", retry_after: int = 30):
+        super().__init__(reason)
+        self.reason = reason
+        self.scope = scope
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    Control de admisión delante de `StreamManager.start_hls`
+    
+    Muestrea CPU y RSS de cada FFmpeg desde /proc y el bitrate de salida de
+    `-progress`, y decide si un stream nuevo cabe en los presupuestos globales
+    y por dispositivo. La comprobación es síncrona y barata: el gestor la hace
+    bajo su lock justo antes de lanzar FFmpeg, de modo que dos peticiones
+    concurrentes no pueden colarse por el mismo hueco.
+    """
+    def __init__(self, stream_manager):
+        self.stream_manager = stream_manager
+        self.queued = 0
+        self.rejected = 0
+        self.admitted = 0
+        # Muestras previas de CPU: pid -> (ticks, instante)
+        self._cpu_samples: Dict[int, tuple] = {}
+        # Última muestra de /proc/stat del nodo: (ocupado, total)
+        self._node_cpu_sample: Optional[tuple] = None
+        self.node_cpu_percent: Optional[float] = None
+        self._capacity_changed = asyncio.Event()
+
+    def sample(self):
+        """Actualizar el consumo de cada FFmpeg local y la CPU del nodo"""
+        now = time.monotonic()
+        alive = set()
+        for info in self.stream_manager.stream_info.values():
+            proc = info["process"]
+            if proc.returncode is not None:
+                continue
+            alive.add(proc.pid)
+            usage = _read_proc_usage(proc.pid)
+            if usage is None:
+                continue
+            ticks, rss_bytes = usage
+            
+            cpu_percent = None
+            previous = self._cpu_samples.get(proc.pid)
+            if previous is not None and now > previous[1]:
+                cpu_percent = round(100 * (ticks - previous[0]) / CLOCK_TICKS / (now - previous[1]), 1)
+            self._cpu_samples[proc.pid] = (ticks, now)
+            
+            info["resources"] = {
+                "cpu_percent": cpu_percent,
+                "rss_mb": round(rss_bytes / (1024 * 1024), 1),
+                "bitrate_kbps": info["drain"].metrics.get("bitrate_kbps"),
+                "sampled_at": now
+            }
+        
+        # Olvidar PIDs que ya no existen (reinicios y streams detenidos)
+        for pid in list(self._cpu_samples):
+            if pid not in alive:
+                del self._cpu_samples[pid]
+        
+        node = _read_node_cpu()
+        if node is not None:
+            if self._node_cpu_sample is not None:
+                busy = node[0] - self._node_cpu_sample[0]
+                total = node[1] - self._node_cpu_sample[1]
+                if total > 0:
+                    self.node_cpu_percent = round(100 * busy / total, 1)
+            self._node_cpu_sample = node
+
+    def check(self, device_id: int, pending_device: int = 0, pending_node: int = 0) -> Optional[AdmissionRejected]:
+        """
+        Comprobar si un stream nuevo del dispositivo cabe; devuelve el motivo del rechazo
+        
+        `pending_device` y `pending_node` cuentan streams ya admitidos en un
+        arranque masivo que todavía no están en la tabla `streams`.
+        """
+        manager = self.stream_manager
+        
+        if MAX_STREAMS_PER_DEVICE or MAX_STREAMS:
+            with manager._db() as db:
+                if MAX_STREAMS_PER_DEVICE:
+                    device_streams = crud.count_active_streams_by_device(db, device_id) + pending_device
+                    if device_streams >= MAX_STREAMS_PER_DEVICE:
+                        return AdmissionRejected(
+                            f"El dispositivo {device_id} ya tiene {device_streams} streams activos "
+                            f"(máximo {MAX_STREAMS_PER_DEVICE})",
+                            scope="device"
+                        )
+                if MAX_STREAMS:
+                    node_streams = crud.count_active_streams_by_host(db, manager.host) + pending_node
+                    if node_streams >= MAX_STREAMS:
+                        return AdmissionRejected(
+                            f"El nodo {manager.host} ya tiene {node_streams} streams activos (máximo {MAX_STREAMS})"
+                        )
+        
+        if MAX_DEVICE_BITRATE_KBPS:
+            device_bitrate = sum(
+                info["drain"].metrics.get("bitrate_kbps") or 0
+                for info in manager.stream_info.values()
+                if info.get("key") and info["key"][0] == device_id
+            )
+            if device_bitrate >= MAX_DEVICE_BITRATE_KBPS:
+                return AdmissionRejected(
+                    f"El dispositivo {device_id} ya consume {device_bitrate:.0f} kbps "
+                    f"(máximo {MAX_DEVICE_BITRATE_KBPS})",
+                    scope="device"
+                )
+        
+        if MAX_CPU_PERCENT and self.node_cpu_percent is not None:
+            # Los streams aún sin muestrear no se reflejan en la CPU del nodo: sumar su coste esperado
+            unsampled = pending_node + sum(
+                1 for info in manager.stream_info.values()
+                if not info.get("resources") or info["resources"]["cpu_percent"] is None
+            )
+            projected = self.node_cpu_percent + (unsampled + 1) * self._estimated_stream_cpu() / CPU_COUNT
+            if projected >= MAX_CPU_PERCENT:
+                return AdmissionRejected(
+                    f"CPU del nodo al {self.node_cpu_percent:.0f}% (máximo {MAX_CPU_PERCENT:.0f}%)"
+                )
+        
+        if MIN_FREE_MEMORY_MB:
+            available = _read_available_memory_mb()
+            if available is not None and available < MIN_FREE_MEMORY_MB:
+                return AdmissionRejected(
+                    f"Memoria disponible insuficiente: {available} MB (mínimo {MIN_FREE_MEMORY_MB} MB)"
+                )
+        
+        if MIN_FREE_DISK_MB:
+            try:
+                free_mb = shutil.disk_usage(manager.hls_root).free // (1024 * 1024)
+            except OSError:
+                free_mb = None
+            if free_mb is not None and free_mb < MIN_FREE_DISK_MB:
+                return AdmissionRejected(
+                    f"Espacio insuficiente en {manager.hls_root}: {free_mb} MB (mínimo {MIN_FREE_DISK_MB} MB)"
+                )
+        
+        if MIN_FREE_FDS:
+            free_fds = _free_fds()
+            if free_fds is not None and free_fds < MIN_FREE_FDS:
+                return AdmissionRejected(
+                    f"Descriptores de archivo insuficientes: {free_fds} libres (mínimo {MIN_FREE_FDS})"
+                )
+        
+        return None
+
+    async def wait(self, rejection: AdmissionRejected, deadline: float):
+        """
+        Esperar en cola a que se libere capacidad
+        
+        Lanza el rechazo si la cola está llena o se alcanza el deadline.
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or self.queued >= MAX_QUEUE:
+            self.rejected += 1
+            logger.warning(f"Stream rechazado por control de admisión: {rejection.reason}")
+            raise rejection
+        
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._capacity_changed.wait(), timeout=min(remaining, RECHECK_INTERVAL))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.queued -= 1
+
+    def notify(self):
+        """Despertar a las peticiones en cola (se liberó un stream)"""
+        self._capacity_changed.set()
+        self._capacity_changed = asyncio.Event()
+
+    def _estimated_stream_cpu(self) -> float:
+        """Coste de CPU esperado de un stream nuevo (media de los muestreados)"""
+        samples = [
+            info["resources"]["cpu_percent"]
+            for info in self.stream_manager.stream_info.values()
+            if info.get("resources") and info["resources"]["cpu_percent"] is not None
+        ]
+        return sum(samples) / len(samples) if samples else DEFAULT_STREAM_CPU_PERCENT
+
+    def get_stats(self) -> Dict:
+        """Estado del control de admisión y consumo de los FFmpeg locales"""
+        resources = [info["resources"] for info in self.stream_manager.stream_info.values() if info.get("resources")]
+        return {
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "node_cpu_percent": self.node_cpu_percent,
+            "ffmpeg_cpu_percent": round(sum(r["cpu_percent"] or 0 for r in resources), 1),
+            "ffmpeg_rss_mb": round(sum(r["rss_mb"] for r in resources), 1),
+            "ffmpeg_bitrate_kbps": round(sum(r["bitrate_kbps"] or 0 for r in resources), 1),
+            "budgets": {
+                "max_streams": MAX_STREAMS,
+                "max_streams_per_device": MAX_STREAMS_PER_DEVICE,
+                "max_device_bitrate_kbps": MAX_DEVICE_BITRATE_KBPS,
+                "max_cpu_percent": MAX_CPU_PERCENT,
+                "min_free_memory_mb": MIN_FREE_MEMORY_MB,
+                "min_free_disk_mb": MIN_FREE_DISK_MB,
+                "min_free_fds": MIN_FREE_FDS
+            }
+        }
+
+def _read_proc_usage(pid: int) -> Optional[tuple]:
+    """Ticks de CPU (user + system) y RSS en bytes de un proceso desde /proc"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read().decode(errors="ignore")
+    except OSError:
+        return None
+    # El nombre del proceso va entre paréntesis y puede contener espacios
+    fields = stat.rpartition(")")[2].split()
+    try:
+        ticks = int(fields[11]) + int(fields[12])
+        rss_bytes = int(fields[21]) * PAGE_SIZE
+    except (IndexError, ValueError):
+        return None
+    return ticks, rss_bytes
+
+def _read_node_cpu() -> Optional[tuple]:
+    """Jiffies ocupados y totales del nodo desde /proc/stat"""
+    try:
+        with open("/proc/stat") as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    # idle + iowait
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    total = sum(values)
+    return total - idle, total
+
+def _read_available_memory_mb() -> Optional[int]:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _free_fds() -> Optional[int]:
+    """Descriptores de archivo disponibles en este proceso"""
+    try:
+        import resource
+        soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft_limit == resource.RLIM_INFINITY:
+            return None
+        return soft_limit - len(os.listdir("/proc/self/fd"))
+    except (ImportError, OSError):
+        return None
@@ -1,14 +1,30 @@
+import os
+from sqlalchemy import update, delete, select, case, or_, func, literal_column, text
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
 from . import models, schemas
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple, Union
+from datetime import date, datetime, timedelta
+
+# Duración máxima de un archivo de grabación: acota el rango de la consulta de
+# solapamiento cuando no hay índice GiST (SQLite)
+RECORDING_MAX_SPAN = timedelta(hours=int(os.getenv("RECORDING_MAX_SPAN_HOURS", "24")))
+# Lock de Postgres que serializa la reserva de exportaciones entre workers
+EXPORT_CLAIM_LOCK_KEY = 7311843
 
 # Device CRUD operations
+
 def get_device(db: Session, device_id: int):
     return db.query(models.Device).filter(models.Device.id == device_id).first()
 
 def get_devices(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Device).offset(skip).limit(limit).all()
 
+def get_devices_by_ids(db: Session, device_ids: List[int]):
+    if not device_ids:
+        return []
+    return db.query(models.Device).filter(models.Device.id.in_(device_ids)).all()
+
 def create_device(db: Session, device: schemas.DeviceCreate):
     db_device = models.Device(**device.dict())
     db.add(db_device)
@@ -40,13 +56,28 @@ def get_stream(db: Session, stream_id: str):
 def get_active_streams(db: Session):
     return db.query(models.Stream).filter(models.Stream.is_active == True).all()
 
-def create_stream(db: Session, stream: schemas.StreamCreate):
+def create_stream(db: Session, stream: schemas.StreamCreate, lease_ids: Optional[List[str]] = None):
     db_stream = models.Stream(**stream.dict())
     db.add(db_stream)
+    # Los leases de los viewers iniciales se registran en la misma transacción
+    db.add_all(_new_leases(stream.stream_id, lease_ids))
     db.commit()
     db.refresh(db_stream)
     return db_stream
 
+def create_streams(db: Session, streams: List[schemas.StreamCreate],
+                   lease_ids: Optional[Dict[str, List[str]]] = None):
+    # Un único INSERT por lotes para los streams de un arranque masivo
+    db_streams = [models.Stream(**stream.dict()) for stream in streams]
+    db.add_all(db_streams)
+    for stream in streams:
+        db.add_all(_new_leases(stream.stream_id, (lease_ids or {}).get(stream.stream_id)))
+    db.commit()
+    return db_streams
+
+def _new_leases(stream_id: str, lease_ids: Optional[List[str]]) -> List[models.StreamLease]:
+    return [models.StreamLease(lease_id=lease_id, stream_id=stream_id) for lease_id in lease_ids or []]
+
 def stop_stream(db: Session, stream_id: str):
     db_stream = db.query(models.Stream).filter(models.Stream.stream_id == stream_id).first()
     if db_stream:
@@ -56,14 +87,292 @@ def stop_stream(db: Session, stream_id: str):
         db.refresh(db_stream)
     return db_stream
 
+def get_active_stream_by_key(db: Session, device_id: int, channel: int, sub_stream: int, profile: str = "ts"):
+    return db.query(models.Stream).filter(
+        models.Stream.device_id == device_id,
+        models.Stream.channel == channel,
+        models.Stream.sub_stream == sub_stream,
+        models.Stream.profile == profile,
+        models.Stream.is_active == True
+    ).first()
+
+def count_active_streams(db: Session) -> int:
+    return db.query(models.Stream).filter(models.Stream.is_active == True).count()
+
+def count_active_streams_by_device(db: Session, device_id: int) -> int:
+    return db.query(models.Stream).filter(
+        models.Stream.device_id == device_id,
+        models.Stream.is_active == True
+    ).count()
+
+def count_active_streams_by_host(db: Session, host: str) -> int:
+    # owner tiene el formato "host:pid" del worker
+    return db.query(models.Stream).filter(
+        models.Stream.owner.like(f"{host}:%"),
+        models.Stream.is_active == True
+    ).count()
+
+def add_stream_viewers(db: Session, stream_id: str, delta: int,
+                       expires_at: Optional[datetime] = None,
+                       lease_ids: Optional[List[str]] = None) -> Optional[int]:
+    """
+    Sumar/restar viewers de forma atómica; el stream se desactiva al llegar a 0
+    
+    Con `expires_at` el fin del stream se amplía hasta esa hora si es posterior.
+    `lease_ids` son los leases de los viewers añadidos: se registran en la
+    misma transacción, solo si el stream sigue activo.
+    """
+    viewers = models.Stream.viewers + delta
+    values = {
+        "viewers": viewers,
+        "is_active": case((viewers > 0, True), else_=False),
+        "stopped_at": case((viewers > 0, None), else_=datetime.utcnow())
+    }
+    if expires_at is not None:
+        values["expires_at"] = case(
+            (or_(models.Stream.expires_at == None, models.Stream.expires_at < expires_at), expires_at),
+            else_=models.Stream.expires_at
+        )
+    result = db.execute(
+        update(models.Stream)
+        .where(models.Stream.stream_id == stream_id, models.Stream.is_active == True)
+        .values(**values)
+        .returning(models.Stream.viewers)
+    ).first()
+    if result:
+        db.add_all(_new_leases(stream_id, lease_ids))
+    db.commit()
+    return result[0] if result else None
+
+def release_leases(db: Session, lease_ids: List[str]) -> Dict[str, Tuple[str, int]]:
+    """
+    Liberar leases de viewers restando sus viewers con un único UPDATE de streams
+    
+    Solo la primera liberación de cada lease resta su viewer: el UPDATE
+    condicional sobre released_at es atómico entre workers, así que un
+    reintento (o dos liberaciones del mismo cliente en carrera) devuelve los
+    viewers actuales sin tocarlos. Un stream que llega a 0 se desactiva.
+    
+    Returns:
+        Dict lease_id -> (stream_id, viewers restantes); los leases desconocidos no aparecen
+    """
+    if not lease_ids:
+        return {}
+    released = db.execute(
+        update(models.StreamLease)
+        .where(models.StreamLease.lease_id.in_(lease_ids), models.StreamLease.released_at == None)
+        .values(released_at=datetime.utcnow())
+        .returning(models.StreamLease.stream_id)
+    ).all()
+    
+    counts: Dict[str, int] = {}
+    for row in released:
+        counts[row[0]] = counts.get(row[0], 0) + 1
+    if counts:
+        viewers = models.Stream.viewers - case(counts, value=models.Stream.stream_id, else_=0)
+        db.execute(
+            update(models.Stream)
+            .where(models.Stream.stream_id.in_(list(counts)), models.Stream.is_active == True)
+            .values(
+                viewers=viewers,
+                is_active=case((viewers > 0, True), else_=False),
+                stopped_at=case((viewers > 0, None), else_=datetime.utcnow())
+            )
+        )
+    
+    rows = db.query(
+        models.StreamLease.lease_id, models.StreamLease.stream_id, models.Stream.viewers, models.Stream.is_active
+    ).outerjoin(
+        models.Stream, models.Stream.stream_id == models.StreamLease.stream_id
+    ).filter(models.StreamLease.lease_id.in_(lease_ids)).all()
+    db.commit()
+    return {
+        lease_id: (stream_id, viewers if is_active else 0)
+        for lease_id, stream_id, viewers, is_active in rows
+    }
+
+def purge_stream_leases(db: Session, before: datetime) -> int:
+    """Borrar los leases liberados antes de `before` y los de streams detenidos desde entonces"""
+    stopped = select(models.Stream.stream_id).where(
+        models.Stream.is_active == False,
+        models.Stream.stopped_at < before
+    )
+    result = db.execute(
+        delete(models.StreamLease).where(or_(
+            models.StreamLease.released_at < before,
+            models.StreamLease.stream_id.in_(stopped)
+        ))
+    )
+    db.commit()
+    return result.rowcount
+
+def stop_streams(db: Session, stream_ids: List[str]) -> List[str]:
+    """Marcar streams como detenidos en un único UPDATE; devuelve los que estaban activos"""
+    if not stream_ids:
+        return []
+    rows = db.execute(
+        update(models.Stream)
+        .where(models.Stream.stream_id.in_(stream_ids), models.Stream.is_active == True)
+        .values(is_active=False, viewers=0, stopped_at=datetime.utcnow())
+        .returning(models.Stream.stream_id)
+    ).all()
+    db.commit()
+    return [row[0] for row in rows]
+
+def update_stream_pid(db: Session, stream_id: str, pid: int) -> int:
+    result = db.execute(
+        update(models.Stream)
+        .where(models.Stream.stream_id == stream_id)
+        .values(pid=pid, heartbeat_at=datetime.utcnow())
+    )
+    db.commit()
+    return result.rowcount
+
+def touch_streams(db: Session, owner: str) -> int:
+    result = db.execute(
+        update(models.Stream)
+        .where(models.Stream.owner == owner, models.Stream.is_active == True)
+        .values(heartbeat_at=datetime.utcnow())
+    )
+    db.commit()
+    return result.rowcount
+
+def get_stale_streams(db: Session, heartbeat_before: datetime):
+    # Sin owner o sin heartbeat (filas de versiones anteriores) tampoco hay un worker detrás
+    return db.query(models.Stream).filter(
+        models.Stream.is_active == True,
+        or_(
+            models.Stream.owner == None,
+            models.Stream.heartbeat_at == None,
+            models.Stream.heartbeat_at < heartbeat_before
+        )
+    ).all()
+
+def set_stream_retain(db: Session, stream_id: str, retain: bool, dvr_window: Optional[int] = None) -> bool:
+    """Activar o desactivar la retención de un stream activo; False si no existe"""
+    result = db.execute(
+        update(models.Stream)
+        .where(models.Stream.stream_id == stream_id, models.Stream.is_active == True)
+        .values(retain=retain, dvr_window=dvr_window)
+    )
+    db.commit()
+    return result.rowcount > 0
+
+def get_retained_streams(db: Session, owner: str) -> Dict[str, Optional[int]]:
+    """Streams activos con retención de un worker: stream_id -> ventana de time-shift"""
+    rows = db.query(models.Stream.stream_id, models.Stream.dvr_window).filter(
+        models.Stream.owner == owner,
+        models.Stream.is_active == True,
+        models.Stream.retain == True
+    ).all()
+    return {stream_id: dvr_window for stream_id, dvr_window in rows}
+
+def get_stream_expiries(db: Session, owner: str) -> Dict[str, datetime]:
+    """Fin de los streams activos de un worker (ampliado por viewers de cualquier worker)"""
+    rows = db.query(models.Stream.stream_id, models.Stream.expires_at).filter(
+        models.Stream.owner == owner,
+        models.Stream.is_active == True,
+        models.Stream.expires_at != None
+    ).all()
+    return {stream_id: expires_at for stream_id, expires_at in rows}
+
+def update_stream_media_info(db: Session, media_info: Dict[str, Dict]) -> int:
+    """Publicar el vídeo medido de varios streams (stream_id -> media_info)"""
+    for stream_id, info in media_info.items():
+        db.execute(
+            update(models.Stream)
+            .where(models.Stream.stream_id == stream_id)
+            .values(media_info=info)
+        )
+    db.commit()
+    return len(media_info)
+
+def get_active_streams_by_devices(db: Session, device_ids: List[int]):
+    if not device_ids:
+        return []
+    return db.query(models.Stream).filter(
+        models.Stream.device_id.in_(device_ids),
+        models.Stream.is_active == True
+    ).all()
+
+def get_streams_by_ids(db: Session, stream_ids: List[str]):
+    if not stream_ids:
+        return []
+    return db.query(models.Stream).filter(models.Stream.stream_id.in_(stream_ids)).all()
+
+def get_stopped_stream_ids(db: Session, stream_ids: List[str]) -> List[str]:
+    if not stream_ids:
+        return []
+    rows = db.query(models.Stream.stream_id).filter(
+        models.Stream.stream_id.in_(stream_ids),
+        models.Stream.is_active == False
+    ).all()
+    return [row[0] for row in rows]
+
 # Recording CRUD operations
-def get_recordings(db: Session, device_id: int, start_time: str, end_time: str, channel: int = 1):
-    return db.query(models.Recording).filter(
+def get_recordings(db: Session, device_id: int, start_time: Union[str, datetime], end_time: Union[str, datetime],
+                   channel: int = 1, recording_type: Optional[str] = None, after: Optional[datetime] = None,
+                   limit: Optional[int] = None):
+    """
+    Grabaciones que se solapan con [start_time, end_time), ordenadas por inicio
+    
+    Un archivo que empieza antes del rango o termina después también se
+    devuelve. En Postgres la condición es `tsrange && tsrange`, resuelta con el
+    índice GiST (device_id, channel, tsrange) de migrations.py; en otros
+    motores se usa el índice (device_id, channel, start_time) acotando el
+    inicio a RECORDING_MAX_SPAN antes del rango.
+    """
+    start_time, end_time = _as_datetime(start_time), _as_datetime(end_time)
+    query = db.query(models.Recording).filter(
         models.Recording.device_id == device_id,
-        models.Recording.channel == channel,
-        models.Recording.start_time >= start_time,
-        models.Recording.end_time <= end_time
-    ).all()
+        models.Recording.channel == channel
+    )
+    if db.get_bind().dialect.name == "postgresql":
+        bounds = literal_column("'[)'")
+        query = query.filter(
+            func.tsrange(models.Recording.start_time, models.Recording.end_time, bounds)
+            .op("&&")(func.tsrange(start_time, end_time, bounds))
+        )
+    else:
+        query = query.filter(
+            models.Recording.start_time > start_time - RECORDING_MAX_SPAN,
+            models.Recording.start_time < end_time,
+            models.Recording.end_time > start_time
+        )
+    if recording_type is not None:
+        query = query.filter(models.Recording.recording_type == recording_type)
+    if after is not None:
+        # Paginación por clave: continuar tras la última grabación devuelta
+        query = query.filter(models.Recording.start_time > after)
+    return query.order_by(models.Recording.start_time).limit(limit).all()
+
+def delete_recordings_before(db: Session, cutoff: datetime, device_ids: Optional[List[int]] = None,
+                             exclude_device_ids: Optional[List[int]] = None, batch_size: int = 5000) -> int:
+    """Borrar por lotes las grabaciones que empiezan antes de `cutoff`; devuelve cuántas"""
+    conditions = [models.Recording.start_time < cutoff]
+    if device_ids is not None:
+        conditions.append(models.Recording.device_id.in_(device_ids))
+    if exclude_device_ids:
+        conditions.append(models.Recording.device_id.notin_(exclude_device_ids))
+    
+    deleted = 0
+    while True:
+        # Lotes cortos: cada transacción bloquea pocas filas
+        batch = select(models.Recording.id).where(*conditions).limit(batch_size)
+        result = db.execute(
+            delete(models.Recording)
+            .where(*conditions, models.Recording.id.in_(batch))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+
+def _as_datetime(value: Union[str, datetime]) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
 
 def create_recording(db: Session, recording: schemas.RecordingCreate):
     db_recording = models.Recording(**recording.dict())
@@ -71,3 +380,294 @@ def create_recording(db: Session, recording: schemas.RecordingCreate):
     db.commit()
     db.refresh(db_recording)
     return db_recording
+
+def _insert(db: Session, model):
+    # INSERT ... ON CONFLICT del dialecto en uso (Postgres en producción, SQLite en local)
+    if db.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+def upsert_recordings(db: Session, recordings: List[Dict]) -> int:
+    """Insertar grabaciones del NVR; una ya indexada (mismo device/canal/inicio) se actualiza"""
+    if not recordings:
+        return 0
+    stmt = _insert(db, models.Recording).values(recordings)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["device_id", "channel", "start_time"],
+        set_={
+            # Un archivo en curso crece entre sincronizaciones
+            "end_time": stmt.excluded.end_time,
+            "file_path": stmt.excluded.file_path,
+            "file_size": stmt.excluded.file_size,
+            "recording_type": stmt.excluded.recording_type
+        }
+    )
+    db.execute(stmt)
+    db.commit()
+    return len(recordings)
+
+def get_recording_rollups(db: Session, device_id: int, channels: List[int], first_day: date, last_day: date):
+    return db.query(models.RecordingRollup).filter(
+        models.RecordingRollup.device_id == device_id,
+        models.RecordingRollup.channel.in_(channels),
+        models.RecordingRollup.day >= first_day,
+        models.RecordingRollup.day <= last_day
+    ).all()
+
+def replace_recording_rollups(db: Session, device_id: int, channel: int, day: date, bitmaps: Dict[str, bytes]):
+    """Sustituir los bitmaps de un día de un canal (uno por tipo de grabación)"""
+    db.execute(
+        delete(models.RecordingRollup).where(
+            models.RecordingRollup.device_id == device_id,
+            models.RecordingRollup.channel == channel,
+            models.RecordingRollup.day == day
+        )
+    )
+    if bitmaps:
+        db.execute(
+            _insert(db, models.RecordingRollup).values([
+                {
+                    "device_id": device_id,
+                    "channel": channel,
+                    "day": day,
+                    "recording_type": recording_type,
+                    "minutes": minutes,
+                    "updated_at": datetime.utcnow()
+                }
+                for recording_type, minutes in bitmaps.items()
+            ])
+        )
+
+def delete_recording_rollups_before(db: Session, day: date, device_ids: Optional[List[int]] = None,
+                                    exclude_device_ids: Optional[List[int]] = None) -> int:
+    """Borrar los rollups de los días anteriores a `day`"""
+    conditions = [models.RecordingRollup.day < day]
+    if device_ids is not None:
+        conditions.append(models.RecordingRollup.device_id.in_(device_ids))
+    if exclude_device_ids:
+        conditions.append(models.RecordingRollup.device_id.notin_(exclude_device_ids))
+    result = db.execute(delete(models.RecordingRollup).where(*conditions))
+    db.commit()
+    return result.rowcount
+
+def get_recording_sync(db: Session, device_id: int, channel: int):
+    return db.query(models.RecordingSync).filter(
+        models.RecordingSync.device_id == device_id,
+        models.RecordingSync.channel == channel
+    ).first()
+
+def get_recording_syncs(db: Session, device_id: int):
+    return db.query(models.RecordingSync).filter(
+        models.RecordingSync.device_id == device_id
+    ).order_by(models.RecordingSync.channel).all()
+
+def claim_recording_sync(db: Session, device_id: int, channel: int, owner: str,
+                         lease_until: datetime) -> Optional[models.RecordingSync]:
+    """Tomar el lease de sincronización de un canal; None si otro worker lo tiene"""
+    db.execute(
+        _insert(db, models.RecordingSync)
+        .values(device_id=device_id, channel=channel)
+        .on_conflict_do_nothing(index_elements=["device_id", "channel"])
+    )
+    row = db.execute(
+        update(models.RecordingSync)
+        .where(
+            models.RecordingSync.device_id == device_id,
+            models.RecordingSync.channel == channel,
+            or_(
+                models.RecordingSync.locked_until == None,
+                models.RecordingSync.locked_until < datetime.utcnow(),
+                models.RecordingSync.locked_by == owner
+            )
+        )
+        .values(locked_by=owner, locked_until=lease_until)
+        .returning(models.RecordingSync.synced_until)
+    ).first()
+    db.commit()
+    return get_recording_sync(db, device_id, channel) if row else None
+
+def advance_recording_sync(db: Session, device_id: int, channel: int, owner: str,
+                           synced_until: datetime, lease_until: datetime) -> int:
+    """Avanzar la marca de agua y renovar el lease mientras se sincroniza"""
+    result = db.execute(
+        update(models.RecordingSync)
+        .where(
+            models.RecordingSync.device_id == device_id,
+            models.RecordingSync.channel == channel,
+            models.RecordingSync.locked_by == owner
+        )
+        .values(synced_until=synced_until, locked_until=lease_until)
+    )
+    db.commit()
+    return result.rowcount
+
+def release_recording_sync(db: Session, device_id: int, channel: int, owner: str,
+                           error: Optional[str] = None) -> int:
+    result = db.execute(
+        update(models.RecordingSync)
+        .where(
+            models.RecordingSync.device_id == device_id,
+            models.RecordingSync.channel == channel,
+            models.RecordingSync.locked_by == owner
+        )
+        .values(locked_by=None, locked_until=None, last_run_at=datetime.utcnow(), last_error=error)
+    )
+    db.commit()
+    return result.rowcount
+
+def get_export(db: Session, export_id: str):
+    return db.query(models.RecordingExport).filter(models.RecordingExport.id == export_id).first()
+
+def create_export(db: Session, export: Dict) -> models.RecordingExport:
+    """Encolar una exportación; si ya existe (mismo tramo) se devuelve la existente"""
+    db.execute(
+        _insert(db, models.RecordingExport)
+        .values(status="queued", progress=0, created_at=datetime.utcnow(), **export)
+        .on_conflict_do_nothing(index_elements=["id"])
+    )
+    db.commit()
+    return get_export(db, export["id"])
+
+def requeue_export(db: Session, export_id: str, requested_by: Optional[str] = None) -> int:
+    """Volver a encolar una exportación fallida, expulsada de la caché o cuyo archivo ya no existe"""
+    result = db.execute(
+        update(models.RecordingExport)
+        .where(
+            models.RecordingExport.id == export_id,
+            models.RecordingExport.status.in_(["failed", "done", "evicted"])
+        )
+        .values(status="queued", progress=0, file_size=None, error=None, requested_by=requested_by,
+                created_at=datetime.utcnow(), started_at=None, finished_at=None,
+                last_accessed_at=datetime.utcnow())
+    )
+    db.commit()
+    return result.rowcount
+
+def claim_export(db: Session, owner: str, lease_until: datetime,
+                 max_per_device: int) -> Optional[models.RecordingExport]:
+    """
+    Tomar la exportación en cola más antigua cuyo NVR tenga hueco
+    
+    El límite por dispositivo es global: en Postgres un lock de transacción
+    serializa el recuento y la reserva entre workers.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": EXPORT_CLAIM_LOCK_KEY})
+    running = dict(
+        db.query(models.RecordingExport.device_id, func.count())
+        .filter(models.RecordingExport.status == "running")
+        .group_by(models.RecordingExport.device_id)
+        .all()
+    )
+    queued = db.query(models.RecordingExport).filter(
+        models.RecordingExport.status == "queued"
+    ).order_by(models.RecordingExport.created_at).limit(100).all()
+    for export in queued:
+        if running.get(export.device_id, 0) >= max_per_device:
+            continue
+        result = db.execute(
+            update(models.RecordingExport)
+            .where(models.RecordingExport.id == export.id, models.RecordingExport.status == "queued")
+            .values(status="running", progress=0, locked_by=owner, locked_until=lease_until,
+                    started_at=datetime.utcnow())
+        )
+        db.commit()
+        if result.rowcount:
+            db.refresh(export)
+            return export
+        # Otro worker la tomó entre medias: probar la siguiente
+        continue
+    db.commit()
+    return None
+
+def update_export(db: Session, export_id: str, owner: str, **values) -> int:
+    """Actualizar una exportación en curso (progreso, lease o resultado) si sigue siendo de `owner`"""
+    result = db.execute(
+        update(models.RecordingExport)
+        .where(models.RecordingExport.id == export_id, models.RecordingExport.locked_by == owner)
+        .values(**values)
+    )
+    db.commit()
+    return result.rowcount
+
+def requeue_stale_exports(db: Session) -> int:
+    """Devolver a la cola las exportaciones de workers caídos (lease vencido)"""
+    result = db.execute(
+        update(models.RecordingExport)
+        .where(
+            models.RecordingExport.status == "running",
+            models.RecordingExport.locked_until < datetime.utcnow()
+        )
+        .values(status="queued", progress=0, locked_by=None, locked_until=None)
+    )
+    db.commit()
+    return result.rowcount
+
+def touch_export(db: Session, export_id: str, hit: bool = True) -> int:
+    """
+    Pasar la exportación al final de la LRU
+    
+    Con `hit` cuenta además un acierto de caché (una petición deduplicada a
+    un archivo existente); una descarga solo refresca el último acceso.
+    """
+    values = {"last_accessed_at": datetime.utcnow()}
+    if hit:
+        values["hits"] = func.coalesce(models.RecordingExport.hits, 0) + 1
+    result = db.execute(
+        update(models.RecordingExport)
+        .where(models.RecordingExport.id == export_id)
+        .values(**values)
+    )
+    db.commit()
+    return result.rowcount
+
+def set_export_pinned(db: Session, export_id: str, pinned: bool, reason: Optional[str] = None) -> int:
+    result = db.execute(
+        update(models.RecordingExport)
+        .where(models.RecordingExport.id == export_id)
+        .values(pinned=pinned, pin_reason=reason if pinned else None)
+    )
+    db.commit()
+    return result.rowcount
+
+def get_export_cache_usage(db: Session) -> Dict[str, int]:
+    """Bytes y entradas en disco (exportaciones terminadas), totales y fijadas"""
+    pinned = func.coalesce(models.RecordingExport.pinned, False)
+    size = func.coalesce(models.RecordingExport.file_size, 0)
+    row = db.query(
+        func.count(),
+        func.coalesce(func.sum(size), 0),
+        func.coalesce(func.sum(case((pinned == True, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((pinned == True, size), else_=0)), 0)
+    ).filter(models.RecordingExport.status == "done").one()
+    return {"entries": row[0], "bytes": int(row[1]), "pinned_entries": row[2], "pinned_bytes": int(row[3])}
+
+def get_evictable_exports(db: Session, limit: int = 100):
+    """Exportaciones terminadas y no fijadas, de la usada hace más tiempo a la más reciente"""
+    return db.query(models.RecordingExport).filter(
+        models.RecordingExport.status == "done",
+        func.coalesce(models.RecordingExport.pinned, False) == False
+    ).order_by(
+        func.coalesce(models.RecordingExport.last_accessed_at, models.RecordingExport.finished_at)
+    ).limit(limit).all()
+
+def evict_export(db: Session, export_id: str) -> bool:
+    """Marcar expulsada una exportación si sigue terminada y sin fijar (el archivo se borra después)"""
+    result = db.execute(
+        update(models.RecordingExport)
+        .where(
+            models.RecordingExport.id == export_id,
+            models.RecordingExport.status == "done",
+            func.coalesce(models.RecordingExport.pinned, False) == False
+        )
+        .values(status="evicted", file_size=None)
+    )
+    db.commit()
+    return result.rowcount > 0
+
+def count_exports_by_status(db: Session) -> Dict[str, int]:
+    return dict(
+        db.query(models.RecordingExport.status, func.count())
+        .group_by(models.RecordingExport.status)
+        .all()
+    )
@@ -1,14 +1,37 @@
 import os
 import ctypes
-from ctypes import cdll, c_int, c_char_p, Structure, byref, create_string_buffer, c_void_p, c_uint32, c_byte, c_bool
-from typing import Dict, List, Optional, Any
+from ctypes import c_int, c_longlong, c_char_p, Structure, byref, create_string_buffer, c_void_p, c_uint32, c_byte, c_bool
+from typing import Dict, Iterator, List, Optional, Any
 import logging
+from datetime import datetime
+from itertools import islice
+from .sdk_runtime import SDKRuntime
+from .sdk_executor import SDK_CONNECT_TIMEOUT_MS, SDK_CONNECT_TRIES
 
 logger = logging.getLogger(__name__)
 
 # Ruta dinámica — el binario lo coloca el integrador
 DAHUA_SDK_PATH = os.getenv("DAHUA_SDK_PATH", "./sdk/dahua/dhnetsdk.dll")
 
+# Códigos de CLIENT_GetLastError (_EC(x) = 0x80000000 | x) que invalidan la sesión
+#   2 NET_NETWORK_ERROR, 4 NET_INVALID_HANDLE
+SESSION_ERROR_CODES = {0x80000000 | 2, 0x80000000 | 4}
+# Timeout de las consultas de comprobación de sesión (ms)
+CHECK_SESSION_WAIT_MS = 3000
+# Archivos pedidos por llamada a CLIENT_QueryRecordFile y su timeout (ms)
+QUERY_RECORD_BATCH = 64
+QUERY_RECORD_WAIT_MS = 5000
+
+# Tipos de grabación (nRecordFileType en la búsqueda y en el resultado)
+FILE_TYPES = {0: "normal", 1: "alarm", 2: "motion"}
+SEARCH_FILE_TYPES = {"alarm": 1, "motion": 2}
+
+class DahuaError(Exception):
+    """Error del SDK de Dahua con el código de CLIENT_GetLastError"""
+    def __init__(self, message: str, error_code: int):
+        super().__init__(message)
+        self.error_code = error_code
+
 # Estructuras del SDK de Dahua v3.060
 class NET_IN_LOGIN_WITH_HIGHLEVEL_SECURITY(Structure):
     _fields_ = [
@@ -61,76 +84,137 @@ class NET_DEVICEINFO_Ex(Structure):
         ("nReserved", c_int * 4),
     ]
 
+class NET_TIME(Structure):
+    _fields_ = [
+        ("dwYear", c_uint32),
+        ("dwMonth", c_uint32),
+        ("dwDay", c_uint32),
+        ("dwHour", c_uint32),
+        ("dwMinute", c_uint32),
+        ("dwSecond", c_uint32),
+    ]
+
+class NET_RECORDFILE_INFO(Structure):
+    _fields_ = [
+        ("ch", c_uint32),
+        ("filename", ctypes.c_char * 124),
+        ("framenum", c_uint32),
+        ("size", c_uint32),  # KB
+        ("starttime", NET_TIME),
+        ("endtime", NET_TIME),
+        ("driveno", c_uint32),
+        ("startcluster", c_uint32),
+        ("nRecordFileType", c_byte),
+        ("bImportantRecID", c_byte),
+        ("bHint", c_byte),
+        ("bRecType", c_byte),
+    ]
+
 class DahuaSDK:
+    """
+    Handle ligero sobre el runtime de dhnetsdk del proceso
+    
+    La librería se carga e inicializa una sola vez (DAHUA_RUNTIME); cada
+    instancia solo toma una referencia que suelta en `close`.
+    """
     def __init__(self):
         if not os.path.exists(DAHUA_SDK_PATH):
             raise FileNotFoundError(f"Dahua SDK no encontrado en {DAHUA_SDK_PATH}")
         
         try:
-            self.lib = cdll.LoadLibrary(DAHUA_SDK_PATH)
-            self._setup_function_signatures()
-            # Inicializar SDK si es necesario
-            logger.info("Dahua SDK cargado correctamente")
+            self.lib = DAHUA_RUNTIME.acquire()
         except Exception as e:
             logger.error(f"Error cargando Dahua SDK: {e}")
             raise
 
-    def _setup_function_signatures(self):
+    def close(self):
+        """Soltar la referencia al runtime del SDK"""
+        if getattr(self, "lib", None) is not None:
+            self.lib = None
+            DAHUA_RUNTIME.release()
+
+    @staticmethod
+    def _setup_function_signatures(lib):
         """Configurar las firmas de las funciones del SDK"""
         try:
-            # CLIENT_Init
-            self.lib.CLIENT_Init.restype = c_bool
+            # CLIENT_Init(cbDisConnect, dwUser)
+            lib.CLIENT_Init.argtypes = [c_void_p, c_void_p]
+            lib.CLIENT_Init.restype = c_bool
             
             # CLIENT_LoginWithHighLevelSecurity
-            self.lib.CLIENT_LoginWithHighLevelSecurity.argtypes = [
+            lib.CLIENT_LoginWithHighLevelSecurity.argtypes = [
                 ctypes.POINTER(NET_IN_LOGIN_WITH_HIGHLEVEL_SECURITY),
                 ctypes.POINTER(NET_OUT_LOGIN_WITH_HIGHLEVEL_SECURITY)
             ]
-            self.lib.CLIENT_LoginWithHighLevelSecurity.restype = c_int
+            # Devuelve el handle de sesión (LLONG)
+            lib.CLIENT_LoginWithHighLevelSecurity.restype = c_longlong
             
             # CLIENT_Logout
-            self.lib.CLIENT_Logout.argtypes = [c_int]
-            self.lib.CLIENT_Logout.restype = c_bool
+            lib.CLIENT_Logout.argtypes = [c_longlong]
+            lib.CLIENT_Logout.restype = c_bool
             
             # CLIENT_Cleanup
-            self.lib.CLIENT_Cleanup.restype = c_bool
+            lib.CLIENT_Cleanup.restype = c_bool
             
             # CLIENT_QueryRecordFile (para búsqueda de grabaciones)
-            self.lib.CLIENT_QueryRecordFile.argtypes = [
-                c_int,  # lLoginID
-                ctypes.POINTER(ctypes.c_byte),  # lpQueryRecordFile
-                ctypes.POINTER(ctypes.c_byte),  # lpQueryRecordFileOut
+            lib.CLIENT_QueryRecordFile.argtypes = [
+                c_longlong,  # lLoginID (LLONG: 64 bits en x64)
+                c_int,  # nChannelId (0-based)
+                c_int,  # nRecordFileType
+                ctypes.POINTER(NET_TIME),  # tmStart
+                ctypes.POINTER(NET_TIME),  # tmEnd
+                c_char_p,  # pchCardid
+                ctypes.POINTER(NET_RECORDFILE_INFO),  # nriFileinfo
+                c_int,  # maxlen (bytes)
+                ctypes.POINTER(c_int),  # filecount
+                c_int,  # waittime
+                c_bool,  # bTime
             ]
-            self.lib.CLIENT_QueryRecordFile.restype = c_bool
+            lib.CLIENT_QueryRecordFile.restype = c_bool
             
             # CLIENT_QueryRecordFileEx (búsqueda extendida)
-            self.lib.CLIENT_QueryRecordFileEx.argtypes = [
-                c_int,  # lLoginID
+            lib.CLIENT_QueryRecordFileEx.argtypes = [
+                c_longlong,  # lLoginID (LLONG: 64 bits en x64)
                 ctypes.POINTER(ctypes.c_byte),  # lpQueryRecordFile
                 ctypes.POINTER(ctypes.c_byte),  # lpQueryRecordFileOut
             ]
-            self.lib.CLIENT_QueryRecordFileEx.restype = c_bool
+            lib.CLIENT_QueryRecordFileEx.restype = c_bool
             
             # CLIENT_PTZControl (control PTZ)
-            self.lib.CLIENT_PTZControl.argtypes = [
-                c_int,  # lLoginID
+            lib.CLIENT_PTZControl.argtypes = [
+                c_longlong,  # lLoginID (LLONG: 64 bits en x64)
                 c_int,  # nChannelID
                 c_int,  # dwCommand
                 c_int,  # dwSpeed
                 c_int,  # dwStop
             ]
-            self.lib.CLIENT_PTZControl.restype = c_bool
+            lib.CLIENT_PTZControl.restype = c_bool
             
             # CLIENT_QueryDeviceInfo (información del dispositivo)
-            self.lib.CLIENT_QueryDeviceInfo.argtypes = [
-                c_int,  # lLoginID
+            lib.CLIENT_QueryDeviceInfo.argtypes = [
+                c_longlong,  # lLoginID (LLONG: 64 bits en x64)
                 c_int,  # nType
                 ctypes.POINTER(ctypes.c_byte),  # lpOutBuffer
                 c_int,  # dwOutBufferSize
                 ctypes.POINTER(c_int),  # lpBytesReturned
             ]
-            self.lib.CLIENT_QueryDeviceInfo.restype = c_bool
+            lib.CLIENT_QueryDeviceInfo.restype = c_bool
+            
+            # CLIENT_QueryDeviceTime (comprobación de estado de la sesión)
+            lib.CLIENT_QueryDeviceTime.argtypes = [
+                c_longlong,  # lLoginID (LLONG: 64 bits en x64)
+                ctypes.POINTER(NET_TIME),  # pDeviceTime
+                c_int,  # waittime
+            ]
+            lib.CLIENT_QueryDeviceTime.restype = c_bool
             
+            # CLIENT_SetConnectTime(nWaitTime, nTryTimes)
+            lib.CLIENT_SetConnectTime.argtypes = [c_int, c_int]
+            lib.CLIENT_SetConnectTime.restype = None
+            
+            # CLIENT_GetLastError
+            lib.CLIENT_GetLastError.restype = c_uint32
+        
         except Exception as e:
             logger.warning(f"Error configurando firmas de funciones Dahua: {e}")
 
@@ -143,7 +227,7 @@ class DahuaSDK:
             port: Puerto del dispositivo
             username: Nombre de usuario
             password: Contraseña
-            
+        
         Returns:
             Dict con información de la sesión
         """
@@ -178,7 +262,7 @@ class DahuaSDK:
             
             if user_id == 0:
                 error_code = login_out.nErrorCode
-                raise Exception(f"Error de login Dahua: {error_code}")
+                raise DahuaError(f"Error de login Dahua: {error_code}", error_code)
             
             # Extraer token
             token = ''.join([chr(login_out.szToken[i]) for i in range(login_out.nTokenLen) if login_out.szToken[i] != 0])
@@ -193,7 +277,7 @@ class DahuaSDK:
                     "error_code": login_out.nErrorCode
                 }
             }
-            
+        
         except Exception as e:
             logger.error(f"Error en login Dahua: {e}")
             raise
@@ -207,7 +291,78 @@ class DahuaSDK:
             logger.error(f"Error en logout Dahua: {e}")
             return False
 
-    def find_recordings(self, user_id: int, channel: int, start_time: str, end_time: str) -> List[Dict[str, Any]]:
+    def check_session(self, user_id: int) -> bool:
+        """Comprobar que la sesión sigue viva consultando la hora del dispositivo"""
+        try:
+            device_time = NET_TIME()
+            return bool(self.lib.CLIENT_QueryDeviceTime(user_id, byref(device_time), CHECK_SESSION_WAIT_MS))
+        except Exception as e:
+            logger.error(f"Error comprobando sesión Dahua: {e}")
+            return False
+
+    def last_error(self) -> int:
+        """Último código de error del SDK"""
+        return self.lib.CLIENT_GetLastError()
+
+    def iter_recordings(self, user_id: int, channel: int, start_time: str, end_time: str,
+                        file_type: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Recorrer las grabaciones del dispositivo Dahua por lotes
+        
+        CLIENT_QueryRecordFile devuelve como mucho QUERY_RECORD_BATCH archivos
+        por llamada; si el lote viene lleno se vuelve a consultar desde el
+        final del último archivo. Solo se guarda un lote en memoria.
+        
+        Args:
+            user_id: ID de usuario de la sesión
+            channel: Canal a consultar (1-based)
+            start_time: Fecha/hora de inicio (formato: "2023-01-01 00:00:00")
+            end_time: Fecha/hora de fin
+            file_type: Tipo de grabación (normal, alarm, motion) o None para todas
+        """
+        files = (NET_RECORDFILE_INFO * QUERY_RECORD_BATCH)()
+        count = c_int(0)
+        search_start = _to_net_time(start_time)
+        search_end = _to_net_time(end_time)
+        # Archivos del lote anterior: la consulta siguiente empieza en su final y puede repetirlos
+        previous = set()
+        
+        while True:
+            ok = self.lib.CLIENT_QueryRecordFile(
+                user_id, channel - 1, SEARCH_FILE_TYPES.get(file_type, 0),
+                byref(search_start), byref(search_end), None,
+                files, ctypes.sizeof(files), byref(count), QUERY_RECORD_WAIT_MS, False
+            )
+            if not ok:
+                error_code = self.lib.CLIENT_GetLastError()
+                raise DahuaError(f"Error buscando grabaciones Dahua: {error_code}", error_code)
+            
+            batch = set()
+            for info in files[:count.value]:
+                record = {
+                    "start": _format_net_time(info.starttime),
+                    "end": _format_net_time(info.endtime),
+                    "type": FILE_TYPES.get(info.nRecordFileType, "other"),
+                    "file_path": info.filename.decode("utf-8", "replace"),
+                    "size": info.size * 1024,
+                    "channel": channel
+                }
+                key = (record["start"], record["file_path"])
+                batch.add(key)
+                if key in previous or (file_type and record["type"] != file_type):
+                    continue
+                yield record
+            
+            if count.value < QUERY_RECORD_BATCH:
+                return
+            next_start = files[count.value - 1].endtime
+            if _format_net_time(next_start) <= _format_net_time(search_start):
+                return
+            search_start = NET_TIME.from_buffer_copy(next_start)
+            previous = batch
+
+    def find_recordings(self, user_id: int, channel: int, start_time: str, end_time: str,
+                        file_type: Optional[str] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
         """
         Buscar grabaciones en el dispositivo Dahua
         
@@ -216,33 +371,20 @@ class DahuaSDK:
             channel: Canal a consultar
             start_time: Fecha/hora de inicio
             end_time: Fecha/hora de fin
-            
+            file_type: Tipo de grabación o None para todas
+            limit: Máximo de grabaciones a devolver
+        
         Returns:
             Lista de grabaciones encontradas
         """
         try:
-            # En una implementación real, aquí se usaría:
-            # CLIENT_QueryRecordFile
-            
-            # Por ahora, devolvemos datos de ejemplo
-            recordings = [
-                {
-                    "start": start_time,
-                    "end": end_time,
-                    "type": "normal",
-                    "file_path": f"/recordings/ch{channel:02d}_{start_time.replace(' ', '_')}.mp4",
-                    "size": 1024000,
-                    "channel": channel
-                }
-            ]
-            
-            return recordings
-            
+            return list(islice(self.iter_recordings(user_id, channel, start_time, end_time, file_type), limit))
         except Exception as e:
             logger.error(f"Error buscando grabaciones Dahua: {e}")
-            return []
+            raise
 
-    def get_rtsp_url(self, ip: str, port: int, username: str, password: str, channel: int, sub_stream: int = 0) -> str:
+    @staticmethod
+    def get_rtsp_url(ip: str, port: int, username: str, password: str, channel: int, sub_stream: int = 0) -> str:
         """
         Generar URL RTSP para streaming Dahua
         
@@ -253,7 +395,7 @@ class DahuaSDK:
             password: Contraseña
             channel: Canal (1-based)
             sub_stream: Sub-stream (0=main, 1=sub)
-            
+        
         Returns:
             URL RTSP completa
         """
@@ -262,10 +404,34 @@ class DahuaSDK:
             stream_type = "0"  # Main stream
         else:
             stream_type = "1"  # Sub stream
-            
+        
         rtsp_url = f"rtsp://{username}:{password}@{ip}:{port}/cam/realmonitor?channel={channel}&subtype={stream_type}"
         return rtsp_url
 
+    @staticmethod
+    def get_playback_url(ip: str, port: int, username: str, password: str, channel: int,
+                         start_time: datetime, end_time: datetime, sub_stream: int = 0) -> str:
+        """
+        Generar URL RTSP de reproducción de grabaciones Dahua
+        
+        Args:
+            ip: IP del dispositivo
+            port: Puerto del dispositivo
+            username: Usuario
+            password: Contraseña
+            channel: Canal (1-based)
+            start_time: Inicio del tramo (hora del NVR)
+            end_time: Fin del tramo (hora del NVR)
+            sub_stream: Sub-stream (0=main, 1=sub)
+        
+        Returns:
+            URL RTSP de reproducción
+        """
+        stream_type = "0" if sub_stream == 0 else "1"
+        start = start_time.strftime("%Y_%m_%d_%H_%M_%S")
+        end = end_time.strftime("%Y_%m_%d_%H_%M_%S")
+        return f"rtsp://{username}:{password}@{ip}:{port}/cam/playback?channel={channel}&subtype={stream_type}&starttime={start}&endtime={end}"
+
     def control_ptz(self, user_id: int, channel: int, command: str, speed: int = 4) -> bool:
         """
         Control PTZ básico para Dahua
@@ -275,7 +441,7 @@ class DahuaSDK:
             channel: Canal
             command: Comando PTZ (up, down, left, right, zoom_in, zoom_out, stop)
             speed: Velocidad (1-7)
-            
+        
         Returns:
             True si el comando se ejecutó correctamente
         """
@@ -284,15 +450,36 @@ class DahuaSDK:
             # Por ahora, simulamos éxito
             logger.info(f"Comando PTZ Dahua: {command} en canal {channel} con velocidad {speed}")
             return True
-            
+        
         except Exception as e:
             logger.error(f"Error en control PTZ Dahua: {e}")
             return False
 
     def __del__(self):
-        """Cleanup al destruir la instancia"""
+        """Soltar la referencia al destruir la instancia (la limpieza global es del runtime)"""
         try:
-            if hasattr(self, 'lib'):
-                self.lib.CLIENT_Cleanup()
+            self.close()
         except:
             pass
+
+def _to_net_time(value: str) -> NET_TIME:
+    moment = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    return NET_TIME(moment.year, moment.month, moment.day, moment.hour, moment.minute, moment.second)
+
+def _format_net_time(value: NET_TIME) -> str:
+    return (f"{value.dwYear:04d}-{value.dwMonth:02d}-{value.dwDay:02d} "
+            f"{value.dwHour:02d}:{value.dwMinute:02d}:{value.dwSecond:02d}")
+
+def _init_runtime(lib):
+    # Sin callback de desconexión: el pool de sesiones detecta las sesiones caídas
+    if not lib.CLIENT_Init(None, None):
+        logger.warning("Error al inicializar Dahua SDK")
+    # Acotar el timeout TCP: una cámara inaccesible no debe bloquear un hilo durante minutos
+    lib.CLIENT_SetConnectTime(SDK_CONNECT_TIMEOUT_MS, SDK_CONNECT_TRIES)
+
+DAHUA_RUNTIME = SDKRuntime(
+    "Dahua", DAHUA_SDK_PATH,
+    setup=DahuaSDK._setup_function_signatures,
+    init=_init_runtime,
+    cleanup=lambda lib: lib.CLIENT_Cleanup()
+)
@@ -0,0 +1,226 @@
+import bisect
+import math
+import os
+import re
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Ventana de time-shift por defecto de los streams con retención (segundos)
+DVR_WINDOW = int(os.getenv("DVR_WINDOW", "1800"))
+# Ventana máxima que se puede pedir por stream
+DVR_MAX_WINDOW = int(os.getenv("DVR_MAX_WINDOW", "21600"))
+# Bytes máximos retenidos por stream, aunque la ventana no esté llena
+DVR_MAX_BYTES = int(os.getenv("DVR_MAX_BYTES", str(4 * 1024 ** 3)))
+
+# Índice de segmentos dentro del directorio de retención (lo leen los demás workers)
+INDEX_NAME = "index"
+PLAYLIST_NAME = "playlist.m3u8"
+
+_EXTINF_RE = re.compile(r"#EXTINF:(?P<duration>[\d.]+)")
+
+@dataclass
+class DVRSegment:
+    msn: int
+    # Inicio en hora UTC (epoch) y duración en segundos
+    start: float
+    duration: float
+    size: int
+    name: str
+
+    @property
+    def end(self) -> float:
+        return self.start + self.duration
+
+class DVRIndex:
+    """
+    Índice de los segmentos retenidos de un stream (anillo de time-shift)
+    
+    Los segmentos se añaden en orden y los que quedan fuera de la ventana
+    (o del tope de bytes) salen por el principio: el llamador borra sus
+    archivos. La playlist se genera bajo demanda desde el índice en lugar de
+    que FFmpeg reescriba una m3u8 enorme en cada segmento, y la búsqueda por
+    hora es una bisección sobre los inicios.
+    
+    El índice se guarda en `INDEX_NAME` (una línea por segmento) para que
+    cualquier worker pueda servir la playlist; solo el worker dueño del
+    FFmpeg lo modifica.
+    """
+    def __init__(self, directory: Path, window: int = DVR_WINDOW, max_bytes: int = DVR_MAX_BYTES):
+        self.directory = directory
+        self.window = window
+        self.max_bytes = max_bytes
+        self.segments: List[DVRSegment] = []
+        # Inicios de los segmentos, en paralelo a `segments`, para bisect
+        self._starts: List[float] = []
+        self.init: Optional[str] = None
+        self.bytes = 0
+        self.next_msn = 0
+        # (inode, mtime_ns, tamaño) del archivo del que se cargó (lectores)
+        self.version: Optional[Tuple[int, int, int]] = None
+
+    def add(self, name: str, start: float, duration: float, size: int) -> List[DVRSegment]:
+        """Añadir un segmento completo; devuelve los que salen del anillo"""
+        removed = []
+        for i, segment in enumerate(self.segments):
+            if segment.name == name:
+                # FFmpeg reinició la numeración: el archivo retenido se sobrescribió
+                self.bytes -= segment.size
+                del self.segments[i], self._starts[i]
+                break
+        
+        # Misma precisión que el archivo de índice: todos los workers generan la misma playlist
+        start, duration = round(start, 3), round(duration, 3)
+        # Con relojes que retroceden (NTP) se conserva el orden del índice
+        if self._starts and start < self._starts[-1]:
+            start = round(self.segments[-1].end, 3)
+        self.segments.append(DVRSegment(self.next_msn, start, duration, size, name))
+        self._starts.append(start)
+        self.next_msn += 1
+        self.bytes += size
+        
+        cutoff = self.segments[-1].end - self.window
+        while len(self.segments) > 1 and (self.segments[0].end <= cutoff or self.bytes > self.max_bytes):
+            segment = self.segments.pop(0)
+            self._starts.pop(0)
+            self.bytes -= segment.size
+            removed.append(segment)
+        return removed
+
+    def seek(self, at: float) -> Optional[Tuple[int, float]]:
+        """Posición (índice del segmento, desplazamiento en segundos) de una hora UTC"""
+        if not self.segments:
+            return None
+        i = bisect.bisect_right(self._starts, at) - 1
+        if i < 0:
+            # Anterior a la ventana: el segmento más antiguo disponible
+            return 0, 0.0
+        segment = self.segments[i]
+        return i, min(max(at - segment.start, 0.0), segment.duration)
+
+    def playlist(self, start: Optional[float] = None) -> str:
+        """
+        Playlist HLS del anillo
+        
+        Sin `start` es una playlist en vivo con toda la ventana (el player
+        arranca en el borde en vivo y puede retroceder). Con `start` es una
+        playlist EVENT anclada en el segmento que contiene esa hora y el player
+        empieza exactamente en ella (EXT-X-START). Cada segmento lleva
+        EXT-X-PROGRAM-DATE-TIME para mostrar la hora real al retroceder.
+        """
+        first, offset = 0, None
+        if start is not None:
+            position = self.seek(start)
+            if position is not None:
+                first, offset = position
+        segments = self.segments[first:]
+        target = max((math.ceil(segment.duration) for segment in segments), default=1)
+        
+        lines = ["#EXTM3U", "#EXT-X-VERSION:7" if self.init else "#EXT-X-VERSION:3",
+                 f"#EXT-X-TARGETDURATION:{target}"]
+        if offset is not None:
+            lines += ["#EXT-X-PLAYLIST-TYPE:EVENT", f"#EXT-X-START:TIME-OFFSET={offset:.3f},PRECISE=YES"]
+        lines.append(f"#EXT-X-MEDIA-SEQUENCE:{segments[0].msn if segments else self.next_msn}")
+        if self.init:
+            lines.append(f'#EXT-X-MAP:URI="{self.init}"')
+        
+        previous = None
+        for segment in segments:
+            # Hueco (reinicio de FFmpeg o segmento perdido): discontinuidad
+            if previous is not None and (segment.msn != previous.msn + 1 or segment.start - previous.end > 1):
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines += [
+                f"#EXT-X-PROGRAM-DATE-TIME:{_format_time(segment.start)}",
+                f"#EXTINF:{segment.duration:.3f},",
+                segment.name
+            ]
+            previous = segment
+        return "\n".join(lines) + "\n"
+
+    def get_info(self) -> Dict:
+        return {
+            "window_seconds": self.window,
+            "segments": len(self.segments),
+            "bytes": self.bytes,
+            "start_time": _format_time(self.segments[0].start) if self.segments else None,
+            "end_time": _format_time(self.segments[-1].end) if self.segments else None,
+            "duration_seconds": round(self.segments[-1].end - self.segments[0].start, 3) if self.segments else 0
+        }
+
+    def dump(self) -> str:
+        """Contenido del archivo de índice"""
+        lines = [f"init {self.init}"] if self.init else []
+        lines += [
+            f"{segment.msn} {segment.start:.3f} {segment.duration:.3f} {segment.size} {segment.name}"
+            for segment in self.segments
+        ]
+        return "\n".join(lines) + "\n"
+
+    def save(self, data: str, removed: List[DVRSegment]):
+        """Escribir el índice (rename atómico) y borrar los segmentos que salieron del anillo"""
+        partial = self.directory / f".{INDEX_NAME}.part"
+        partial.write_text(data)
+        os.replace(partial, self.directory / INDEX_NAME)
+        for segment in removed:
+            try:
+                os.unlink(self.directory / segment.name)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def load(cls, directory: Path, cached: Optional["DVRIndex"] = None) -> Optional["DVRIndex"]:
+        """Índice de un stream de otro worker; reutiliza `cached` si el archivo no cambió"""
+        path = directory / INDEX_NAME
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if cached is not None and cached.version == version:
+            return cached
+        
+        index = cls(directory)
+        index.version = version
+        try:
+            data = path.read_text()
+        except FileNotFoundError:
+            return None
+        for line in data.splitlines():
+            parts = line.split(" ")
+            if parts[0] == "init" and len(parts) == 2:
+                index.init = parts[1]
+            elif len(parts) == 5:
+                segment = DVRSegment(int(parts[0]), float(parts[1]), float(parts[2]), int(parts[3]), parts[4])
+                index.segments.append(segment)
+                index._starts.append(segment.start)
+                index.bytes += segment.size
+        if index.segments:
+            index.next_msn = index.segments[-1].msn + 1
+        return index
+
+def segment_duration(playlist: Path, name: str) -> Optional[float]:
+    """Duración (EXTINF) de un segmento según la playlist en vivo de FFmpeg"""
+    try:
+        lines = playlist.read_text().splitlines()
+    except (FileNotFoundError, UnicodeDecodeError):
+        return None
+    duration = None
+    for line in lines:
+        match = _EXTINF_RE.match(line)
+        if match:
+            duration = float(match.group("duration"))
+        elif line.strip() and not line.startswith("#"):
+            if os.path.basename(line.strip()) == name:
+                return duration
+            duration = None
+    return None
+
+def to_epoch(value: datetime) -> float:
+    """Hora de la API (UTC, con o sin zona) a epoch"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+def _format_time(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
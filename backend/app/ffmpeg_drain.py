@@ -0,0 +1,135 @@
+import asyncio
+import os
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Líneas de log de FFmpeg que se conservan por stream
+LOG_LINES = int(os.getenv("FFMPEG_LOG_LINES", "50"))
+# Límite de lectura por línea (FFmpeg puede emitir líneas muy largas con metadatos)
+READ_CHUNK = 64 * 1024
+
+class FFmpegDrain:
+    """
+    Drenar stdout/stderr de un proceso FFmpeg sin bloquear
+    
+    stdout recibe la salida de `-progress pipe:1` (bloques clave=valor que
+    terminan en `progress=continue|end`) y se convierte en métricas en vivo.
+    stderr se guarda en un ring buffer acotado con las últimas líneas de log.
+    Leer ambos pipes continuamente evita que FFmpeg se bloquee al llenar el
+    buffer del pipe (64 KiB) y congele el stream.
+    
+    `on_log_line` recibe cada línea de stderr (p.ej. para detectar segmentos).
+    """
+    def __init__(self, stream_id: str, max_lines: int = LOG_LINES,
+                 on_log_line: Optional[Callable[[str], None]] = None):
+        self.stream_id = stream_id
+        self.on_log_line = on_log_line
+        self.log: Deque[str] = deque(maxlen=max_lines)
+        self.metrics: Dict = {
+            "fps": None,
+            "bitrate_kbps": None,
+            "speed": None,
+            "frames": None,
+            "dropped_frames": None,
+            "duplicated_frames": None,
+            "total_size": None,
+            "out_time_s": None,
+            "updated_at": None
+        }
+        self._tasks: List[asyncio.Task] = []
+
+    def attach(self, proc: asyncio.subprocess.Process):
+        """Empezar a drenar los pipes de un proceso (también tras un reinicio)"""
+        self._tasks = [task for task in self._tasks if not task.done()]
+        if proc.stdout is not None:
+            self._tasks.append(asyncio.create_task(self._read_progress(proc.stdout)))
+        if proc.stderr is not None:
+            self._tasks.append(asyncio.create_task(self._read_log(proc.stderr)))
+
+    def close(self):
+        """Cancelar las lecturas pendientes"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def tail(self, lines: Optional[int] = None) -> List[str]:
+        """Últimas líneas de log"""
+        log = list(self.log)
+        return log[-lines:] if lines else log
+
+    async def _readlines(self, reader: asyncio.StreamReader):
+        """Iterar líneas de un pipe tolerando líneas más largas que el buffer"""
+        while True:
+            try:
+                line = await reader.readuntil(b"\n")
+            except asyncio.IncompleteReadError as e:
+                # EOF: el proceso terminó
+                if e.partial:
+                    yield e.partial.decode(errors="replace").rstrip()
+                return
+            except asyncio.LimitOverrunError as e:
+                line = await reader.read(max(e.consumed, READ_CHUNK))
+            yield line.decode(errors="replace").rstrip()
+
+    async def _read_log(self, reader: asyncio.StreamReader):
+        try:
+            async for line in self._readlines(reader):
+                if line:
+                    self.log.append(line)
+                    if self.on_log_line is not None:
+                        self.on_log_line(line)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error leyendo stderr del stream {self.stream_id}: {e}")
+
+    async def _read_progress(self, reader: asyncio.StreamReader):
+        block: Dict[str, str] = {}
+        try:
+            async for line in self._readlines(reader):
+                key, sep, value = line.partition("=")
+                if not sep:
+                    continue
+                block[key.strip()] = value.strip()
+                if key.strip() == "progress":
+                    self._update_metrics(block)
+                    block = {}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error leyendo progreso del stream {self.stream_id}: {e}")
+
+    def _update_metrics(self, block: Dict[str, str]):
+        """Actualizar métricas a partir de un bloque de `-progress`"""
+        self.metrics.update({
+            "fps": _to_float(block.get("fps")),
+            "bitrate_kbps": _to_float(block.get("bitrate", "").replace("kbits/s", "")),
+            "speed": _to_float(block.get("speed", "").rstrip("x")),
+            "frames": _to_int(block.get("frame")),
+            "dropped_frames": _to_int(block.get("drop_frames")),
+            "duplicated_frames": _to_int(block.get("dup_frames")),
+            "total_size": _to_int(block.get("total_size")),
+            "out_time_s": _us_to_seconds(block.get("out_time_us") or block.get("out_time_ms")),
+            "updated_at": datetime.utcnow().isoformat()
+        })
+
+def _to_float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _to_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _us_to_seconds(value: Optional[str]) -> Optional[float]:
+    # FFmpeg expresa out_time_ms también en microsegundos
+    microseconds = _to_int(value)
+    return round(microseconds / 1_000_000, 3) if microseconds is not None else None
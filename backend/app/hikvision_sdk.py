@@ -1,14 +1,48 @@
 import os
+import time
 import ctypes
-from ctypes import cdll, c_int, c_char_p, Structure, byref, create_string_buffer, c_void_p, c_uint32, c_uint16, c_byte, c_bool
-from typing import Dict, List, Optional, Any
+from ctypes import c_int, c_char_p, Structure, byref, create_string_buffer, c_void_p, c_uint32, c_uint16, c_byte, c_bool
+from typing import Dict, Iterator, List, Optional, Any
 import logging
+from datetime import datetime
+from itertools import islice
+from .sdk_runtime import SDKRuntime
+from .sdk_executor import SDK_CONNECT_TIMEOUT_MS, SDK_CONNECT_TRIES
 
 logger = logging.getLogger(__name__)
 
 # Ruta dinámica — el binario lo coloca el integrador
 HCNETSDK_PATH = os.getenv("HIK_SDK_PATH", "./sdk/hikvision/HCNetSDK.dll")
 
+# NET_DVR_RemoteControl: comprobar si la sesión del usuario sigue activa
+NET_DVR_CHECK_USER_STATUS = 20005
+
+# Códigos de NET_DVR_GetLastError que invalidan la sesión (hay que volver a hacer login)
+#   7 NETWORK_FAIL_CONNECT, 8 NETWORK_SEND_ERROR, 9 NETWORK_RECV_ERROR,
+#   10 NETWORK_RECV_TIMEOUT, 11 NETWORK_ERRORDATA, 47 USERNOTEXIST
+SESSION_ERROR_CODES = {7, 8, 9, 10, 11, 47}
+
+# Estados de NET_DVR_FindNextFile_V30
+NET_DVR_FILE_SUCCESS = 1000
+NET_DVR_FILE_NOFIND = 1001
+NET_DVR_ISFINDING = 1002
+NET_DVR_NOMOREFILE = 1003
+NET_DVR_FILE_EXCEPTION = 1004
+# Espera máxima del NVR por el siguiente archivo (estado ISFINDING)
+FIND_NEXT_TIMEOUT = 10
+FIND_POLL_INTERVAL = 0.05
+
+# Tipos de archivo (dwFileType en la búsqueda, byFileType en el resultado)
+FILE_TYPE_ALL = 0xff
+FILE_TYPES = {0: "normal", 1: "motion", 2: "alarm"}
+SEARCH_FILE_TYPES = {"normal": 0, "motion": 1, "alarm": 2}
+
+class HikvisionError(Exception):
+    """Error del SDK de Hikvision con el código de NET_DVR_GetLastError"""
+    def __init__(self, message: str, error_code: int):
+        super().__init__(message)
+        self.error_code = error_code
+
 # Estructuras del SDK de Hikvision v6.1.9.48
 class NET_DVR_DEVICEINFO_V30(Structure):
     _fields_ = [
@@ -56,6 +90,39 @@ class NET_DVR_USER_LOGIN_INFO(Structure):
         ("byRes2", c_byte * 2),
     ]
 
+class NET_DVR_TIME(Structure):
+    _fields_ = [
+        ("dwYear", c_uint32),
+        ("dwMonth", c_uint32),
+        ("dwDay", c_uint32),
+        ("dwHour", c_uint32),
+        ("dwMinute", c_uint32),
+        ("dwSecond", c_uint32),
+    ]
+
+class NET_DVR_FILECOND(Structure):
+    _fields_ = [
+        ("lChannel", c_int),
+        ("dwFileType", c_uint32),
+        ("dwIsLocked", c_uint32),
+        ("dwUseCardNo", c_uint32),
+        ("sCardNumber", ctypes.c_byte * 32),
+        ("struStartTime", NET_DVR_TIME),
+        ("struStopTime", NET_DVR_TIME),
+    ]
+
+class NET_DVR_FINDDATA_V30(Structure):
+    _fields_ = [
+        ("sFileName", ctypes.c_char * 100),
+        ("struStartTime", NET_DVR_TIME),
+        ("struStopTime", NET_DVR_TIME),
+        ("dwFileSize", c_uint32),
+        ("sCardNum", ctypes.c_char * 32),
+        ("byLocked", c_byte),
+        ("byFileType", c_byte),
+        ("byRes", c_byte * 2),
+    ]
+
 class NET_DVR_LOGIN_V30(Structure):
     _fields_ = [
         ("pLoginInfo", ctypes.POINTER(NET_DVR_USER_LOGIN_INFO)),
@@ -63,73 +130,95 @@ class NET_DVR_LOGIN_V30(Structure):
     ]
 
 class HikvisionSDK:
+    """
+    Handle ligero sobre el runtime de HCNetSDK del proceso
+    
+    La librería se carga e inicializa una sola vez (HIKVISION_RUNTIME); cada
+    instancia solo toma una referencia que suelta en `close`.
+    """
     def __init__(self):
         if not os.path.exists(HCNETSDK_PATH):
             raise FileNotFoundError(f"HCNetSDK no encontrado en {HCNETSDK_PATH}")
         
         try:
-            self.lib = cdll.LoadLibrary(HCNETSDK_PATH)
-            self._setup_function_signatures()
-            # Inicializar SDK
-            result = self.lib.NET_DVR_Init()
-            if result != 1:
-                logger.warning("Error al inicializar HCNetSDK")
+            self.lib = HIKVISION_RUNTIME.acquire()
         except Exception as e:
             logger.error(f"Error cargando HCNetSDK: {e}")
             raise
 
-    def _setup_function_signatures(self):
+    def close(self):
+        """Soltar la referencia al runtime del SDK"""
+        if getattr(self, "lib", None) is not None:
+            self.lib = None
+            HIKVISION_RUNTIME.release()
+
+    @staticmethod
+    def _setup_function_signatures(lib):
         """Configurar las firmas de las funciones del SDK"""
         try:
             # NET_DVR_Init
-            self.lib.NET_DVR_Init.restype = c_bool
+            lib.NET_DVR_Init.restype = c_bool
             
             # NET_DVR_Login_V30
-            self.lib.NET_DVR_Login_V30.argtypes = [
+            lib.NET_DVR_Login_V30.argtypes = [
                 ctypes.POINTER(NET_DVR_USER_LOGIN_INFO),
                 ctypes.POINTER(NET_DVR_DEVICEINFO_V30)
             ]
-            self.lib.NET_DVR_Login_V30.restype = c_int
+            lib.NET_DVR_Login_V30.restype = c_int
             
             # NET_DVR_Logout
-            self.lib.NET_DVR_Logout.argtypes = [c_int]
-            self.lib.NET_DVR_Logout.restype = c_bool
+            lib.NET_DVR_Logout.argtypes = [c_int]
+            lib.NET_DVR_Logout.restype = c_bool
             
             # NET_DVR_Cleanup
-            self.lib.NET_DVR_Cleanup.restype = c_bool
+            lib.NET_DVR_Cleanup.restype = c_bool
             
             # NET_DVR_GetLastError
-            self.lib.NET_DVR_GetLastError.restype = c_int
+            lib.NET_DVR_GetLastError.restype = c_int
             
             # NET_DVR_FindFile_V30 (para búsqueda de grabaciones)
-            self.lib.NET_DVR_FindFile_V30.argtypes = [
+            lib.NET_DVR_FindFile_V30.argtypes = [
                 c_int,  # lUserID
-                ctypes.POINTER(ctypes.c_byte),  # lpFindFileData
-                ctypes.POINTER(ctypes.c_byte),  # lpSearchCond
+                ctypes.POINTER(NET_DVR_FILECOND),  # pFindCond
             ]
-            self.lib.NET_DVR_FindFile_V30.restype = c_int
+            lib.NET_DVR_FindFile_V30.restype = c_int
             
-            # NET_DVR_FindNextFile_V30
-            self.lib.NET_DVR_FindNextFile_V30.argtypes = [
+            # NET_DVR_FindNextFile_V30 (devuelve un estado NET_DVR_FILE_*)
+            lib.NET_DVR_FindNextFile_V30.argtypes = [
                 c_int,  # lFindHandle
-                ctypes.POINTER(ctypes.c_byte),  # lpFindFileData
+                ctypes.POINTER(NET_DVR_FINDDATA_V30),  # lpFindData
             ]
-            self.lib.NET_DVR_FindNextFile_V30.restype = c_bool
+            lib.NET_DVR_FindNextFile_V30.restype = c_int
             
             # NET_DVR_FindClose_V30
-            self.lib.NET_DVR_FindClose_V30.argtypes = [c_int]
-            self.lib.NET_DVR_FindClose_V30.restype = c_bool
+            lib.NET_DVR_FindClose_V30.argtypes = [c_int]
+            lib.NET_DVR_FindClose_V30.restype = c_bool
             
             # NET_DVR_PTZControl_Other
-            self.lib.NET_DVR_PTZControl_Other.argtypes = [
+            lib.NET_DVR_PTZControl_Other.argtypes = [
                 c_int,  # lUserID
                 c_int,  # lChannel
                 c_int,  # dwCommand
                 c_int,  # dwSpeed
                 c_int,  # dwStop
             ]
-            self.lib.NET_DVR_PTZControl_Other.restype = c_bool
+            lib.NET_DVR_PTZControl_Other.restype = c_bool
             
+            # NET_DVR_SetConnectTime / NET_DVR_SetReconnect
+            lib.NET_DVR_SetConnectTime.argtypes = [c_uint32, c_uint32]
+            lib.NET_DVR_SetConnectTime.restype = c_bool
+            lib.NET_DVR_SetReconnect.argtypes = [c_uint32, c_bool]
+            lib.NET_DVR_SetReconnect.restype = c_bool
+            
+            # NET_DVR_RemoteControl (comprobación de estado de la sesión)
+            lib.NET_DVR_RemoteControl.argtypes = [
+                c_int,  # lUserID
+                c_uint32,  # dwCommand
+                c_void_p,  # lpInBuffer
+                c_uint32,  # dwInBufferSize
+            ]
+            lib.NET_DVR_RemoteControl.restype = c_bool
+        
         except Exception as e:
             logger.warning(f"Error configurando firmas de funciones: {e}")
 
@@ -142,7 +231,7 @@ class HikvisionSDK:
             port: Puerto del dispositivo
             username: Nombre de usuario
             password: Contraseña
-            
+        
         Returns:
             Dict con información de la sesión
         """
@@ -178,7 +267,7 @@ class HikvisionSDK:
             
             if user_id == -1:
                 error_code = self.lib.NET_DVR_GetLastError()
-                raise Exception(f"Error de login Hikvision: {error_code}")
+                raise HikvisionError(f"Error de login Hikvision: {error_code}", error_code)
             
             # Extraer información del dispositivo
             serial_number = ''.join([chr(device_info.sSerialNumber[i]) for i in range(48) if device_info.sSerialNumber[i] != 0])
@@ -197,7 +286,7 @@ class HikvisionSDK:
                     "ip_channels": device_info.byIPChanNum
                 }
             }
-            
+        
         except Exception as e:
             logger.error(f"Error en login Hikvision: {e}")
             raise
@@ -211,7 +300,77 @@ class HikvisionSDK:
             logger.error(f"Error en logout Hikvision: {e}")
             return False
 
-    def find_recordings(self, user_id: int, channel: int, start_time: str, end_time: str) -> List[Dict[str, Any]]:
+    def check_session(self, user_id: int) -> bool:
+        """Comprobar que la sesión sigue viva en el dispositivo"""
+        try:
+            return bool(self.lib.NET_DVR_RemoteControl(user_id, NET_DVR_CHECK_USER_STATUS, None, 0))
+        except Exception as e:
+            logger.error(f"Error comprobando sesión Hikvision: {e}")
+            return False
+
+    def last_error(self) -> int:
+        """Último código de error del SDK"""
+        return self.lib.NET_DVR_GetLastError()
+
+    def iter_recordings(self, user_id: int, channel: int, start_time: str, end_time: str,
+                        file_type: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Recorrer las grabaciones del dispositivo a medida que el NVR las devuelve
+        
+        Generador sobre NET_DVR_FindFile_V30/NET_DVR_FindNextFile_V30: no guarda
+        los resultados en memoria y el handle de búsqueda se cierra al agotarse
+        o al cerrar el generador.
+        
+        Args:
+            user_id: ID de usuario de la sesión
+            channel: Canal a consultar
+            start_time: Fecha/hora de inicio (formato: "2023-01-01 00:00:00")
+            end_time: Fecha/hora de fin
+            file_type: Tipo de grabación (normal, motion, alarm) o None para todas
+        """
+        cond = NET_DVR_FILECOND()
+        cond.lChannel = channel
+        cond.dwFileType = SEARCH_FILE_TYPES.get(file_type, FILE_TYPE_ALL)
+        # Archivos bloqueados y normales
+        cond.dwIsLocked = 0xff
+        cond.struStartTime = _to_dvr_time(start_time)
+        cond.struStopTime = _to_dvr_time(end_time)
+        
+        find_handle = self.lib.NET_DVR_FindFile_V30(user_id, byref(cond))
+        if find_handle < 0:
+            error_code = self.lib.NET_DVR_GetLastError()
+            raise HikvisionError(f"Error iniciando búsqueda Hikvision: {error_code}", error_code)
+        
+        try:
+            data = NET_DVR_FINDDATA_V30()
+            deadline = time.monotonic() + FIND_NEXT_TIMEOUT
+            while True:
+                result = self.lib.NET_DVR_FindNextFile_V30(find_handle, byref(data))
+                if result == NET_DVR_ISFINDING:
+                    if time.monotonic() > deadline:
+                        raise HikvisionError("Timeout esperando resultados de búsqueda Hikvision", 10)
+                    time.sleep(FIND_POLL_INTERVAL)
+                    continue
+                if result in (NET_DVR_FILE_NOFIND, NET_DVR_NOMOREFILE):
+                    return
+                if result != NET_DVR_FILE_SUCCESS:
+                    error_code = self.lib.NET_DVR_GetLastError()
+                    raise HikvisionError(f"Error en búsqueda Hikvision ({result}): {error_code}", error_code)
+                
+                deadline = time.monotonic() + FIND_NEXT_TIMEOUT
+                yield {
+                    "start": _format_dvr_time(data.struStartTime),
+                    "end": _format_dvr_time(data.struStopTime),
+                    "type": FILE_TYPES.get(data.byFileType, "other"),
+                    "file_path": data.sFileName.decode("utf-8", "replace"),
+                    "size": data.dwFileSize,
+                    "channel": channel
+                }
+        finally:
+            self.lib.NET_DVR_FindClose_V30(find_handle)
+
+    def find_recordings(self, user_id: int, channel: int, start_time: str, end_time: str,
+                        file_type: Optional[str] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
         """
         Buscar grabaciones en el dispositivo
         
@@ -220,33 +379,20 @@ class HikvisionSDK:
             channel: Canal a consultar
             start_time: Fecha/hora de inicio (formato: "2023-01-01 00:00:00")
             end_time: Fecha/hora de fin
-            
+            file_type: Tipo de grabación o None para todas
+            limit: Máximo de grabaciones a devolver
+        
         Returns:
             Lista de grabaciones encontradas
         """
         try:
-            # En una implementación real, aquí se usarían:
-            # NET_DVR_FindFile_V30 y NET_DVR_FindNextFile_V30
-            
-            # Por ahora, devolvemos datos de ejemplo
-            recordings = [
-                {
-                    "start": start_time,
-                    "end": end_time,
-                    "type": "normal",
-                    "file_path": f"/recordings/ch{channel:02d}_{start_time.replace(' ', '_')}.mp4",
-                    "size": 1024000,
-                    "channel": channel
-                }
-            ]
-            
-            return recordings
-            
+            return list(islice(self.iter_recordings(user_id, channel, start_time, end_time, file_type), limit))
         except Exception as e:
             logger.error(f"Error buscando grabaciones Hikvision: {e}")
-            return []
+            raise
 
-    def get_rtsp_url(self, ip: str, port: int, username: str, password: str, channel: int, sub_stream: int = 0) -> str:
+    @staticmethod
+    def get_rtsp_url(ip: str, port: int, username: str, password: str, channel: int, sub_stream: int = 0) -> str:
         """
         Generar URL RTSP para streaming
         
@@ -257,7 +403,7 @@ class HikvisionSDK:
             password: Contraseña
             channel: Canal (1-based)
             sub_stream: Sub-stream (0=main, 1=sub)
-            
+        
         Returns:
             URL RTSP completa
         """
@@ -266,10 +412,35 @@ class HikvisionSDK:
             stream_type = "01"  # Main stream
         else:
             stream_type = "02"  # Sub stream
-            
+        
         rtsp_url = f"rtsp://{username}:{password}@{ip}:{port}/Streaming/Channels/{channel:02d}{stream_type}"
         return rtsp_url
 
+    @staticmethod
+    def get_playback_url(ip: str, port: int, username: str, password: str, channel: int,
+                         start_time: datetime, end_time: datetime, sub_stream: int = 0) -> str:
+        """
+        Generar URL RTSP de reproducción de grabaciones Hikvision
+        
+        Args:
+            ip: IP del dispositivo
+            port: Puerto del dispositivo
+            username: Usuario
+            password: Contraseña
+            channel: Canal (1-based)
+            start_time: Inicio del tramo (hora del NVR)
+            end_time: Fin del tramo (hora del NVR)
+            sub_stream: Sub-stream (0=main, 1=sub)
+        
+        Returns:
+            URL RTSP de reproducción
+        """
+        stream_type = "01" if sub_stream == 0 else "02"
+        # Hora local del NVR; el sufijo Z es parte del formato aunque no se aplica UTC
+        start = start_time.strftime("%Y%m%dT%H%M%SZ")
+        end = end_time.strftime("%Y%m%dT%H%M%SZ")
+        return f"rtsp://{username}:{password}@{ip}:{port}/Streaming/tracks/{channel}{stream_type}?starttime={start}&endtime={end}"
+
     def control_ptz(self, user_id: int, channel: int, command: str, speed: int = 4) -> bool:
         """
         Control PTZ básico
@@ -279,7 +450,7 @@ class HikvisionSDK:
             channel: Canal
             command: Comando PTZ (up, down, left, right, zoom_in, zoom_out, stop)
             speed: Velocidad (1-7)
-            
+        
         Returns:
             True si el comando se ejecutó correctamente
         """
@@ -288,15 +459,36 @@ class HikvisionSDK:
             # Por ahora, simulamos éxito
             logger.info(f"Comando PTZ: {command} en canal {channel} con velocidad {speed}")
             return True
-            
+        
         except Exception as e:
             logger.error(f"Error en control PTZ Hikvision: {e}")
             return False
 
     def __del__(self):
-        """Cleanup al destruir la instancia"""
+        """Soltar la referencia al destruir la instancia (la limpieza global es del runtime)"""
         try:
-            if hasattr(self, 'lib'):
-                self.lib.NET_DVR_Cleanup()
+            self.close()
         except:
             pass
+
+def _to_dvr_time(value: str) -> NET_DVR_TIME:
+    moment = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    return NET_DVR_TIME(moment.year, moment.month, moment.day, moment.hour, moment.minute, moment.second)
+
+def _format_dvr_time(value: NET_DVR_TIME) -> str:
+    return (f"{value.dwYear:04d}-{value.dwMonth:02d}-{value.dwDay:02d} "
+            f"{value.dwHour:02d}:{value.dwMinute:02d}:{value.dwSecond:02d}")
+
+def _init_runtime(lib):
+    if lib.NET_DVR_Init() != 1:
+        logger.warning("Error al inicializar HCNetSDK")
+    # Acotar el timeout TCP: una cámara inaccesible no debe bloquear un hilo durante minutos
+    lib.NET_DVR_SetConnectTime(SDK_CONNECT_TIMEOUT_MS, SDK_CONNECT_TRIES)
+    lib.NET_DVR_SetReconnect(10000, True)
+
+HIKVISION_RUNTIME = SDKRuntime(
+    "Hikvision", HCNETSDK_PATH,
+    setup=HikvisionSDK._setup_function_signatures,
+    init=_init_runtime,
+    cleanup=lambda lib: lib.NET_DVR_Cleanup()
+)
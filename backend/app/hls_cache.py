@@ -0,0 +1,322 @@
+import asyncio
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+# Memoria máxima de la caché HLS de este worker (playlists y segmentos de todos los streams)
+HLS_CACHE_MAX_BYTES = int(os.getenv("HLS_CACHE_MAX_BYTES", str(512 * 1024 ** 2)))
+# Segmentos que siguen en memoria tras salir de la playlist (players que van por detrás)
+HLS_CACHE_EXTRA_SEGMENTS = int(os.getenv("HLS_CACHE_EXTRA_SEGMENTS", "2"))
+# Streams sin peticiones durante este tiempo se descartan (p.ej. streams de otro worker)
+HLS_CACHE_IDLE = 60
+# Intervalo de comprobación de la playlist en recargas bloqueantes de streams de otro worker
+HLS_POLL_INTERVAL = 0.2
+
+# Nombres válidos dentro del directorio de un stream (sin rutas)
+_NAME_RE = re.compile(r"^[\w-][\w.-]*$")
+_MAP_RE = re.compile(r'#EXT-X-MAP:.*URI="(?P<uri>[^"]+)"')
+
+MEDIA_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+    ".m4s": "video/iso.segment",
+    ".mp4": "video/mp4"
+}
+DEFAULT_MEDIA_TYPE = "application/octet-stream"
+
+@dataclass
+class CachedFile:
+    data: bytes
+    etag: str
+
+@dataclass
+class Playlist:
+    data: bytes
+    etag: str
+    # Identifica la versión en disco: (inode, mtime_ns, tamaño); FFmpeg la reescribe con rename
+    version: Tuple[int, int, int]
+    media_sequence: int = 0
+    target_duration: float = 0
+    segments: List[str] = field(default_factory=list)
+    init: Optional[str] = None
+
+    @property
+    def last_msn(self) -> int:
+        """Media sequence number del último segmento publicado"""
+        return self.media_sequence + len(self.segments) - 1
+
+@dataclass
+class StreamCache:
+    playlists: Dict[str, Playlist] = field(default_factory=dict)
+    # Segmentos (y init.mp4) en orden de llegada
+    files: "OrderedDict[str, CachedFile]" = field(default_factory=OrderedDict)
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+    last_used: float = field(default_factory=time.monotonic)
+
+@dataclass
+class DiskScan:
+    """Lo leído del disco al recargar un stream, fuera del event loop"""
+    exists: bool = False
+    # Playlists con una versión nueva en disco y segmentos recién publicados en ellas
+    playlists: Dict[str, Playlist] = field(default_factory=dict)
+    files: Dict[str, CachedFile] = field(default_factory=dict)
+    reads: int = 0
+
+class HLSCache:
+    """
+    Caché en memoria de las playlists y los últimos segmentos de los streams en vivo
+    
+    Cada segmento se lee del disco una sola vez (al publicarse en la playlist)
+    y todos los viewers se sirven desde memoria. La playlist se valida con un
+    `stat` en cada petición; cuando FFmpeg publica una nueva versión, los
+    segmentos que salen de ella se descartan (salvo HLS_CACHE_EXTRA_SEGMENTS)
+    y se despiertan las recargas bloqueantes (`_HLS_msn`).
+    
+    El `stat` y las lecturas se hacen en un hilo (`asyncio.to_thread`) sobre
+    una copia de las versiones conocidas; el estado de la caché solo se
+    modifica en el event loop, así que no necesita locks.
+    
+    En el worker dueño del FFmpeg, StreamManager llama a `on_segment` al
+    detectar cada segmento nuevo; en el resto de workers la caché se llena
+    bajo demanda con la misma validación.
+    """
+    def __init__(self, root: Path, max_bytes: int = HLS_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._streams: Dict[str, StreamCache] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_reads = 0
+        self.blocking_requests = 0
+        self.blocking_timeouts = 0
+        # Precargas en curso lanzadas por on_segment: stream_id -> tarea
+        self._preloads: Dict[str, asyncio.Task] = {}
+
+    async def refresh(self, stream_id: str, name: Optional[str] = None) -> Optional[StreamCache]:
+        """
+        Recargar las playlists del stream que hayan cambiado en disco
+        
+        Con `name` se incluye esa playlist aunque aún no se haya pedido nunca.
+        Devuelve None si el stream no tiene directorio.
+        """
+        cache = self._streams.get(stream_id)
+        known = {playlist_name: playlist.version for playlist_name, playlist in cache.playlists.items()} if cache else {}
+        known.setdefault(name or "stream.m3u8", None)
+        cached = set(cache.files) if cache else set()
+        scan = await asyncio.to_thread(self._scan, self.root / stream_id, known, cached)
+        return self._apply(stream_id, scan)
+
+    def on_segment(self, stream_id: str):
+        """FFmpeg publicó un segmento: precargarlo si el stream tiene viewers recientes"""
+        if stream_id in self._streams and stream_id not in self._preloads:
+            task = asyncio.get_running_loop().create_task(self.refresh(stream_id))
+            self._preloads[stream_id] = task
+            task.add_done_callback(lambda _: self._preloads.pop(stream_id, None))
+
+    async def get_playlist(self, stream_id: str, name: str) -> Optional[Playlist]:
+        cache = await self.refresh(stream_id, name)
+        if cache is None:
+            return None
+        cache.last_used = time.monotonic()
+        return cache.playlists.get(name)
+
+    async def wait_for_msn(self, stream_id: str, name: str, msn: int, timeout: float) -> Optional[Playlist]:
+        """Esperar a que la playlist incluya el segmento `msn`; None si vence el plazo"""
+        self.blocking_requests += 1
+        deadline = time.monotonic() + timeout
+        while True:
+            playlist = await self.get_playlist(stream_id, name)
+            if playlist is not None and playlist.last_msn >= msn:
+                return playlist
+            remaining = deadline - time.monotonic()
+            cache = self._streams.get(stream_id)
+            if remaining <= 0 or cache is None:
+                self.blocking_timeouts += 1
+                return None
+            try:
+                # El worker dueño avisa al instante; los demás comprueban el disco periódicamente
+                await asyncio.wait_for(cache.changed.wait(), min(HLS_POLL_INTERVAL, remaining))
+            except asyncio.TimeoutError:
+                pass
+
+    async def get_file(self, stream_id: str, name: str) -> Optional[CachedFile]:
+        """Segmento o init.mp4 desde memoria; si no está se lee una vez del disco"""
+        cache = self._streams.get(stream_id)
+        if cache is not None:
+            cache.last_used = time.monotonic()
+            cached = cache.files.get(name)
+            if cached is not None:
+                self.hits += 1
+                return cached
+        
+        self.misses += 1
+        cached = await asyncio.to_thread(_read, self.root / stream_id / name)
+        if cached is None:
+            return None
+        self.disk_reads += 1
+        # El stream pudo descartarse (drop) mientras se leía
+        cache = self._streams.get(stream_id)
+        if cache is None:
+            cache = self._streams[stream_id] = StreamCache()
+        self._store(cache, name, cached)
+        self._enforce_budget()
+        return cached
+
+    def drop(self, stream_id: str):
+        """Liberar la memoria de un stream detenido"""
+        cache = self._streams.pop(stream_id, None)
+        if cache is not None:
+            self.bytes -= sum(len(cached.data) for cached in cache.files.values())
+            cache.changed.set()
+
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "streams": len(self._streams),
+            "segments": sum(len(cache.files) for cache in self._streams.values()),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            "disk_reads": self.disk_reads,
+            "blocking_requests": self.blocking_requests,
+            "blocking_timeouts": self.blocking_timeouts
+        }
+
+    @staticmethod
+    def _scan(stream_dir: Path, known: Dict[str, Optional[Tuple[int, int, int]]], cached: Set[str]) -> DiskScan:
+        """
+        Leer del disco las playlists que cambiaron y sus segmentos nuevos
+        
+        Se ejecuta en un hilo: solo usa las copias `known` (versión de cada
+        playlist en la caché) y `cached` (archivos ya en memoria).
+        """
+        scan = DiskScan()
+        for playlist_name, known_version in known.items():
+            try:
+                stat = (stream_dir / playlist_name).stat()
+            except FileNotFoundError:
+                continue
+            scan.exists = True
+            version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if version == known_version:
+                continue
+            playlist = _load_playlist(stream_dir / playlist_name, version)
+            if playlist is not None:
+                scan.playlists[playlist_name] = playlist
+                scan.reads += 1
+        if not scan.exists:
+            scan.exists = stream_dir.is_dir()
+        
+        for playlist in scan.playlists.values():
+            for name in playlist.segments + ([playlist.init] if playlist.init else []):
+                if name in cached or name in scan.files:
+                    continue
+                cached_file = _read(stream_dir / name)
+                if cached_file is not None:
+                    scan.files[name] = cached_file
+                    scan.reads += 1
+        return scan
+
+    def _apply(self, stream_id: str, scan: DiskScan) -> Optional[StreamCache]:
+        """Incorporar a la caché lo leído por `_scan` (en el event loop)"""
+        self.disk_reads += scan.reads
+        cache = self._streams.get(stream_id)
+        if cache is None:
+            if not scan.exists:
+                return None
+            cache = self._streams[stream_id] = StreamCache()
+        
+        changed = False
+        for playlist_name, playlist in scan.playlists.items():
+            current = cache.playlists.get(playlist_name)
+            # Otra petición concurrente ya cargó esta versión
+            if current is not None and current.version == playlist.version:
+                continue
+            cache.playlists[playlist_name] = playlist
+            changed = True
+        if changed:
+            self._rollover(cache, scan.files)
+            # Despertar a las recargas bloqueantes y preparar el siguiente aviso
+            cache.changed.set()
+            cache.changed = asyncio.Event()
+        return cache
+
+    def _rollover(self, cache: StreamCache, files: Dict[str, CachedFile]):
+        """Guardar los segmentos recién publicados y descartar los que salieron de la playlist"""
+        listed = set()
+        for playlist in cache.playlists.values():
+            listed.update(playlist.segments)
+            if playlist.init:
+                listed.add(playlist.init)
+        
+        for name in sorted(listed - set(cache.files)):
+            if name in files:
+                self._store(cache, name, files[name])
+        
+        unlisted = [name for name in cache.files if name not in listed]
+        for name in unlisted[:max(0, len(unlisted) - HLS_CACHE_EXTRA_SEGMENTS)]:
+            self.bytes -= len(cache.files.pop(name).data)
+        self._enforce_budget()
+
+    def _store(self, cache: StreamCache, name: str, cached: CachedFile):
+        previous = cache.files.pop(name, None)
+        if previous is not None:
+            self.bytes -= len(previous.data)
+        cache.files[name] = cached
+        self.bytes += len(cached.data)
+
+    def _enforce_budget(self):
+        """Descartar streams inactivos y, si no basta, los segmentos más antiguos de los streams menos usados"""
+        now = time.monotonic()
+        for stream_id in [s for s, cache in self._streams.items() if now - cache.last_used > HLS_CACHE_IDLE]:
+            self.drop(stream_id)
+        if self.bytes <= self.max_bytes:
+            return
+        for cache in sorted(self._streams.values(), key=lambda cache: cache.last_used):
+            while cache.files and self.bytes > self.max_bytes:
+                _, cached = cache.files.popitem(last=False)
+                self.bytes -= len(cached.data)
+            if self.bytes <= self.max_bytes:
+                return
+
+def _load_playlist(path: Path, version: Tuple[int, int, int]) -> Optional[Playlist]:
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    playlist = Playlist(data=data, etag=f'"{version[0]:x}-{version[1]:x}-{version[2]:x}"', version=version)
+    for line in data.decode(errors="replace").splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            playlist.media_sequence = int(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-TARGETDURATION:"):
+            playlist.target_duration = float(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-MAP:"):
+            match = _MAP_RE.search(line)
+            if match:
+                playlist.init = os.path.basename(match.group("uri"))
+        elif line and not line.startswith("#"):
+            playlist.segments.append(os.path.basename(line.split("?", 1)[0]))
+    return playlist
+
+def _read(path: Path) -> Optional[CachedFile]:
+    try:
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    return CachedFile(data=data, etag=f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"')
+
+def valid_name(name: str) -> bool:
+    return bool(_NAME_RE.match(name)) and ".." not in name
+
+def media_type(name: str) -> str:
+    return MEDIA_TYPES.get(os.path.splitext(name)[1], DEFAULT_MEDIA_TYPE)
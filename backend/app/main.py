@@ -1,16 +1,46 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.security import HTTPBearer
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import os
-from .database import Base, engine
-from .routes import devices, recordings, streams
+from .migrations import run_migrations
+from .routes import devices, recordings, streams, hls
 from .auth import create_access_token, authenticate_user, verify_token
 from .schemas import UserLogin, Token
-from .stream_manager import StreamManager
+from .stream_manager import StreamManager, get_stream_manager
+from .sdk_sessions import SDKSessionPool
+from .sdk_runtime import shutdown_runtimes
+from .sdk_executor import shutdown_executors
+from .recording_indexer import RecordingIndexer
+from .recording_partitions import RecordingPartitionManager
+from .recording_exports import RecordingExportManager
 
-# Crear tablas de la base de datos
-Base.metadata.create_all(bind=engine)
+# Crear tablas de la base de datos y aplicar migraciones pendientes
+run_migrations()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Crear el gestor de streams, el pool de sesiones SDK y los servicios de grabaciones de la aplicación"""
+    app.state.stream_manager = StreamManager()
+    app.state.sdk_sessions = SDKSessionPool()
+    app.state.recording_indexer = RecordingIndexer(app.state.sdk_sessions)
+    app.state.recording_partitions = RecordingPartitionManager()
+    app.state.recording_exports = RecordingExportManager()
+    await app.state.stream_manager.start()
+    await app.state.sdk_sessions.start()
+    await app.state.recording_partitions.start()
+    await app.state.recording_indexer.start()
+    await app.state.recording_exports.start()
+    yield
+    await app.state.recording_exports.shutdown()
+    await app.state.recording_indexer.shutdown()
+    await app.state.recording_partitions.shutdown()
+    await app.state.stream_manager.shutdown()
+    await app.state.sdk_sessions.shutdown()
+    shutdown_executors()
+    # Limpieza global de los SDK de fabricante (tras cerrar las sesiones)
+    shutdown_runtimes()
 
 # Inicializar aplicación FastAPI
 app = FastAPI(
@@ -18,7 +48,8 @@ app = FastAPI(
     description="Sistema de Gestión de Video (VMS) para cámaras Hikvision y Dahua",
     version="1.0.0",
     docs_url="/api/docs",
-    redoc_url="/api/redoc"
+    redoc_url="/api/redoc",
+    lifespan=lifespan
 )
 
 # Configurar CORS
@@ -30,14 +61,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Playlists y segmentos en vivo desde la caché en memoria (antes del montaje estático)
+app.include_router(hls.router)
+
 # Montar directorio estático para archivos HLS
 hls_root = os.getenv("HLS_ROOT", "/var/www/hls")
 if os.path.exists(hls_root):
     app.mount("/hls", StaticFiles(directory=hls_root), name="hls")
 
-# Inicializar gestor de streams
-stream_manager = StreamManager()
-
 # Rutas de autenticación
 @app.post("/api/auth/login", response_model=Token)
 async def login(user_credentials: UserLogin):
@@ -65,23 +96,25 @@ app.include_router(streams.router, prefix="/api")
 
 # Rutas de salud del sistema
 @app.get("/api/health")
-async def health_check():
+def health_check(stream_manager: StreamManager = Depends(get_stream_manager)):
     """Verificar estado del sistema"""
     try:
         # Verificar conexión a base de datos
+        from sqlalchemy import text
         from .database import SessionLocal
         db = SessionLocal()
-        db.execute("SELECT 1")
+        db.execute(text("SELECT 1"))
         db.close()
         
-        # Obtener estadísticas de streams
-        stream_stats = stream_manager.get_stream_stats()
+        # Obtener estadísticas de streams (contadores en memoria, sin recorrer el disco)
+        stream_stats = stream_manager.get_stream_stats(include_streams=False)
         
         return {
             "status": "healthy",
             "database": "connected",
             "streams": {
                 "active": stream_stats["active_streams"],
+                "local": stream_stats["local_streams"],
                 "total_segments": stream_stats["total_segments"]
             },
             "version": "1.0.0"
@@ -93,7 +126,10 @@ async def health_check():
         )
 
 @app.get("/api/stats/overview")
-async def get_system_overview(current_user: str = Depends(verify_token)):
+def get_system_overview(
+    current_user: str = Depends(verify_token),
+    stream_manager: StreamManager = Depends(get_stream_manager)
+):
     """Obtener resumen general del sistema"""
     try:
         from .database import SessionLocal
@@ -108,7 +144,7 @@ async def get_system_overview(current_user: str = Depends(verify_token)):
         dahua_devices = db.query(models.Device).filter(models.Device.brand == "dahua").count()
         
         # Estadísticas de streams
-        stream_stats = stream_manager.get_stream_stats()
+        stream_stats = stream_manager.get_stream_stats(include_streams=False)
         
         # Estadísticas de grabaciones (últimas 24 horas)
         from datetime import datetime, timedelta
@@ -141,7 +177,7 @@ async def get_system_overview(current_user: str = Depends(verify_token)):
                 "status": "operational"
             }
         }
-        
+    
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -0,0 +1,151 @@
+import logging
+from datetime import datetime
+from sqlalchemy import func, inspect, select, text, update
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+from .database import Base, engine as default_engine
+from . import models
+from .recording_partitions import (
+    create_partitioned_table, ensure_partitions, is_partitioned, partitioning_enabled, TABLE
+)
+from .recording_timeline import rebuild_rollups
+
+logger = logging.getLogger(__name__)
+
+# Índice GiST por rango de tiempo para las consultas de solapamiento (solo Postgres)
+RECORDINGS_RANGE_INDEX = "ix_recordings_device_channel_range"
+# Índice único parcial de streams activos por canal (ver models.py)
+STREAMS_ACTIVE_INDEX = "uq_streams_active_key"
+
+def run_migrations(engine: Engine = default_engine):
+    """
+    Llevar el esquema de la base de datos al de los modelos (idempotente)
+    
+    `create_all` solo crea las tablas que faltan: las columnas e índices
+    añadidos a tablas existentes (p.ej. streams.owner/profile o el índice
+    único de recordings) se aplican aquí. Se ejecuta al arrancar y desde
+    `make migrate`.
+    """
+    if partitioning_enabled(engine):
+        with engine.begin() as conn:
+            _partition_recordings(conn)
+    
+    with engine.connect() as conn:
+        rollups_missing = not inspect(conn).has_table(models.RecordingRollup.__tablename__)
+    
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        _add_missing_columns(conn)
+        _stop_orphaned_streams(conn)
+        _sync_indexes(conn)
+    
+    if engine.dialect.name == "postgresql":
+        _create_range_index(engine)
+    
+    if rollups_missing:
+        # Primera vez con rollups de línea de tiempo: calcularlos para las grabaciones ya indexadas
+        with Session(bind=engine) as db:
+            channels = rebuild_rollups(db)
+        logger.info(f"Migración: rollups de línea de tiempo calculados para {channels} canales")
+
+def _partition_recordings(conn: Connection):
+    """Crear `recordings` particionada o convertir la tabla existente (una sola vez)"""
+    partitioned = is_partitioned(conn)
+    if partitioned:
+        return
+    if partitioned is None:
+        create_partitioned_table(conn)
+        logger.info(f"Migración: tabla {TABLE} creada con particionado por start_time")
+        return
+
+    # Tabla sin particionar de una versión anterior: copiar sus filas a la particionada.
+    # Los índices de la tabla antigua desaparecen con ella y se recrean después en la nueva.
+    legacy = f"{TABLE}_unpartitioned"
+    conn.execute(text(f"ALTER TABLE {TABLE} RENAME TO {legacy}"))
+    conn.execute(text(f"ALTER TABLE {legacy} RENAME CONSTRAINT {TABLE}_pkey TO {legacy}_pkey"))
+    create_partitioned_table(conn)
+    first, last = conn.execute(text(f"SELECT min(start_time), max(start_time) FROM {legacy}")).one()
+    if first is not None:
+        ensure_partitions(conn, first, last)
+    columns = ", ".join(column.name for column in models.Recording.__table__.columns)
+    copied = conn.execute(text(f"INSERT INTO {TABLE} ({columns}) SELECT {columns} FROM {legacy}")).rowcount
+    conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{TABLE}', 'id'), (SELECT coalesce(max(id), 0) + 1 FROM {TABLE}), false)"))
+    conn.execute(text(f"DROP TABLE {legacy}"))
+    logger.info(f"Migración: tabla {TABLE} particionada ({copied} filas copiadas)")
+
+def _add_missing_columns(conn: Connection):
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            # Las filas existentes toman el valor por defecto del modelo
+            if column.default is not None and column.default.is_scalar:
+                conn.execute(text(f"UPDATE {table.name} SET {column.name} = :value"),
+                             {"value": column.default.arg})
+            logger.info(f"Migración: columna {table.name}.{column.name} añadida")
+
+def _stop_orphaned_streams(conn: Connection):
+    """
+    Marcar detenidas las filas de `streams` activas que ningún worker sirve
+    
+    Las versiones sin `owner` no desactivaban los streams expirados, caídos o
+    detenidos en bloque: puede haber varias filas activas del mismo canal y
+    ninguna tiene un FFmpeg detrás. Con duplicados el índice único de streams
+    activos no se puede crear y la aplicación no arrancaría.
+    """
+    streams = models.Stream.__table__
+    now = datetime.utcnow()
+    stopped = conn.execute(
+        update(streams)
+        .where(streams.c.is_active == True, streams.c.owner == None)
+        .values(is_active=False, viewers=0, stopped_at=now)
+    ).rowcount
+    if stopped:
+        logger.info(f"Migración: {stopped} streams activos sin owner marcados como detenidos")
+    
+    if STREAMS_ACTIVE_INDEX in {index["name"] for index in inspect(conn).get_indexes(streams.name)}:
+        return
+    # Sin el índice también puede haber duplicados con owner: se conserva la fila más reciente de cada canal
+    latest = (
+        select(func.max(streams.c.id))
+        .where(streams.c.is_active == True)
+        .group_by(streams.c.device_id, streams.c.channel, streams.c.sub_stream, streams.c.profile)
+    )
+    deduped = conn.execute(
+        update(streams)
+        .where(streams.c.is_active == True, streams.c.id.not_in(latest))
+        .values(is_active=False, viewers=0, stopped_at=now)
+    ).rowcount
+    if deduped:
+        logger.info(f"Migración: {deduped} streams activos duplicados marcados como detenidos")
+
+def _sync_indexes(conn: Connection):
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"]: index["column_names"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            columns = [column.name for column in index.columns]
+            if index.name in existing and existing[index.name] != columns:
+                # Índice con el mismo nombre y otras columnas (p.ej. sin `profile`): recrearlo
+                index.drop(bind=conn)
+                logger.info(f"Migración: índice {index.name} recreado")
+                del existing[index.name]
+            if index.name not in existing:
+                index.create(bind=conn, checkfirst=True)
+
+def _create_range_index(engine: Engine):
+    # btree_gist permite combinar device_id/channel (igualdad) con el rango en un solo índice GiST
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gist"))
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS {RECORDINGS_RANGE_INDEX} ON {models.Recording.__tablename__} "
+                "USING gist (device_id, channel, tsrange(start_time, end_time, '[)'))"
+            ))
+    except Exception as e:
+        # Sin el índice las consultas siguen siendo correctas, pero más lentas
+        logger.warning(f"No se pudo crear el índice GiST de grabaciones: {e}")
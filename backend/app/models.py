@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, JSON, TIMESTAMP, Text
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, Float, JSON, TIMESTAMP, Text, Index, Date, LargeBinary
 from .database import Base
 import datetime
 
@@ -31,6 +31,45 @@ class Stream(Base):
     is_active = Column(Boolean, default=True)
     started_at = Column(TIMESTAMP, default=datetime.datetime.utcnow)
     stopped_at = Column(TIMESTAMP)
+    # Propiedad del proceso FFmpeg entre workers: "host:pid" del worker y PID de FFmpeg
+    owner = Column(String(255))
+    pid = Column(Integer)
+    viewers = Column(Integer, default=1)
+    heartbeat_at = Column(TIMESTAMP, default=datetime.datetime.utcnow)
+    # Perfil de salida HLS: ts (MPEG-TS) o ll (fMP4 baja latencia)
+    profile = Column(String(20), default="ts")
+    # Retención (DVR): los segmentos se copian a almacenamiento persistente
+    retain = Column(Boolean, default=False)
+    # Ventana de time-shift (segundos) de los segmentos retenidos
+    dvr_window = Column(Integer)
+    # Fin del stream: el plazo más lejano pedido por sus viewers
+    expires_at = Column(TIMESTAMP)
+    # Vídeo medido por el worker dueño (resolución, fps, bitrate) para la master playlist ABR
+    media_info = Column(JSON)
+
+# Un único stream activo por (device_id, channel, sub_stream, profile) entre todos los workers
+Index(
+    "uq_streams_active_key",
+    Stream.device_id, Stream.channel, Stream.sub_stream, Stream.profile,
+    unique=True,
+    postgresql_where=Stream.is_active == True,
+    sqlite_where=Stream.is_active == True
+)
+
+class StreamLease(Base):
+    """
+    Lease de un viewer sobre un stream compartido
+    
+    /streams/start entrega el lease_id y /streams/stop lo libera: un reintento
+    o una doble liberación del mismo viewer encuentra el lease ya liberado y
+    no resta otro viewer de `streams.viewers`.
+    """
+    __tablename__ = "stream_leases"
+    
+    lease_id = Column(String(64), primary_key=True)
+    stream_id = Column(String(255), nullable=False, index=True)
+    created_at = Column(TIMESTAMP, default=datetime.datetime.utcnow)
+    released_at = Column(TIMESTAMP)
 
 class Recording(Base):
     __tablename__ = "recordings"
@@ -45,3 +84,75 @@ class Recording(Base):
     recording_type = Column(String(50), default="normal")  # normal, alarm, motion
     meta = Column(JSON, default={})
     created_at = Column(TIMESTAMP, default=datetime.datetime.utcnow)
+
+# Índice local de grabaciones: una fila por archivo del NVR
+Index(
+    "uq_recordings_device_channel_start",
+    Recording.device_id, Recording.channel, Recording.start_time,
+    unique=True
+)
+
+class RecordingSync(Base):
+    """Marca de agua de la sincronización del índice de grabaciones por (device_id, channel)"""
+    __tablename__ = "recording_sync"
+    
+    device_id = Column(Integer, primary_key=True)
+    channel = Column(Integer, primary_key=True)
+    # Todo lo grabado antes de esta hora (del NVR) ya está en el índice
+    synced_until = Column(TIMESTAMP)
+    last_run_at = Column(TIMESTAMP)
+    last_error = Column(Text)
+    # Un único worker sincroniza cada canal: "host:pid" y fin del lease
+    locked_by = Column(String(255))
+    locked_until = Column(TIMESTAMP)
+
+class RecordingRollup(Base):
+    """
+    Cobertura de grabación precalculada por (device_id, channel, día, tipo)
+    
+    `minutes` es un bitmap de 1440 bits (180 bytes), uno por minuto del día
+    (hora del NVR): el bit i, empezando por el más significativo del primer
+    byte, indica que hay grabación de ese tipo en el minuto i.
+    """
+    __tablename__ = "recording_rollups"
+    
+    device_id = Column(Integer, primary_key=True)
+    channel = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    recording_type = Column(String(50), primary_key=True)
+    minutes = Column(LargeBinary, nullable=False)
+    updated_at = Column(TIMESTAMP, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class RecordingExport(Base):
+    """
+    Exportación de un tramo de grabación a MP4
+    
+    El id es la clave del tramo y el perfil (ver recording_exports.export_key):
+    pedir dos veces el mismo tramo devuelve el mismo trabajo y el mismo archivo. La tabla es la cola
+    compartida entre workers; el worker que ejecuta un trabajo renueva su lease.
+    """
+    __tablename__ = "recording_exports"
+    
+    id = Column(String(64), primary_key=True)
+    device_id = Column(Integer, nullable=False)
+    channel = Column(Integer, nullable=False)
+    start_time = Column(TIMESTAMP, nullable=False)
+    end_time = Column(TIMESTAMP, nullable=False)
+    profile = Column(String(20), default="main")  # main, sub (ver EXPORT_PROFILES)
+    status = Column(String(20), default="queued")  # queued, running, done, failed, evicted
+    progress = Column(Float, default=0)
+    file_size = Column(BigInteger)
+    error = Column(Text)
+    requested_by = Column(String(255))
+    # Caché de exportaciones: LRU por último acceso; las fijadas (evidencias) no se expulsan
+    hits = Column(Integer, default=0)
+    last_accessed_at = Column(TIMESTAMP)
+    pinned = Column(Boolean, default=False)
+    pin_reason = Column(Text)
+    locked_by = Column(String(255))
+    locked_until = Column(TIMESTAMP)
+    created_at = Column(TIMESTAMP, default=datetime.datetime.utcnow)
+    started_at = Column(TIMESTAMP)
+    finished_at = Column(TIMESTAMP)
+
+Index("ix_recording_exports_status", RecordingExport.status, RecordingExport.created_at)
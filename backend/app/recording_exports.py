@@ -0,0 +1,509 @@
+import asyncio
+import hashlib
+import os
+import socket
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from fastapi import HTTPException, Request, status
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from .database import SessionLocal
+from . import crud, models
+from .ffmpeg_drain import FFmpegDrain
+from .hikvision_sdk import HikvisionSDK
+from .dahua_sdk import DahuaSDK
+from .stream_manager import FFMPEG_PATH, STOP_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Directorio gestionado donde se guardan los MP4 exportados
+EXPORT_ROOT = os.getenv("EXPORT_ROOT", "/var/cache/vms/exports")
+# Exportaciones simultáneas por worker y por NVR (entre todos los workers)
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "4"))
+EXPORT_MAX_PER_DEVICE = int(os.getenv("EXPORT_MAX_PER_DEVICE", "2"))
+# Duración máxima de un tramo exportado (segundos)
+EXPORT_MAX_DURATION = int(os.getenv("EXPORT_MAX_DURATION", "7200"))
+# Sin avance de FFmpeg durante este tiempo la exportación se da por fallida
+EXPORT_STALL_TIMEOUT = int(os.getenv("EXPORT_STALL_TIMEOUT", "60"))
+# Prefijo de la location `internal` de nginx que sirve EXPORT_ROOT (X-Accel-Redirect)
+EXPORT_ACCEL_PREFIX = os.getenv("EXPORT_ACCEL_PREFIX", "/protected-exports/")
+# Revisión de la cola (además de los avisos al encolar)
+EXPORT_POLL_INTERVAL = 5
+# Actualización del progreso y renovación del lease
+EXPORT_PROGRESS_INTERVAL = 5
+# Lease de una exportación en curso; otro worker la retoma si vence
+EXPORT_LEASE = 60
+# Presupuesto de disco de la caché de exportaciones (las fijadas cuentan pero no se expulsan)
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_BYTES", str(50 * 1024 ** 3)))
+# Bloques de lectura al servir rangos sin nginx
+RANGE_CHUNK = 256 * 1024
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Perfiles de exportación: forman parte de la clave de la caché
+EXPORT_PROFILES = {
+    "main": {"sub_stream": 0},
+    "sub": {"sub_stream": 1}
+}
+DEFAULT_EXPORT_PROFILE = "main"
+
+# Generadores de URL RTSP de reproducción por marca (métodos estáticos: no cargan el SDK)
+PLAYBACK_URL_BUILDERS = {
+    "hikvision": HikvisionSDK.get_playback_url,
+    "dahua": DahuaSDK.get_playback_url
+}
+
+def export_key(device_id: int, channel: int, start_time: datetime, end_time: datetime,
+               profile: str = DEFAULT_EXPORT_PROFILE) -> str:
+    """Clave de caché direccionada por contenido: mismo tramo y perfil, mismo trabajo y mismo archivo"""
+    raw = f"{device_id}:{channel}:{start_time:{TIME_FORMAT}}:{end_time:{TIME_FORMAT}}:{profile}"
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+def build_playback_url(device: models.Device, channel: int, start_time: datetime,
+                       end_time: datetime, profile: str = DEFAULT_EXPORT_PROFILE) -> Optional[str]:
+    """URL RTSP de reproducción de un tramo, o None si la marca no está soportada"""
+    builder = PLAYBACK_URL_BUILDERS.get(device.brand)
+    if builder is None:
+        return None
+    return builder(device.ip, device.port, device.username, device.password, channel, start_time, end_time,
+                   EXPORT_PROFILES[profile]["sub_stream"])
+
+class RecordingExportManager:
+    """
+    Exportación de tramos de grabación a MP4 en segundo plano
+    
+    Cada tramo se reproduce desde el NVR por RTSP y FFmpeg lo remuxa sin
+    recodificar el vídeo (`-c:v copy`) a un MP4 con `+faststart` en
+    EXPORT_ROOT. Los trabajos viven en la tabla `recording_exports`, que hace
+    de cola compartida: cualquier worker puede ejecutarlos, un lease evita que
+    dos lo hagan a la vez y el límite por NVR se aplica entre todos. Las
+    peticiones de la API solo encolan y consultan: ningún worker de la API
+    queda bloqueado durante la exportación.
+    
+    EXPORT_ROOT es además una caché direccionada por contenido: el archivo se
+    nombra con la clave (dispositivo, canal, inicio, fin, perfil), así que una
+    exportación repetida se sirve desde disco sin tocar el NVR. Cuando los
+    archivos superan EXPORT_CACHE_MAX_BYTES se expulsan los usados hace más
+    tiempo (LRU), salvo los fijados como evidencia.
+    """
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self.owner_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.export_root = Path(EXPORT_ROOT)
+        self.export_root.mkdir(parents=True, exist_ok=True)
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        # Exportaciones en curso en este worker: export_id -> tarea
+        self._running: Dict[str, asyncio.Task] = {}
+        self.completed = 0
+        self.failed = 0
+        self.bytes_exported = 0
+        # Métricas de la caché en este worker
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_evicted = 0
+
+    async def start(self):
+        """Iniciar el despachador de la cola de exportaciones"""
+        if self._task is None or self._task.done():
+            self._wakeup.set()
+            self._task = asyncio.create_task(self._run())
+            logger.info("Despachador de exportaciones iniciado")
+
+    async def shutdown(self):
+        """Detener el despachador; las exportaciones en curso vuelven a la cola"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def request_export(self, db, device: models.Device, channel: int, start_time: datetime,
+                       end_time: datetime, profile: str = DEFAULT_EXPORT_PROFILE,
+                       requested_by: Optional[str] = None) -> models.RecordingExport:
+        """
+        Encolar la exportación de un tramo o devolver la existente
+        
+        Un tramo ya exportado cuyo archivo sigue en disco es un acierto de
+        caché y se devuelve sin volver a pedir nada al NVR; uno fallido,
+        expulsado o cuyo archivo desapareció se vuelve a encolar.
+        """
+        export_id = export_key(device.id, channel, start_time, end_time, profile)
+        export = crud.get_export(db, export_id)
+        if export is None:
+            self.misses += 1
+            export = crud.create_export(db, {
+                "id": export_id,
+                "device_id": device.id,
+                "channel": channel,
+                "start_time": start_time,
+                "end_time": end_time,
+                "profile": profile,
+                "requested_by": requested_by,
+                "last_accessed_at": datetime.utcnow()
+            })
+        elif export.status == "done" and self.export_path(export_id).exists():
+            self.hits += 1
+            crud.touch_export(db, export_id)
+            db.refresh(export)
+        elif export.status in ("failed", "evicted", "done"):
+            self.misses += 1
+            crud.requeue_export(db, export_id, requested_by)
+            db.refresh(export)
+        
+        if export.status == "queued":
+            self._wakeup.set()
+        return export
+
+    def touch(self, db, export_id: str, byte_range: Optional[str] = None):
+        """
+        Una descarga del archivo también cuenta como uso reciente
+        
+        Solo refresca el último acceso (no es un acierto de caché) y solo al
+        empezar la descarga: sin Range o con un rango desde el byte 0, no en
+        cada trozo de una descarga reanudada o del seek del reproductor.
+        """
+        if byte_range and not _starts_at_zero(byte_range):
+            return
+        crud.touch_export(db, export_id, hit=False)
+
+    def set_pinned(self, db, export_id: str, pinned: bool, reason: Optional[str] = None) -> bool:
+        """Fijar (evidencia) o liberar una exportación; al liberarla puede expulsarse"""
+        updated = crud.set_export_pinned(db, export_id, pinned, reason) > 0
+        if updated and not pinned:
+            self._wakeup.set()
+        return updated
+
+    def evict(self) -> int:
+        """Expulsar las exportaciones usadas hace más tiempo hasta volver al presupuesto"""
+        evicted = 0
+        with self._db() as db:
+            used = crud.get_export_cache_usage(db)["bytes"]
+            while used > EXPORT_CACHE_MAX_BYTES:
+                candidates = crud.get_evictable_exports(db)
+                if not candidates:
+                    logger.warning(f"Caché de exportaciones por encima del presupuesto ({used} bytes) "
+                                   f"solo con exportaciones fijadas")
+                    break
+                for export in candidates:
+                    if used <= EXPORT_CACHE_MAX_BYTES:
+                        break
+                    size = export.file_size or 0
+                    # Primero la fila: si otra petición la fija o la reexporta, el archivo se conserva
+                    if crud.evict_export(db, export.id):
+                        self.export_path(export.id).unlink(missing_ok=True)
+                        evicted += 1
+                        self.bytes_evicted += size
+                    used -= size
+        if evicted:
+            self.evictions += evicted
+            logger.info(f"{evicted} exportaciones expulsadas de la caché")
+        return evicted
+
+    def export_path(self, export_id: str) -> Path:
+        return self.export_root / f"{export_id}.mp4"
+
+    def export_info(self, export: models.RecordingExport) -> Dict:
+        done = export.status == "done"
+        return {
+            "export_id": export.id,
+            "device_id": export.device_id,
+            "channel": export.channel,
+            "start_time": export.start_time.strftime(TIME_FORMAT),
+            "end_time": export.end_time.strftime(TIME_FORMAT),
+            "profile": export.profile or DEFAULT_EXPORT_PROFILE,
+            "status": export.status,
+            "progress": round(export.progress or 0, 3),
+            "file_size": export.file_size,
+            "error": export.error,
+            "pinned": bool(export.pinned),
+            "pin_reason": export.pin_reason,
+            "hits": export.hits or 0,
+            "created_at": export.created_at.isoformat() if export.created_at else None,
+            "finished_at": export.finished_at.isoformat() if export.finished_at else None,
+            "status_url": f"/api/recordings/exports/{export.id}",
+            "download_url": f"/api/recordings/exports/{export.id}/file" if done else None
+        }
+
+    def get_stats(self) -> Dict:
+        with self._db() as db:
+            by_status = crud.count_exports_by_status(db)
+            usage = crud.get_export_cache_usage(db)
+        lookups = self.hits + self.misses
+        return {
+            "running_local": len(self._running),
+            "queued": by_status.get("queued", 0),
+            "running": by_status.get("running", 0),
+            "done": by_status.get("done", 0),
+            "failed": by_status.get("failed", 0),
+            "evicted": by_status.get("evicted", 0),
+            "completed": self.completed,
+            "errors": self.failed,
+            "bytes_exported": self.bytes_exported,
+            "concurrency": EXPORT_CONCURRENCY,
+            "max_per_device": EXPORT_MAX_PER_DEVICE,
+            "cache": {
+                "max_bytes": EXPORT_CACHE_MAX_BYTES,
+                "used_bytes": usage["bytes"],
+                "entries": usage["entries"],
+                "pinned_entries": usage["pinned_entries"],
+                "pinned_bytes": usage["pinned_bytes"],
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "bytes_evicted": self.bytes_evicted
+            }
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), EXPORT_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            
+            self._wakeup.clear()
+            try:
+                self.evict()
+                self._dispatch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error en el despachador de exportaciones: {e}")
+
+    def _dispatch(self):
+        """Reservar trabajos de la cola mientras haya hueco en este worker"""
+        with self._db() as db:
+            requeued = crud.requeue_stale_exports(db)
+            if requeued:
+                logger.warning(f"{requeued} exportaciones retomadas tras vencer su lease")
+            while len(self._running) < EXPORT_CONCURRENCY:
+                export = crud.claim_export(db, self.owner_id, self._lease_until(), EXPORT_MAX_PER_DEVICE)
+                if export is None:
+                    return
+                task = asyncio.create_task(self._export(export.id))
+                self._running[export.id] = task
+                task.add_done_callback(lambda _, export_id=export.id: self._finished(export_id))
+
+    def _finished(self, export_id: str):
+        self._running.pop(export_id, None)
+        # Hay hueco: revisar la cola sin esperar al siguiente ciclo
+        self._wakeup.set()
+
+    async def _export(self, export_id: str):
+        with self._db() as db:
+            export = crud.get_export(db, export_id)
+            device = crud.get_device(db, export.device_id)
+        
+        # Nombre temporal único: el MP4 solo aparece completo (rename atómico)
+        final_path = self.export_path(export_id)
+        part_path = self.export_root / f"{export_id}.{uuid.uuid4().hex[:8]}.part"
+        proc = None
+        drain = FFmpegDrain(f"export-{export_id}")
+        try:
+            if device is None:
+                raise RuntimeError("Dispositivo no encontrado")
+            rtsp_url = build_playback_url(device, export.channel, export.start_time, export.end_time,
+                                          export.profile or DEFAULT_EXPORT_PROFILE)
+            if rtsp_url is None:
+                raise RuntimeError("Marca de dispositivo no soportada")
+            
+            duration = int((export.end_time - export.start_time).total_seconds())
+            cmd = self._build_command(rtsp_url, duration, part_path)
+            logger.info(f"Exportando {export_id}: {device.ip} canal {export.channel} "
+                        f"{export.start_time:{TIME_FORMAT}} - {export.end_time:{TIME_FORMAT}}")
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=str(self.export_root)
+            )
+            drain.attach(proc)
+            await self._wait(export_id, proc, drain, duration)
+            
+            if proc.returncode != 0 or not part_path.exists() or part_path.stat().st_size == 0:
+                tail = " | ".join(drain.tail(3))
+                raise RuntimeError(f"FFmpeg terminó con código {proc.returncode}: {tail}")
+            
+            os.replace(part_path, final_path)
+            size = final_path.stat().st_size
+            with self._db() as db:
+                crud.update_export(db, export_id, self.owner_id, status="done", progress=1, file_size=size,
+                                   error=None, locked_by=None, locked_until=None, finished_at=datetime.utcnow())
+            self.completed += 1
+            self.bytes_exported += size
+            logger.info(f"Exportación {export_id} completada ({size} bytes)")
+        
+        except asyncio.CancelledError:
+            # Apagado del worker: otro worker la retoma desde la cola
+            with self._db() as db:
+                crud.update_export(db, export_id, self.owner_id, status="queued", progress=0,
+                                   locked_by=None, locked_until=None)
+            raise
+        except Exception as e:
+            self.failed += 1
+            error = str(e) or type(e).__name__
+            logger.warning(f"Error en la exportación {export_id}: {error}")
+            with self._db() as db:
+                crud.update_export(db, export_id, self.owner_id, status="failed", error=error,
+                                   locked_by=None, locked_until=None, finished_at=datetime.utcnow())
+        finally:
+            if proc is not None and proc.returncode is None:
+                await _terminate(proc)
+            drain.close()
+            part_path.unlink(missing_ok=True)
+
+    async def _wait(self, export_id: str, proc: asyncio.subprocess.Process, drain: FFmpegDrain, duration: int):
+        """Esperar a FFmpeg actualizando el progreso; abortar si deja de avanzar"""
+        last_out_time, last_progress_at = None, time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(proc.wait(), EXPORT_PROGRESS_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            
+            out_time = drain.metrics["out_time_s"]
+            if out_time != last_out_time:
+                last_out_time, last_progress_at = out_time, time.monotonic()
+            elif time.monotonic() - last_progress_at > EXPORT_STALL_TIMEOUT:
+                raise RuntimeError(f"El NVR no envió vídeo en {EXPORT_STALL_TIMEOUT}s")
+            
+            progress = min((out_time or 0) / duration, 0.99) if duration else 0
+            with self._db() as db:
+                if not crud.update_export(db, export_id, self.owner_id, progress=progress,
+                                          locked_until=self._lease_until()):
+                    # Lease perdido: otro worker la ha retomado
+                    raise RuntimeError("Exportación retomada por otro worker")
+
+    def _build_command(self, rtsp_url: str, duration: int, output: Path) -> List[str]:
+        return [
+            FFMPEG_PATH,
+            "-rtsp_transport", "tcp",
+            "-i", rtsp_url,
+            "-map", "0:v:0",
+            "-map", "0:a:0?",
+            "-c:v", "copy",                # Copiar video sin re-encoding
+            "-c:a", "aac",                 # G.711/ADPCM del NVR no caben en MP4
+            "-t", str(duration),
+            "-movflags", "+faststart",     # moov al principio: reproducible mientras se descarga
+            "-f", "mp4",
+            "-nostats",
+            "-progress", "pipe:1",
+            "-y",
+            str(output)
+        ]
+
+    def _lease_until(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=EXPORT_LEASE)
+
+    @contextmanager
+    def _db(self):
+        db = self.session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+async def _terminate(proc: asyncio.subprocess.Process):
+    try:
+        proc.terminate()
+        await asyncio.wait_for(proc.wait(), STOP_TIMEOUT)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+def file_response(request: Request, path: Path, filename: str) -> Response:
+    """
+    Servir un archivo exportado con soporte de Range
+    
+    Detrás de nginx (cabecera X-Sendfile-Type: X-Accel-Redirect) la respuesta
+    solo lleva X-Accel-Redirect y nginx envía el archivo con sendfile, sin
+    copiarlo por el worker. Sin nginx se atienden aquí las peticiones Range
+    de un único rango (reanudar descargas, seek del reproductor).
+    """
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{filename}"'
+    }
+    if request.headers.get("x-sendfile-type", "").lower() == "x-accel-redirect":
+        return Response(headers={**headers, "X-Accel-Redirect": f"{EXPORT_ACCEL_PREFIX}{path.name}"},
+                        media_type="video/mp4")
+    
+    size = path.stat().st_size
+    byte_range = request.headers.get("range")
+    if not byte_range:
+        return FileResponse(path, media_type="video/mp4", headers=headers)
+    
+    bounds = _parse_range(byte_range, size)
+    if bounds is None:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Rango no válido",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    start, end = bounds
+    return StreamingResponse(
+        _read_range(path, start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type="video/mp4",
+        headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)}
+    )
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Rango [inicio, fin] (inclusivo) de una cabecera `bytes=a-b`, `bytes=a-` o `bytes=-n`"""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    try:
+        if not sep:
+            return None
+        if not first:
+            # Sufijo: los últimos n bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end
+
+def _starts_at_zero(header: str) -> bool:
+    """Si una cabecera Range pide el archivo desde el principio (`bytes=0-` o `bytes=0-n`)"""
+    unit, _, spec = header.partition("=")
+    first, sep, _ = spec.strip().partition("-")
+    return unit.strip() == "bytes" and "," not in spec and bool(sep) and first.strip() == "0"
+
+def _read_range(path: Path, start: int, end: int) -> Iterator[bytes]:
+    # Generador síncrono: Starlette lo itera en el threadpool
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(RANGE_CHUNK, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def get_recording_exports(request: Request) -> RecordingExportManager:
+    """Dependencia de FastAPI: exportaciones de grabaciones de la aplicación"""
+    return request.app.state.recording_exports
@@ -0,0 +1,240 @@
+import asyncio
+import os
+import socket
+import time
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+from fastapi import Request
+from .database import SessionLocal
+from . import crud, models
+from .sdk_sessions import SDKSessionPool
+from .recording_search import PAGE_SIZE
+from .recording_partitions import ensure_partitions_for, retention_cutoff
+from .recording_timeline import recording_days, refresh_rollups
+
+logger = logging.getLogger(__name__)
+
+# Sincronización periódica del índice local de grabaciones
+INDEX_ENABLED = os.getenv("RECORDING_INDEX_ENABLED", "1") == "1"
+INDEX_INTERVAL = int(os.getenv("RECORDING_INDEX_INTERVAL", "300"))
+# Historial que se indexa la primera vez que se sincroniza un canal
+INDEX_BACKFILL_DAYS = int(os.getenv("RECORDING_INDEX_BACKFILL_DAYS", "30"))
+# Se vuelve a consultar este margen antes de la marca de agua: archivos que seguían grabándose
+INDEX_OVERLAP = int(os.getenv("RECORDING_INDEX_OVERLAP", "600"))
+# Dispositivos sincronizados a la vez (los canales de un dispositivo van en serie)
+INDEX_CONCURRENCY = int(os.getenv("RECORDING_INDEX_CONCURRENCY", "4"))
+# Cada búsqueda en el NVR cubre como mucho esta ventana
+INDEX_WINDOW = timedelta(days=1)
+# Lease de un canal entre workers; se renueva con cada ventana sincronizada
+INDEX_LEASE = 600
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+class RecordingIndexer:
+    """
+    Sincroniza en segundo plano las listas de archivos de los NVR con la tabla `recordings`
+    
+    Cada (device_id, channel) tiene una marca de agua en `recording_sync`: solo
+    se busca en el NVR desde ahí (menos INDEX_OVERLAP) hasta ahora, por
+    ventanas de un día, y la marca avanza tras cada ventana. Las grabaciones se
+    insertan con upsert por (device_id, channel, start_time), así que repetir
+    una ventana no duplica filas. Varios workers pueden ejecutar el indexador:
+    un lease en `recording_sync` asegura que cada canal lo sincroniza uno solo.
+    
+    Las horas son las del NVR (se asume el mismo huso horario que el servidor).
+    """
+    def __init__(self, sdk_sessions: SDKSessionPool, session_factory=SessionLocal):
+        self.sdk_sessions = sdk_sessions
+        self.session_factory = session_factory
+        self.owner_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        # Dispositivos con sincronización pedida desde la API
+        self._requested: Set[int] = set()
+        self.runs = 0
+        self.files_indexed = 0
+        self.errors = 0
+        self.last_run_at: Optional[datetime] = None
+        self.last_run_seconds: Optional[float] = None
+
+    async def start(self):
+        """Iniciar la sincronización periódica"""
+        if not INDEX_ENABLED:
+            logger.info("Indexador de grabaciones deshabilitado")
+            return
+        if self._task is None or self._task.done():
+            # Primera sincronización al arrancar
+            self._wakeup.set()
+            self._task = asyncio.create_task(self._run())
+            logger.info("Indexador de grabaciones iniciado")
+
+    async def shutdown(self):
+        """Detener la sincronización (la marca de agua conserva el avance)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def request_sync(self, device_id: Optional[int] = None):
+        """Adelantar la sincronización de un dispositivo (o de todos)"""
+        if device_id is not None:
+            self._requested.add(device_id)
+        self._wakeup.set()
+
+    async def sync_devices(self, device_ids: Optional[Iterable[int]] = None):
+        """Sincronizar los dispositivos activos indicados (todos si None)"""
+        with self._db() as db:
+            if device_ids is None:
+                devices = db.query(models.Device).filter(models.Device.is_active == True).all()
+            else:
+                devices = crud.get_devices_by_ids(db, list(device_ids))
+        devices = [d for d in devices if self.sdk_sessions.supports(d.brand)]
+        
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(INDEX_CONCURRENCY)
+        
+        async def sync_device(device):
+            async with semaphore:
+                for channel in range(1, (device.channels or 0) + 1):
+                    await self.sync_channel(device, channel)
+        
+        await asyncio.gather(*(sync_device(device) for device in devices))
+        self.runs += 1
+        self.last_run_at = datetime.utcnow()
+        self.last_run_seconds = round(time.monotonic() - started, 3)
+
+    async def sync_channel(self, device, channel: int) -> int:
+        """Traer del NVR los archivos nuevos de un canal; devuelve cuántos se indexaron"""
+        now = datetime.now().replace(microsecond=0)
+        with self._db() as db:
+            state = crud.claim_recording_sync(db, device.id, channel, self.owner_id, self._lease_until())
+            if state is None:
+                # Otro worker está sincronizando este canal
+                return 0
+            synced_until = state.synced_until
+        
+        since = synced_until - timedelta(seconds=INDEX_OVERLAP) if synced_until else now - timedelta(days=INDEX_BACKFILL_DAYS)
+        indexed = 0
+        error = None
+        try:
+            while since < now:
+                until = min(since + INDEX_WINDOW, now)
+                indexed += await self._sync_window(device, channel, since, until)
+                with self._db() as db:
+                    crud.advance_recording_sync(db, device.id, channel, self.owner_id, until, self._lease_until())
+                since = until
+        except asyncio.CancelledError:
+            error = "Sincronización interrumpida"
+            raise
+        except Exception as e:
+            self.errors += 1
+            error = str(e) or type(e).__name__
+            logger.warning(f"Error indexando grabaciones de {device.ip} canal {channel}: {error}")
+        finally:
+            with self._db() as db:
+                crud.release_recording_sync(db, device.id, channel, self.owner_id, error)
+        
+        self.files_indexed += indexed
+        return indexed
+
+    async def _sync_window(self, device, channel: int, since: datetime, until: datetime) -> int:
+        start, end = since.strftime(TIME_FORMAT), until.strftime(TIME_FORMAT)
+        pages = self.sdk_sessions.aiter_pages(
+            device, lambda sdk, user_id: sdk.iter_recordings(user_id, channel, start, end), PAGE_SIZE
+        )
+        indexed = 0
+        # Días con archivos nuevos o modificados: sus rollups de línea de tiempo se recalculan
+        days = set()
+        # Lo que ya está fuera de la retención no se indexa (su partición puede no existir)
+        cutoff = retention_cutoff(device)
+        try:
+            async for page in pages:
+                rows = [_recording_row(device.id, channel, record) for record in page]
+                rows = _dedupe([row for row in rows if row["start_time"] >= cutoff])
+                with self._db() as db:
+                    ensure_partitions_for(db, [row["start_time"] for row in rows])
+                    indexed += crud.upsert_recordings(db, rows)
+                for row in rows:
+                    days.update(recording_days(row["start_time"], row["end_time"]))
+        finally:
+            await pages.aclose()
+        
+        if days:
+            with self._db() as db:
+                refresh_rollups(db, device.id, channel, days)
+        return indexed
+
+    def get_stats(self) -> Dict:
+        return {
+            "enabled": INDEX_ENABLED,
+            "runs": self.runs,
+            "files_indexed": self.files_indexed,
+            "errors": self.errors,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+            "last_run_seconds": self.last_run_seconds
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), INDEX_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            
+            self._wakeup.clear()
+            requested, self._requested = self._requested, set()
+            try:
+                # Una petición de la API sincroniza solo sus dispositivos; el ciclo periódico, todos
+                await self.sync_devices(requested or None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error en el indexador de grabaciones: {e}")
+
+    def _lease_until(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=INDEX_LEASE)
+
+    @contextmanager
+    def _db(self):
+        db = self.session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+def index_covers(state: Optional[models.RecordingSync], start_time: datetime, end_time: datetime) -> bool:
+    """El índice tiene el rango pedido, salvo el retraso normal entre sincronizaciones"""
+    if state is None or state.synced_until is None:
+        return False
+    now = datetime.now()
+    if start_time < now - timedelta(days=INDEX_BACKFILL_DAYS):
+        return False
+    return state.synced_until >= min(end_time, now) - timedelta(seconds=2 * INDEX_INTERVAL)
+
+def _recording_row(device_id: int, channel: int, record: Dict) -> Dict:
+    return {
+        "device_id": device_id,
+        "channel": channel,
+        "start_time": datetime.strptime(record["start"], TIME_FORMAT),
+        "end_time": datetime.strptime(record["end"], TIME_FORMAT),
+        "file_path": record.get("file_path"),
+        "file_size": record.get("size"),
+        "recording_type": record.get("type", "normal"),
+        "meta": {}
+    }
+
+def _dedupe(rows: List[Dict]) -> List[Dict]:
+    # Un mismo INSERT ... ON CONFLICT no admite dos filas con la misma clave
+    unique = {}
+    for row in rows:
+        unique[row["start_time"]] = row
+    return list(unique.values())
+
+def get_recording_indexer(request: Request) -> RecordingIndexer:
+    """Dependencia de FastAPI: indexador de grabaciones de la aplicación"""
+    return request.app.state.recording_indexer
@@ -0,0 +1,288 @@
+import asyncio
+import os
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from fastapi import Request
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+from .database import SessionLocal, engine as default_engine
+from . import crud, models
+
+logger = logging.getLogger(__name__)
+
+# Particionado nativo de `recordings` por rango de start_time (solo Postgres)
+PARTITIONING = os.getenv("RECORDING_PARTITIONING", "1") == "1"
+# Tamaño de cada partición: month o day (no cambiar una vez creadas)
+PARTITION_INTERVAL = os.getenv("RECORDING_PARTITION_INTERVAL", "month")
+# Particiones futuras creadas por adelantado
+PARTITIONS_AHEAD = int(os.getenv("RECORDING_PARTITIONS_AHEAD", "3"))
+# Retención por defecto; cada dispositivo puede fijar la suya en meta["retention_days"]
+RETENTION_DAYS = int(os.getenv("RECORDING_RETENTION_DAYS", "90"))
+# Intervalo del mantenimiento (particiones futuras y retención)
+MAINTENANCE_INTERVAL = int(os.getenv("RECORDING_MAINTENANCE_INTERVAL", "3600"))
+# Lock de Postgres que serializa el DDL de particiones entre workers
+PARTITION_LOCK_KEY = 7311842
+
+TABLE = models.Recording.__tablename__
+PARTITION_PREFIX = f"{TABLE}_p"
+
+# Particiones que ya se sabe que existen (evita DDL repetido en cada inserción)
+_known_partitions: Set[str] = set()
+
+def partitioning_enabled(bind) -> bool:
+    return PARTITIONING and bind.dialect.name == "postgresql"
+
+def partition_bounds(moment: datetime) -> Tuple[datetime, datetime]:
+    """Rango [inicio, fin) de la partición que contiene `moment`"""
+    if PARTITION_INTERVAL == "day":
+        start = datetime(moment.year, moment.month, moment.day)
+        return start, start + timedelta(days=1)
+    start = datetime(moment.year, moment.month, 1)
+    end = datetime(start.year + 1, 1, 1) if start.month == 12 else datetime(start.year, start.month + 1, 1)
+    return start, end
+
+def partition_name(start: datetime) -> str:
+    if PARTITION_INTERVAL == "day":
+        return f"{PARTITION_PREFIX}{start:%Y_%m_%d}"
+    return f"{PARTITION_PREFIX}{start:%Y_%m}"
+
+def _partition_end(name: str) -> Optional[datetime]:
+    # El nombre codifica el inicio: recordings_p2024_01 o recordings_p2024_01_15
+    suffix = name[len(PARTITION_PREFIX):]
+    for fmt in ("%Y_%m_%d", "%Y_%m"):
+        try:
+            start = datetime.strptime(suffix, fmt)
+        except ValueError:
+            continue
+        if fmt == "%Y_%m_%d":
+            return start + timedelta(days=1)
+        return partition_bounds(start)[1]
+    return None
+
+def create_partitioned_table(conn: Connection):
+    """
+    Crear `recordings` como tabla particionada por rango de start_time
+    
+    La clave primaria incluye start_time (Postgres lo exige en tablas
+    particionadas); para el ORM `id` sigue siendo la clave.
+    """
+    columns = []
+    for column in models.Recording.__table__.columns:
+        if column.name == "id":
+            columns.append("id SERIAL NOT NULL")
+            continue
+        not_null = "" if column.nullable else " NOT NULL"
+        columns.append(f"{column.name} {column.type.compile(dialect=conn.dialect)}{not_null}")
+    columns.append("PRIMARY KEY (id, start_time)")
+    conn.execute(text(f"CREATE TABLE {TABLE} ({', '.join(columns)}) PARTITION BY RANGE (start_time)"))
+
+def is_partitioned(conn: Connection) -> Optional[bool]:
+    """True/False si la tabla existe particionada o no; None si no existe"""
+    relkind = conn.execute(
+        text("SELECT relkind FROM pg_class WHERE relname = :name AND relkind IN ('r', 'p')"),
+        {"name": TABLE}
+    ).scalar()
+    return None if relkind is None else relkind == "p"
+
+def ensure_partitions(conn: Connection, start: datetime, end: datetime) -> List[str]:
+    """Crear las particiones que falten para cubrir [start, end]; devuelve las creadas"""
+    periods = []
+    moment = start
+    while moment <= end:
+        period = partition_bounds(moment)
+        if partition_name(period[0]) not in _known_partitions:
+            periods.append(period)
+        moment = period[1]
+    if not periods:
+        return []
+    
+    conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": PARTITION_LOCK_KEY})
+    existing = set(list_partitions(conn))
+    created = []
+    for period_start, period_end in periods:
+        name = partition_name(period_start)
+        if name not in existing:
+            conn.execute(text(
+                f"CREATE TABLE {name} PARTITION OF {TABLE} "
+                f"FOR VALUES FROM ('{period_start:%Y-%m-%d %H:%M:%S}') TO ('{period_end:%Y-%m-%d %H:%M:%S}')"
+            ))
+            created.append(name)
+        _known_partitions.add(name)
+    if created:
+        logger.info(f"Particiones de grabaciones creadas: {', '.join(created)}")
+    return created
+
+def ensure_partitions_for(db, times: Iterable[datetime]):
+    """Asegurar la partición de cada start_time antes de insertar (no-op sin particionado)"""
+    bind = db.get_bind()
+    if not partitioning_enabled(bind):
+        return
+    starts = {partition_bounds(moment)[0] for moment in times}
+    missing = sorted(start for start in starts if partition_name(start) not in _known_partitions)
+    if not missing:
+        return
+    # En su propia transacción: el DDL no debe quedar atado a la sesión del llamante
+    with bind.begin() as conn:
+        for start in missing:
+            ensure_partitions(conn, start, start)
+
+def retention_days(device) -> int:
+    """Días de retención del dispositivo: meta["retention_days"] o RECORDING_RETENTION_DAYS"""
+    days = (device.meta or {}).get("retention_days")
+    try:
+        if days is not None and int(days) > 0:
+            return int(days)
+    except (TypeError, ValueError):
+        logger.warning(f"retention_days inválido en el dispositivo {device.id}: {days}")
+    return RETENTION_DAYS
+
+def retention_cutoff(device, now: Optional[datetime] = None) -> datetime:
+    return (now or datetime.now()) - timedelta(days=retention_days(device))
+
+def list_partitions(conn: Connection) -> List[str]:
+    rows = conn.execute(text("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = :name
+        ORDER BY child.relname
+    """), {"name": TABLE}).all()
+    return [row[0] for row in rows]
+
+class RecordingPartitionManager:
+    """
+    Mantenimiento del almacenamiento de grabaciones: particiones y retención
+    
+    En Postgres crea por adelantado las particiones futuras y elimina con
+    DROP TABLE las particiones enteras más antiguas que la retención más larga
+    de todos los dispositivos: sin DELETE fila a fila ni bloat. Los
+    dispositivos con una retención más corta (meta["retention_days"]) borran
+    sus filas por lotes, solo en particiones que acabarán eliminadas enteras.
+    En SQLite (tests locales) la retención es siempre por lotes de DELETE.
+    
+    Se ejecuta al arrancar y cada MAINTENANCE_INTERVAL segundos.
+    """
+    def __init__(self, engine: Engine = default_engine, session_factory=SessionLocal):
+        self.engine = engine
+        self.session_factory = session_factory
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.partitions_created = 0
+        self.partitions_dropped = 0
+        self.rows_deleted = 0
+        self.last_run_at: Optional[datetime] = None
+
+    async def start(self):
+        """Mantenimiento inicial y programado"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def maintain(self, now: Optional[datetime] = None):
+        """Crear particiones futuras y aplicar la retención"""
+        # Horas del NVR, igual que el indexador
+        now = now or datetime.now()
+        policies = self._retention_policies()
+        longest = max([RETENTION_DAYS, *policies.values()])
+        drop_before = now - timedelta(days=longest)
+        
+        if partitioning_enabled(self.engine):
+            with self.engine.begin() as conn:
+                ahead = now
+                for _ in range(PARTITIONS_AHEAD):
+                    ahead = partition_bounds(ahead)[1]
+                self.partitions_created += len(ensure_partitions(conn, now, ahead))
+                self.partitions_dropped += len(self._drop_partitions(conn, drop_before))
+        else:
+            drop_before = None
+        
+        # Retenciones por dispositivo más cortas que la de las particiones
+        with self._db() as db:
+            for device_id, days in policies.items():
+                cutoff = now - timedelta(days=days)
+                if drop_before is None or cutoff > drop_before:
+                    self.rows_deleted += crud.delete_recordings_before(db, cutoff, device_ids=[device_id])
+            default_cutoff = now - timedelta(days=RETENTION_DAYS)
+            if drop_before is None or default_cutoff > drop_before:
+                # Resto de dispositivos (y filas de dispositivos ya eliminados)
+                self.rows_deleted += crud.delete_recordings_before(db, default_cutoff, exclude_device_ids=list(policies))
+            
+            # Rollups de línea de tiempo: se borran los días completos fuera de la retención
+            for device_id, days in policies.items():
+                cutoff = now - timedelta(days=days)
+                crud.delete_recording_rollups_before(db, cutoff.date(), device_ids=[device_id])
+            crud.delete_recording_rollups_before(db, default_cutoff.date(), exclude_device_ids=list(policies))
+        
+        self.runs += 1
+        self.last_run_at = datetime.utcnow()
+
+    def get_stats(self) -> Dict:
+        stats = {
+            "partitioning": partitioning_enabled(self.engine),
+            "interval": PARTITION_INTERVAL,
+            "retention_days": RETENTION_DAYS,
+            "runs": self.runs,
+            "partitions_created": self.partitions_created,
+            "partitions_dropped": self.partitions_dropped,
+            "rows_deleted": self.rows_deleted,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None
+        }
+        if stats["partitioning"]:
+            with self.engine.connect() as conn:
+                stats["partitions"] = len(list_partitions(conn))
+        return stats
+
+    def _drop_partitions(self, conn: Connection, before: datetime) -> List[str]:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": PARTITION_LOCK_KEY})
+        dropped = []
+        for name in list_partitions(conn):
+            end = _partition_end(name)
+            if end is not None and end <= before:
+                conn.execute(text(f"DROP TABLE {name}"))
+                _known_partitions.discard(name)
+                dropped.append(name)
+        if dropped:
+            logger.info(f"Particiones de grabaciones eliminadas por retención: {', '.join(dropped)}")
+        return dropped
+
+    def _retention_policies(self) -> Dict[int, int]:
+        """device_id -> días de retención de los dispositivos con política propia"""
+        with self._db() as db:
+            devices = db.query(models.Device).all()
+        return {
+            device.id: retention_days(device)
+            for device in devices
+            if (device.meta or {}).get("retention_days") is not None
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.maintain)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error en el mantenimiento de grabaciones: {e}")
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+    @contextmanager
+    def _db(self):
+        db = self.session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+def get_recording_partitions(request: Request) -> RecordingPartitionManager:
+    """Dependencia de FastAPI: mantenimiento de grabaciones de la aplicación"""
+    return request.app.state.recording_partitions
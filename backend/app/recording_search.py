@@ -0,0 +1,121 @@
+import base64
+import binascii
+import json
+import os
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from . import crud
+from .sdk_sessions import SDKSessionPool
+
+# Grabaciones leídas del SDK por llamada al executor
+PAGE_SIZE = int(os.getenv("RECORDING_SEARCH_PAGE_SIZE", "100"))
+# Máximo de grabaciones por petición; el resto se pide con el cursor de continuación
+MAX_RESULTS = int(os.getenv("RECORDING_SEARCH_MAX_RESULTS", "1000"))
+
+def encode_cursor(start: str, files: List[str]) -> str:
+    """Cursor opaco: inicio de la última grabación devuelta y los archivos con ese inicio"""
+    payload = json.dumps({"start": start, "files": files}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[str, List[str]]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(payload["start"]), [str(f) for f in payload["files"]]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise ValueError("Cursor inválido")
+
+def _after_cursor(records: Iterator[Dict], start: str, files: List[str]) -> Iterator[Dict]:
+    # Los NVR devuelven los archivos en orden de inicio; la búsqueda se retoma
+    # desde `start` y se saltan los ya devueltos
+    seen = set(files)
+    try:
+        for record in records:
+            if record["start"] < start or (record["start"] == start and record["file_path"] in seen):
+                continue
+            yield record
+    finally:
+        records.close()
+
+class RecordingSearch:
+    """
+    Búsqueda de grabaciones en el dispositivo servida por páginas
+    
+    Recorre el generador `iter_recordings` del SDK sin cargar todos los
+    resultados: devuelve como mucho `limit` grabaciones y, si se alcanza el
+    límite, deja en `next_cursor` un cursor para continuar la búsqueda en otra
+    petición (el handle de búsqueda del SDK no sobrevive entre peticiones).
+    """
+    def __init__(self, sdk_sessions: SDKSessionPool, device, channel: int, start: str, end: str,
+                 file_type: Optional[str] = None, limit: int = MAX_RESULTS, cursor: Optional[str] = None):
+        self.sdk_sessions = sdk_sessions
+        self.device = device
+        self.channel = channel
+        self.start = start
+        self.end = end
+        self.file_type = file_type
+        self.limit = min(limit, MAX_RESULTS)
+        self.after = decode_cursor(cursor) if cursor else None
+        self.total = 0
+        self.next_cursor: Optional[str] = None
+
+    async def pages(self) -> AsyncIterator[List[Dict]]:
+        """Páginas de grabaciones; `total` y `next_cursor` quedan listos al terminar"""
+        search_start = self.after[0] if self.after else self.start
+        
+        def records(sdk, user_id):
+            found = sdk.iter_recordings(user_id, self.channel, search_start, self.end, self.file_type)
+            return _after_cursor(found, *self.after) if self.after else found
+        
+        last_start, last_files = None, []
+        pages = self.sdk_sessions.aiter_pages(self.device, records, min(PAGE_SIZE, self.limit))
+        try:
+            async for page in pages:
+                page = page[:self.limit - self.total]
+                for record in page:
+                    if record["start"] != last_start:
+                        last_start, last_files = record["start"], []
+                    last_files.append(record["file_path"])
+                self.total += len(page)
+                yield page
+                if self.total >= self.limit:
+                    # Puede haber más: el cliente sigue con el cursor
+                    self.next_cursor = encode_cursor(last_start, last_files)
+                    return
+        finally:
+            await pages.aclose()
+
+    async def collect(self) -> List[Dict]:
+        recordings = []
+        async for page in self.pages():
+            recordings += page
+        return recordings
+
+def search_index(db: Session, device_id: int, channel: int, start: str, end: str,
+                 file_type: Optional[str] = None, limit: int = MAX_RESULTS,
+                 cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Grabaciones desde el índice local (tabla `recordings`), con el mismo
+    formato y cursor que la búsqueda en el dispositivo
+    """
+    limit = min(limit, MAX_RESULTS)
+    after = datetime.strptime(decode_cursor(cursor)[0], "%Y-%m-%d %H:%M:%S") if cursor else None
+    # Una fila de más indica si hay que devolver cursor
+    rows = crud.get_recordings(db, device_id, start, end, channel=channel,
+                               recording_type=file_type, after=after, limit=limit + 1)
+    recordings = [_indexed_recording(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = recordings[-1]
+        next_cursor = encode_cursor(last["start"], [last["file_path"]])
+    return recordings, next_cursor
+
+def _indexed_recording(row) -> Dict:
+    return {
+        "start": row.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "end": row.end_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "type": row.recording_type,
+        "file_path": row.file_path,
+        "size": row.file_size,
+        "channel": row.channel
+    }
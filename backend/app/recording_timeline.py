@@ -0,0 +1,145 @@
+import base64
+import os
+import re
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, List
+from sqlalchemy.orm import Session
+from . import crud, models
+
+# Buckets por canal cuando no se pide un tamaño de bucket explícito
+TIMELINE_MAX_BUCKETS = int(os.getenv("RECORDING_TIMELINE_MAX_BUCKETS", "1440"))
+# Rango máximo de una consulta de línea de tiempo
+TIMELINE_MAX_DAYS = int(os.getenv("RECORDING_TIMELINE_MAX_DAYS", "92"))
+
+MINUTES_PER_DAY = 1440
+# Tamaños de bucket (minutos) que se eligen automáticamente
+BUCKET_STEPS = [1, 2, 5, 10, 15, 30, 60, 120, 180, 360, 720, 1440]
+
+def recording_days(start_time: datetime, end_time: datetime) -> List[date]:
+    """Días (hora del NVR) que abarca una grabación"""
+    last = max(start_time, end_time - timedelta(microseconds=1)).date()
+    days = [start_time.date()]
+    while days[-1] < last:
+        days.append(days[-1] + timedelta(days=1))
+    return days
+
+def day_bitmaps(recordings: Iterable[models.Recording], day: date) -> Dict[str, bytes]:
+    """Bitmap de minutos de un día por tipo de grabación (ver RecordingRollup)"""
+    day_start = datetime.combine(day, time())
+    day_end = day_start + timedelta(days=1)
+    masks: Dict[str, int] = {}
+    for recording in recordings:
+        first = max(recording.start_time, day_start)
+        last = min(recording.end_time, day_end)
+        if last <= first:
+            continue
+        # Un minuto cuenta si tiene algún segundo grabado
+        a = int((first - day_start).total_seconds()) // 60
+        b = -(-int((last - day_start).total_seconds()) // 60)
+        recording_type = recording.recording_type or "normal"
+        masks[recording_type] = masks.get(recording_type, 0) | _mask(a, b, MINUTES_PER_DAY)
+    return {
+        recording_type: mask.to_bytes(MINUTES_PER_DAY // 8, "big")
+        for recording_type, mask in masks.items()
+    }
+
+def refresh_rollups(db: Session, device_id: int, channel: int, days: Iterable[date]):
+    """Recalcular desde `recordings` los rollups de los días indicados de un canal"""
+    for day in sorted(set(days)):
+        day_start = datetime.combine(day, time())
+        recordings = crud.get_recordings(db, device_id, day_start, day_start + timedelta(days=1), channel=channel)
+        crud.replace_recording_rollups(db, device_id, channel, day, day_bitmaps(recordings, day))
+    db.commit()
+
+def rebuild_rollups(db: Session) -> int:
+    """Calcular los rollups de todas las grabaciones existentes; devuelve los canales procesados"""
+    channels = db.query(models.Recording.device_id, models.Recording.channel).distinct().all()
+    for device_id, channel in channels:
+        recordings = db.query(models.Recording).filter(
+            models.Recording.device_id == device_id,
+            models.Recording.channel == channel
+        ).order_by(models.Recording.start_time).all()
+        by_day: Dict[date, List[models.Recording]] = {}
+        for recording in recordings:
+            for day in recording_days(recording.start_time, recording.end_time):
+                by_day.setdefault(day, []).append(recording)
+        for day, day_recordings in by_day.items():
+            crud.replace_recording_rollups(db, device_id, channel, day, day_bitmaps(day_recordings, day))
+        db.commit()
+    return len(channels)
+
+def auto_bucket(start_time: datetime, end_time: datetime) -> int:
+    """Bucket (segundos) más pequeño que deja como mucho TIMELINE_MAX_BUCKETS por canal"""
+    minutes = _span_minutes(start_time, end_time)
+    for step in BUCKET_STEPS:
+        if -(-minutes // step) <= TIMELINE_MAX_BUCKETS:
+            return step * 60
+    return BUCKET_STEPS[-1] * 60
+
+def build_timeline(db: Session, device_id: int, channels: List[int], start_time: datetime,
+                   end_time: datetime, bucket: int) -> Dict:
+    """
+    Cobertura de grabación de varios canales desde los rollups precalculados
+    
+    Cada bitmap tiene `buckets` bits, uno por bucket de `bucket` segundos
+    desde `start_time`, codificados en base64: el bit i (empezando por el más
+    significativo del primer byte) indica que hay grabación en el bucket i.
+    `coverage` incluye todos los tipos; `types` solo los tipos con grabación.
+    """
+    step = bucket // 60
+    start_time = start_time.replace(second=0, microsecond=0)
+    minutes = _span_minutes(start_time, end_time)
+    buckets = -(-minutes // step)
+    
+    coverage = {channel: 0 for channel in channels}
+    types: Dict[int, Dict[str, int]] = {channel: {} for channel in channels}
+    last_day = (start_time + timedelta(minutes=minutes - 1)).date()
+    for rollup in crud.get_recording_rollups(db, device_id, channels, start_time.date(), last_day):
+        # Minuto del rango en el que empieza el día del rollup (negativo el primer día)
+        offset = int((datetime.combine(rollup.day, time()) - start_time).total_seconds()) // 60
+        mask = 0
+        for a, b in _runs(rollup.minutes):
+            a, b = max(a + offset, 0), min(b + offset, minutes)
+            if a < b:
+                mask |= _mask(a // step, -(-b // step), buckets)
+        if mask:
+            coverage[rollup.channel] |= mask
+            channel_types = types[rollup.channel]
+            channel_types[rollup.recording_type] = channel_types.get(rollup.recording_type, 0) | mask
+    
+    syncs = {state.channel: state.synced_until for state in crud.get_recording_syncs(db, device_id)}
+    return {
+        "device_id": device_id,
+        "start_time": start_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "end_time": (start_time + timedelta(seconds=buckets * bucket)).strftime("%Y-%m-%d %H:%M:%S"),
+        "bucket_seconds": bucket,
+        "buckets": buckets,
+        "channels": [
+            {
+                "channel": channel,
+                "coverage": _encode(coverage[channel], buckets),
+                "types": {
+                    recording_type: _encode(mask, buckets)
+                    for recording_type, mask in sorted(types[channel].items())
+                },
+                "indexed_until": syncs[channel].isoformat() if syncs.get(channel) else None
+            }
+            for channel in channels
+        ]
+    }
+
+def _span_minutes(start_time: datetime, end_time: datetime) -> int:
+    return max(1, -(-int((end_time - start_time.replace(second=0, microsecond=0)).total_seconds()) // 60))
+
+def _mask(a: int, b: int, width: int) -> int:
+    # Bits [a, b) de un bitmap de `width` bits; el bit 0 es el más significativo
+    return ((1 << (b - a)) - 1) << (width - b)
+
+def _runs(minutes: bytes):
+    """Tramos [a, b) de minutos grabados de un bitmap diario"""
+    bits = format(int.from_bytes(minutes, "big"), f"0{len(minutes) * 8}b")
+    return [match.span() for match in re.finditer("1+", bits)]
+
+def _encode(mask: int, width: int) -> str:
+    padding = -width % 8
+    return base64.b64encode((mask << padding).to_bytes((width + padding) // 8, "big")).decode()
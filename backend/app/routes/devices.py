@@ -4,6 +4,9 @@ from typing import List
 from ..database import get_db
 from .. import models, schemas, crud
 from ..auth import verify_token
+from ..sdk_sessions import SDKSessionPool, get_sdk_sessions
+from ..sdk_executor import SDKTimeoutError
+from .streams import build_rtsp_url
 
 router = APIRouter(prefix="/devices", tags=["devices"])
 
@@ -28,7 +31,7 @@ def create_device(
             )
         
         return crud.create_device(db=db, device=device)
-        
+    
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -66,7 +69,8 @@ def update_device(
     device_id: int,
     device_update: schemas.DeviceUpdate,
     db: Session = Depends(get_db),
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    sdk_sessions: SDKSessionPool = Depends(get_sdk_sessions)
 ):
     """Actualizar un dispositivo"""
     db_device = crud.get_device(db, device_id=device_id)
@@ -75,14 +79,17 @@ def update_device(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Dispositivo no encontrado"
         )
-    
+
+    # Las sesiones abiertas pueden usar credenciales antiguas
+    sdk_sessions.invalidate(device_id)
     return crud.update_device(db=db, device_id=device_id, device=device_update)
 
 @router.delete("/{device_id}")
 def delete_device(
     device_id: int,
     db: Session = Depends(get_db),
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    sdk_sessions: SDKSessionPool = Depends(get_sdk_sessions)
 ):
     """Eliminar un dispositivo"""
     db_device = crud.get_device(db, device_id=device_id)
@@ -92,14 +99,16 @@ def delete_device(
             detail="Dispositivo no encontrado"
         )
     
+    sdk_sessions.invalidate(device_id)
     crud.delete_device(db=db, device_id=device_id)
     return {"message": "Dispositivo eliminado correctamente"}
 
 @router.post("/{device_id}/test")
-def test_device_connection(
+async def test_device_connection(
     device_id: int,
     db: Session = Depends(get_db),
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    sdk_sessions: SDKSessionPool = Depends(get_sdk_sessions)
 ):
     """Probar conexión a un dispositivo"""
     device = crud.get_device(db, device_id=device_id)
@@ -109,31 +118,27 @@ def test_device_connection(
             detail="Dispositivo no encontrado"
         )
     
+    if not sdk_sessions.supports(device.brand):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Marca de dispositivo no soportada"
+        )
+    
     try:
-        if device.brand == "hikvision":
-            from ..hikvision_sdk import HikvisionSDK
-            sdk = HikvisionSDK()
-            result = sdk.login(device.ip, device.port, device.username, device.password)
-            sdk.logout(result["user_id"])
-            
-        elif device.brand == "dahua":
-            from ..dahua_sdk import DahuaSDK
-            sdk = DahuaSDK()
-            result = sdk.login(device.ip, device.port, device.username, device.password)
-            sdk.logout(result["user_id"])
-        
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Marca de dispositivo no soportada"
-            )
+        # Una sesión reutilizada se verifica contra el dispositivo
+        device_info = await sdk_sessions.device_info(device, verify=True)
         
         return {
             "status": "success",
             "message": "Conexión exitosa",
-            "device_info": result.get("device_info", {})
+            "device_info": device_info
         }
-        
+    
+    except SDKTimeoutError as e:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Error de conexión: {str(e)}"
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -141,10 +146,11 @@ def test_device_connection(
         )
 
 @router.get("/{device_id}/channels")
-def get_device_channels(
+async def get_device_channels(
     device_id: int,
     db: Session = Depends(get_db),
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    sdk_sessions: SDKSessionPool = Depends(get_sdk_sessions)
 ):
     """Obtener información de canales del dispositivo"""
     device = crud.get_device(db, device_id=device_id)
@@ -154,35 +160,25 @@ def get_device_channels(
             detail="Dispositivo no encontrado"
         )
     
+    if not sdk_sessions.supports(device.brand):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Marca de dispositivo no soportada"
+        )
+    
     try:
-        if device.brand == "hikvision":
-            from ..hikvision_sdk import HikvisionSDK
-            sdk = HikvisionSDK()
-            result = sdk.login(device.ip, device.port, device.username, device.password)
-            sdk.logout(result["user_id"])
-            
-        elif device.brand == "dahua":
-            from ..dahua_sdk import DahuaSDK
-            sdk = DahuaSDK()
-            result = sdk.login(device.ip, device.port, device.username, device.password)
-            sdk.logout(result["user_id"])
-        
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Marca de dispositivo no soportada"
-            )
+        device_info = await sdk_sessions.device_info(device)
         
         channels = []
-        total_channels = result.get("device_info", {}).get("channels", device.channels)
+        total_channels = device_info.get("channels", device.channels)
         
         for i in range(1, total_channels + 1):
             channels.append({
                 "channel": i,
                 "name": f"Canal {i}",
                 "enabled": True,
-                "rtsp_main": sdk.get_rtsp_url(device.ip, device.port, device.username, device.password, i, 0),
-                "rtsp_sub": sdk.get_rtsp_url(device.ip, device.port, device.username, device.password, i, 1)
+                "rtsp_main": build_rtsp_url(device, i, 0),
+                "rtsp_sub": build_rtsp_url(device, i, 1)
             })
         
         return {
@@ -190,7 +186,12 @@ def get_device_channels(
             "total_channels": total_channels,
             "channels": channels
         }
-        
+    
+    except SDKTimeoutError as e:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Error obteniendo canales: {str(e)}"
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
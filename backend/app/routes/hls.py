@@ -0,0 +1,121 @@
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Request, status, Query
+from fastapi.responses import FileResponse, Response
+from typing import Optional
+from ..stream_manager import StreamManager, HLS_TIME, HLS_SPILL_DIR, get_stream_manager
+from ..hls_cache import DEFAULT_MEDIA_TYPE, media_type, valid_name
+from ..dvr import PLAYLIST_NAME, to_epoch
+
+router = APIRouter(prefix="/hls", tags=["hls"])
+
+# Un segmento no cambia una vez publicado
+SEGMENT_CACHE_CONTROL = "public, max-age=3600"
+# Recarga bloqueante: como mucho 3 target durations de espera (LL-HLS)
+BLOCKING_RELOAD_TARGETS = 3
+# Segmentos por delante del último publicado que se aceptan en _HLS_msn
+BLOCKING_RELOAD_MAX_AHEAD = 2
+# Variantes como máximo en una master playlist
+MAX_VARIANTS = 8
+
+def cached_response(request: Request, data: bytes, etag: str, name: str, cache_control: str) -> Response:
+    """Respuesta con ETag; 304 si el cliente ya tiene esta versión"""
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=data, media_type=media_type(name), headers=headers)
+
+@router.get("/master.m3u8")
+def get_master_playlist(
+    streams: str = Query(..., description="IDs de los streams variantes separados por comas"),
+    stream_manager: StreamManager = Depends(get_stream_manager)
+):
+    """Master playlist ABR generada con el vídeo medido de cada variante"""
+    stream_ids = [stream_id for stream_id in streams.split(",") if stream_id]
+    if not stream_ids or len(stream_ids) > MAX_VARIANTS or not all(valid_name(stream_id) for stream_id in stream_ids):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Lista de variantes inválida")
+    
+    data = stream_manager.master_playlist(stream_ids)
+    if data is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ninguna variante activa")
+    return Response(content=data, media_type=media_type("master.m3u8"), headers={"Cache-Control": "no-cache"})
+
+@router.get("/{stream_id}/{name}")
+async def get_hls_file(
+    stream_id: str,
+    name: str,
+    request: Request,
+    msn: Optional[int] = Query(None, alias="_HLS_msn", ge=0, description="Esperar a este media sequence number"),
+    part: Optional[int] = Query(None, alias="_HLS_part", ge=0, description="Sin partes: se ignora"),
+    stream_manager: StreamManager = Depends(get_stream_manager)
+):
+    """
+    Playlist o segmento de un stream en vivo servido desde memoria
+    
+    Las playlists se sirven con `no-cache` y ETag (los players revalidan
+    con If-None-Match) y los segmentos como inmutables. Con `_HLS_msn` la
+    respuesta espera a que FFmpeg publique ese segmento (recarga bloqueante)
+    en lugar de que el player sondee la playlist.
+    """
+    if not valid_name(stream_id) or not valid_name(name):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Archivo no encontrado")
+    
+    cache = stream_manager.hls_cache
+    if not name.endswith(".m3u8"):
+        cached = await cache.get_file(stream_id, name)
+        if cached is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Archivo no encontrado")
+        return cached_response(request, cached.data, cached.etag, name, SEGMENT_CACHE_CONTROL)
+    
+    playlist = await cache.get_playlist(stream_id, name)
+    if playlist is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Playlist no encontrada")
+    if msn is None:
+        return cached_response(request, playlist.data, playlist.etag, name, "no-cache")
+    
+    if msn > playlist.last_msn + BLOCKING_RELOAD_MAX_AHEAD:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"_HLS_msn demasiado adelantado (último publicado: {playlist.last_msn})"
+        )
+    target_duration = playlist.target_duration or HLS_TIME
+    playlist = await cache.wait_for_msn(stream_id, name, msn, BLOCKING_RELOAD_TARGETS * target_duration)
+    if playlist is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="El segmento pedido no se publicó a tiempo"
+        )
+    # Cada (playlist, _HLS_msn) tiene siempre la misma respuesta: cacheable por proxies
+    return cached_response(request, playlist.data, playlist.etag, name, f"public, max-age={int(6 * target_duration)}")
+
+@router.get("/{stream_id}/dvr/{name}")
+def get_dvr_file(
+    stream_id: str,
+    name: str,
+    start: Optional[datetime] = Query(None, description="Empezar en esta hora (UTC) en lugar del borde en vivo"),
+    stream_manager: StreamManager = Depends(get_stream_manager)
+):
+    """
+    Playlist de time-shift o segmento retenido de un stream
+    
+    La playlist se genera desde el índice de segmentos retenidos: sin `start`
+    cubre toda la ventana y el player arranca en vivo; con `start` es una
+    playlist EVENT que empieza en esa hora.
+    """
+    if not valid_name(stream_id) or not valid_name(name):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Archivo no encontrado")
+    
+    if name == PLAYLIST_NAME:
+        index = stream_manager.get_dvr_index(stream_id)
+        if index is None or not index.segments:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="El stream no tiene time-shift")
+        return Response(
+            content=index.playlist(to_epoch(start) if start else None),
+            media_type=media_type(name),
+            headers={"Cache-Control": "no-cache"}
+        )
+    
+    path = stream_manager.hls_root / stream_id / HLS_SPILL_DIR / name
+    # Solo segmentos e init.mp4 (no el índice)
+    if name.endswith(".m3u8") or media_type(name) == DEFAULT_MEDIA_TYPE or not path.is_file():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Archivo no encontrado")
+    return FileResponse(path, media_type=media_type(name), headers={"Cache-Control": SEGMENT_CACHE_CONTROL})
@@ -1,21 +1,109 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+import json
+from fastapi import APIRouter, Depends, HTTPException, Request, status, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Dict, List, Optional
 from datetime import datetime
 from ..database import get_db
 from .. import models, schemas, crud
 from ..auth import verify_token
+from ..sdk_sessions import SDKSessionPool, get_sdk_sessions
+from ..sdk_executor import SDKTimeoutError
+from ..recording_search import RecordingSearch, MAX_RESULTS, search_index
+from ..recording_indexer import RecordingIndexer, get_recording_indexer, index_covers
+from ..recording_partitions import RecordingPartitionManager, get_recording_partitions
+from ..recording_exports import (
+    RecordingExportManager, EXPORT_MAX_DURATION, EXPORT_PROFILES, PLAYBACK_URL_BUILDERS,
+    file_response, get_recording_exports
+)
+from ..recording_timeline import TIMELINE_MAX_BUCKETS, TIMELINE_MAX_DAYS, auto_bucket, build_timeline
 
 router = APIRouter(prefix="/recordings", tags=["recordings"])
 
+async def search_response(search: RecordingSearch, result: Dict, stream: bool):
+    """
+    Respuesta de una búsqueda de grabaciones
+    
+    Sin `stream` se devuelve un JSON con hasta `limit` grabaciones. Con
+    `stream` se responde NDJSON: una línea {"recordings": [...]} por página a
+    medida que el NVR las devuelve y una línea final con el total y el cursor.
+    La primera página se lee antes de responder para que los errores del
+    dispositivo lleguen como código HTTP.
+    """
+    if not stream:
+        recordings = await search.collect()
+        return {
+            **result,
+            "total_recordings": len(recordings),
+            "recordings": recordings,
+            "next_cursor": search.next_cursor
+        }
+    
+    pages = search.pages()
+    first = await anext(pages, None)
+
+    async def ndjson():
+        try:
+            if first is not None:
+                yield json.dumps({"recordings": first}) + "\n"
+            async for page in pages:
+                yield json.dumps({"recordings": page}) + "\n"
+            yield json.dumps({**result, "total_recordings": search.total, "next_cursor": search.next_cursor}) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e), "total_recordings": search.total}) + "\n"
+        finally:
+            await pages.aclose()
+    
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+def index_response(db: Session, device_id: int, channel: int, start: str, end: str,
+                   file_type: Optional[str], limit: int, cursor: Optional[str],
+                   indexed_until: Optional[datetime], result: Dict, stream: bool):
+    """Respuesta desde el índice local, con el mismo formato que la búsqueda en el NVR"""
+    recordings, next_cursor = search_index(db, device_id, channel, start, end, file_type, limit, cursor)
+    result = {
+        **result,
+        "source": "index",
+        "indexed_until": indexed_until.isoformat() if indexed_until else None
+    }
+    if not stream:
+        return {**result, "total_recordings": len(recordings), "recordings": recordings, "next_cursor": next_cursor}
+    
+    lines = [{"recordings": recordings}, {**result, "total_recordings": len(recordings), "next_cursor": next_cursor}]
+    return StreamingResponse((json.dumps(line) + "\n" for line in lines), media_type="application/x-ndjson")
+
+def use_index(db: Session, source: str, device_id: int, channel: int,
+              start_time: datetime, end_time: datetime, indexer: RecordingIndexer):
+    """
+    Decidir si se responde desde el índice local o buscando en el NVR
+    
+    Con source=auto se usa el índice si cubre el rango; si no, se busca en el
+    NVR y se adelanta la sincronización del dispositivo.
+    """
+    state = crud.get_recording_sync(db, device_id, channel)
+    indexed_until = state.synced_until if state else None
+    if source == "index":
+        return True, indexed_until
+    if source == "auto" and index_covers(state, start_time, end_time):
+        return True, indexed_until
+    if source == "auto":
+        indexer.request_sync(device_id)
+    return False, indexed_until
+
 @router.get("/{device_id}")
-def list_recordings(
+async def list_recordings(
     device_id: int,
     start: str = Query(..., description="Fecha de inicio (YYYY-MM-DD HH:MM:SS)"),
     end: str = Query(..., description="Fecha de fin (YYYY-MM-DD HH:MM:SS)"),
     channel: int = Query(1, ge=1, le=64, description="Canal a consultar"),
+    limit: int = Query(MAX_RESULTS, ge=1, le=MAX_RESULTS, description="Máximo de grabaciones"),
+    cursor: Optional[str] = Query(None, description="Cursor de continuación (next_cursor)"),
+    stream: bool = Query(False, description="Responder NDJSON página a página"),
+    source: str = Query("auto", regex="^(auto|index|device)$", description="Índice local, NVR o automático"),
     db: Session = Depends(get_db),
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    sdk_sessions: SDKSessionPool = Depends(get_sdk_sessions),
+    indexer: RecordingIndexer = Depends(get_recording_indexer)
 ):
     """Obtener lista de grabaciones de un dispositivo"""
     device = crud.get_device(db, device_id=device_id)
@@ -36,37 +124,44 @@ def list_recordings(
                 detail="La fecha de inicio debe ser anterior a la fecha de fin"
             )
         
-        # Obtener grabaciones usando el SDK correspondiente
-        if device.brand == "hikvision":
-            from ..hikvision_sdk import HikvisionSDK
-            sdk = HikvisionSDK()
-            login_result = sdk.login(device.ip, device.port, device.username, device.password)
-            recordings = sdk.find_recordings(login_result["user_id"], channel, start, end)
-            sdk.logout(login_result["user_id"])
-            
-        elif device.brand == "dahua":
-            from ..dahua_sdk import DahuaSDK
-            sdk = DahuaSDK()
-            login_result = sdk.login(device.ip, device.port, device.username, device.password)
-            recordings = sdk.find_recordings(login_result["user_id"], channel, start, end)
-            sdk.logout(login_result["user_id"])
+        result = {
+            "device_id": device_id,
+            "device_name": device.name,
+            "channel": channel,
+            "start_time": start,
+            "end_time": end
+        }
         
-        else:
+        # Las consultas de línea de tiempo se sirven desde el índice local si está al día
+        indexed, indexed_until = use_index(db, source, device_id, channel, start_time, end_time, indexer)
+        if indexed:
+            try:
+                return index_response(db, device_id, channel, start, end, None, limit, cursor,
+                                      indexed_until, result, stream)
+            except ValueError as e:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        
+        # Obtener grabaciones usando una sesión del pool (sin login por petición)
+        if not sdk_sessions.supports(device.brand):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Marca de dispositivo no soportada"
             )
         
-        return {
-            "device_id": device_id,
-            "device_name": device.name,
-            "channel": channel,
-            "start_time": start,
-            "end_time": end,
-            "total_recordings": len(recordings),
-            "recordings": recordings
-        }
+        try:
+            search = RecordingSearch(sdk_sessions, device, channel, start, end, limit=limit, cursor=cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
         
+        return await search_response(search, {**result, "source": "device"}, stream)
+    
+    except HTTPException:
+        raise
+    except SDKTimeoutError as e:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Error obteniendo grabaciones: {str(e)}"
+        )
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -79,14 +174,20 @@ def list_recordings(
         )
 
 @router.get("/{device_id}/channels/{channel}")
-def get_channel_recordings(
+async def get_channel_recordings(
     device_id: int,
     channel: int,
     start: str = Query(..., description="Fecha de inicio (YYYY-MM-DD HH:MM:SS)"),
     end: str = Query(..., description="Fecha de fin (YYYY-MM-DD HH:MM:SS)"),
     recording_type: str = Query("normal", regex="^(normal|alarm|motion)$"),
+    limit: int = Query(MAX_RESULTS, ge=1, le=MAX_RESULTS, description="Máximo de grabaciones"),
+    cursor: Optional[str] = Query(None, description="Cursor de continuación (next_cursor)"),
+    stream: bool = Query(False, description="Responder NDJSON página a página"),
+    source: str = Query("auto", regex="^(auto|index|device)$", description="Índice local, NVR o automático"),
     db: Session = Depends(get_db),
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    sdk_sessions: SDKSessionPool = Depends(get_sdk_sessions),
+    indexer: RecordingIndexer = Depends(get_recording_indexer)
 ):
     """Obtener grabaciones de un canal específico con filtro de tipo"""
     device = crud.get_device(db, device_id=device_id)
@@ -107,63 +208,211 @@ def get_channel_recordings(
                 detail="La fecha de inicio debe ser anterior a la fecha de fin"
             )
         
-        # Obtener grabaciones usando el SDK correspondiente
-        if device.brand == "hikvision":
-            from ..hikvision_sdk import HikvisionSDK
-            sdk = HikvisionSDK()
-            login_result = sdk.login(device.ip, device.port, device.username, device.password)
-            recordings = sdk.find_recordings(login_result["user_id"], channel, start, end)
-            sdk.logout(login_result["user_id"])
-            
-        elif device.brand == "dahua":
-            from ..dahua_sdk import DahuaSDK
-            sdk = DahuaSDK()
-            login_result = sdk.login(device.ip, device.port, device.username, device.password)
-            recordings = sdk.find_recordings(login_result["user_id"], channel, start, end)
-            sdk.logout(login_result["user_id"])
+        result = {
+            "device_id": device_id,
+            "device_name": device.name,
+            "channel": channel,
+            "recording_type": recording_type,
+            "start_time": start,
+            "end_time": end
+        }
+        # Filtrar por tipo de grabación en el índice o en el propio NVR si es necesario
+        file_type = recording_type if recording_type != "normal" else None
+        
+        # Las consultas de línea de tiempo se sirven desde el índice local si está al día
+        indexed, indexed_until = use_index(db, source, device_id, channel, start_time, end_time, indexer)
+        if indexed:
+            try:
+                return index_response(db, device_id, channel, start, end, file_type, limit, cursor,
+                                      indexed_until, result, stream)
+            except ValueError as e:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
         
-        else:
+        # Obtener grabaciones usando una sesión del pool (sin login por petición)
+        if not sdk_sessions.supports(device.brand):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Marca de dispositivo no soportada"
             )
         
-        # Filtrar por tipo de grabación si es necesario
-        if recording_type != "normal":
-            recordings = [r for r in recordings if r.get("type") == recording_type]
+        try:
+            search = RecordingSearch(sdk_sessions, device, channel, start, end,
+                                     file_type=file_type, limit=limit, cursor=cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        
+        return await search_response(search, {**result, "source": "device"}, stream)
+    
+    except HTTPException:
+        raise
+    except SDKTimeoutError as e:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Error obteniendo grabaciones: {str(e)}"
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Formato de fecha inválido: {str(e)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error obteniendo grabaciones: {str(e)}"
+        )
+
+@router.get("/{device_id}/timeline")
+def get_recordings_timeline(
+    device_id: int,
+    start: str = Query(..., description="Fecha de inicio (YYYY-MM-DD HH:MM:SS)"),
+    end: str = Query(..., description="Fecha de fin (YYYY-MM-DD HH:MM:SS)"),
+    channels: Optional[str] = Query(None, description="Canales separados por comas (todos si se omite)"),
+    bucket: Optional[int] = Query(None, ge=60, description="Segundos por bucket, múltiplo de 60 (automático si se omite)"),
+    db: Session = Depends(get_db),
+    current_user: str = Depends(verify_token)
+):
+    """
+    Cobertura de grabación de varios canales como bitmaps por bucket
+    
+    Se sirve desde los rollups por minuto que mantiene el indexador, sin
+    listar archivos: cada canal devuelve un bitmap base64 de cobertura y uno
+    por tipo de grabación (alarm, motion...). Sin `bucket` se elige el más
+    pequeño que deja como mucho RECORDING_TIMELINE_MAX_BUCKETS por canal.
+    """
+    device = crud.get_device(db, device_id=device_id)
+    if device is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Dispositivo no encontrado"
+        )
+    
+    try:
+        start_time = datetime.strptime(start, "%Y-%m-%d %H:%M:%S")
+        end_time = datetime.strptime(end, "%Y-%m-%d %H:%M:%S")
+        
+        if start_time >= end_time:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="La fecha de inicio debe ser anterior a la fecha de fin"
+            )
+        if (end_time - start_time).days >= TIMELINE_MAX_DAYS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"El rango máximo de la línea de tiempo es de {TIMELINE_MAX_DAYS} días"
+            )
+        
+        if channels:
+            channel_list = sorted({int(channel) for channel in channels.split(",")})
+        else:
+            channel_list = list(range(1, (device.channels or 0) + 1))
+        if not channel_list or channel_list[0] < 1 or channel_list[-1] > 64:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Canales inválidos"
+            )
+        
+        if bucket is None:
+            bucket = auto_bucket(start_time, end_time)
+        elif bucket % 60:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="El bucket debe ser un múltiplo de 60 segundos"
+            )
+        elif (end_time - start_time).total_seconds() / bucket > 4 * TIMELINE_MAX_BUCKETS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Demasiados buckets para el rango pedido: aumente el bucket"
+            )
         
         return {
-            "device_id": device_id,
             "device_name": device.name,
-            "channel": channel,
-            "recording_type": recording_type,
-            "start_time": start,
-            "end_time": end,
-            "total_recordings": len(recordings),
-            "recordings": recordings
+            **build_timeline(db, device_id, channel_list, start_time, end_time, bucket)
         }
-        
+    
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Formato de fecha inválido: {str(e)}"
+            detail=f"Parámetros inválidos: {str(e)}"
         )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error obteniendo grabaciones: {str(e)}"
+            detail=f"Error obteniendo línea de tiempo: {str(e)}"
+        )
+
+@router.post("/{device_id}/sync", status_code=status.HTTP_202_ACCEPTED)
+def sync_recordings(
+    device_id: int,
+    db: Session = Depends(get_db),
+    current_user: str = Depends(verify_token),
+    indexer: RecordingIndexer = Depends(get_recording_indexer)
+):
+    """Adelantar la sincronización del índice de grabaciones de un dispositivo"""
+    device = crud.get_device(db, device_id=device_id)
+    if device is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Dispositivo no encontrado"
+        )
+    
+    indexer.request_sync(device_id)
+    return {"device_id": device_id, "status": "queued"}
+
+@router.get("/{device_id}/sync")
+def get_recordings_sync(
+    device_id: int,
+    db: Session = Depends(get_db),
+    current_user: str = Depends(verify_token)
+):
+    """Estado de sincronización del índice de grabaciones por canal"""
+    device = crud.get_device(db, device_id=device_id)
+    if device is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Dispositivo no encontrado"
         )
+    
+    return {
+        "device_id": device_id,
+        "channels": [
+            {
+                "channel": state.channel,
+                "synced_until": state.synced_until.isoformat() if state.synced_until else None,
+                "last_run_at": state.last_run_at.isoformat() if state.last_run_at else None,
+                "last_error": state.last_error,
+                "syncing": state.locked_until is not None and state.locked_until > datetime.utcnow()
+            }
+            for state in crud.get_recording_syncs(db, device_id)
+        ]
+    }
 
-@router.post("/{device_id}/channels/{channel}/download")
+@router.post("/{device_id}/channels/{channel}/download", status_code=status.HTTP_202_ACCEPTED)
 def download_recording(
     device_id: int,
     channel: int,
     start: str = Query(..., description="Fecha de inicio (YYYY-MM-DD HH:MM:SS)"),
     end: str = Query(..., description="Fecha de fin (YYYY-MM-DD HH:MM:SS)"),
+    profile: str = Query("main", description="Perfil de exportación: main (stream principal) o sub"),
     db: Session = Depends(get_db),
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    exports: RecordingExportManager = Depends(get_recording_exports)
 ):
-    """Iniciar descarga de una grabación específica"""
+    """
+    Exportar un tramo de grabación a MP4
+    
+    Encola la exportación (o devuelve la existente del mismo tramo y perfil,
+    servida desde la caché sin tocar el NVR) y responde enseguida: el estado
+    se consulta en status_url y, al terminar, el archivo se descarga desde
+    download_url.
+    """
+    if profile not in EXPORT_PROFILES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Perfil no soportado. Opciones: {', '.join(EXPORT_PROFILES)}"
+        )
+    
     device = crud.get_device(db, device_id=device_id)
     if device is None:
         raise HTTPException(
@@ -171,6 +420,12 @@ def download_recording(
             detail="Dispositivo no encontrado"
         )
     
+    if device.brand not in PLAYBACK_URL_BUILDERS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Marca de dispositivo no soportada"
+        )
+    
     try:
         # Validar formato de fechas
         start_time = datetime.strptime(start, "%Y-%m-%d %H:%M:%S")
@@ -181,20 +436,20 @@ def download_recording(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="La fecha de inicio debe ser anterior a la fecha de fin"
             )
+        if (end_time - start_time).total_seconds() > EXPORT_MAX_DURATION:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"La duración máxima de una exportación es de {EXPORT_MAX_DURATION} segundos"
+            )
         
-        # En una implementación real, aquí se iniciaría la descarga
-        # Por ahora, devolvemos información de la grabación solicitada
+        export = exports.request_export(db, device, channel, start_time, end_time, profile, current_user)
         return {
-            "device_id": device_id,
             "device_name": device.name,
-            "channel": channel,
-            "start_time": start,
-            "end_time": end,
-            "download_url": f"/api/recordings/{device_id}/channels/{channel}/download?start={start}&end={end}",
-            "status": "pending",
-            "message": "Descarga iniciada. Use el download_url para obtener el archivo."
+            **exports.export_info(export)
         }
-        
+    
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -206,10 +461,87 @@ def download_recording(
             detail=f"Error iniciando descarga: {str(e)}"
         )
 
+@router.get("/exports/{export_id}")
+def get_export(
+    export_id: str,
+    db: Session = Depends(get_db),
+    current_user: str = Depends(verify_token),
+    exports: RecordingExportManager = Depends(get_recording_exports)
+):
+    """Estado de una exportación"""
+    export = crud.get_export(db, export_id)
+    if export is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Exportación no encontrada"
+        )
+    return exports.export_info(export)
+
+@router.get("/exports/{export_id}/file")
+def download_export(
+    export_id: str,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: str = Depends(verify_token),
+    exports: RecordingExportManager = Depends(get_recording_exports)
+):
+    """Descargar el MP4 de una exportación terminada (admite Range)"""
+    export = crud.get_export(db, export_id)
+    if export is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Exportación no encontrada"
+        )
+    
+    path = exports.export_path(export_id)
+    if export.status != "done" or not path.exists():
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"La exportación no está disponible (estado: {export.status})"
+        )
+    
+    exports.touch(db, export_id, request.headers.get("range"))
+    filename = f"device{export.device_id}_ch{export.channel}_{export.start_time:%Y%m%d_%H%M%S}.mp4"
+    return file_response(request, path, filename)
+
+@router.post("/exports/{export_id}/pin")
+def pin_export(
+    export_id: str,
+    reason: Optional[str] = Query(None, description="Caso o referencia de la evidencia"),
+    db: Session = Depends(get_db),
+    current_user: str = Depends(verify_token),
+    exports: RecordingExportManager = Depends(get_recording_exports)
+):
+    """Fijar una exportación como evidencia: la caché no la expulsa"""
+    if not exports.set_pinned(db, export_id, True, reason):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Exportación no encontrada"
+        )
+    return exports.export_info(crud.get_export(db, export_id))
+
+@router.delete("/exports/{export_id}/pin")
+def unpin_export(
+    export_id: str,
+    db: Session = Depends(get_db),
+    current_user: str = Depends(verify_token),
+    exports: RecordingExportManager = Depends(get_recording_exports)
+):
+    """Liberar una exportación fijada: vuelve a la LRU de la caché"""
+    if not exports.set_pinned(db, export_id, False):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Exportación no encontrada"
+        )
+    return exports.export_info(crud.get_export(db, export_id))
+
 @router.get("/stats/summary")
 def get_recordings_stats(
     db: Session = Depends(get_db),
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    indexer: RecordingIndexer = Depends(get_recording_indexer),
+    partitions: RecordingPartitionManager = Depends(get_recording_partitions),
+    exports: RecordingExportManager = Depends(get_recording_exports)
 ):
     """Obtener estadísticas generales de grabaciones"""
     try:
@@ -229,9 +561,12 @@ def get_recordings_stats(
                 "hikvision": hikvision_count,
                 "dahua": dahua_count
             },
-            "total_channels": sum(device.channels for device in db.query(models.Device).all())
+            "total_channels": sum(device.channels for device in db.query(models.Device).all()),
+            "index": indexer.get_stats(),
+            "storage": partitions.get_stats(),
+            "exports": exports.get_stats()
         }
-        
+    
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -1,29 +1,84 @@
+import asyncio
+import json
+from datetime import datetime
+from urllib.parse import quote
 from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from ..database import get_db
 from .. import models, schemas, crud
 from ..auth import verify_token
-from ..stream_manager import StreamManager
+from ..stream_manager import (
+    StreamManager, HLS_PROFILES, ABR_VARIANTS, BULK_CONCURRENCY, get_stream_manager, select_variant
+)
+from ..admission import AdmissionRejected
+from ..dvr import DVR_MAX_WINDOW, DVR_WINDOW, PLAYLIST_NAME, to_epoch
 from ..hikvision_sdk import HikvisionSDK
 from ..dahua_sdk import DahuaSDK
 
 router = APIRouter(prefix="/streams", tags=["streams"])
 
-# Instancia global del gestor de streams
-stream_manager = StreamManager()
+# Generadores de URL RTSP por marca (métodos estáticos: no cargan la librería del SDK)
+RTSP_URL_BUILDERS = {
+    "hikvision": HikvisionSDK.get_rtsp_url,
+    "dahua": DahuaSDK.get_rtsp_url
+}
+
+def _validation_message(error: ValidationError) -> str:
+    """Mensaje de error de un item de un lote que no pasa la validación"""
+    return "; ".join(
+        f"{'.'.join(str(part) for part in detail['loc'])}: {detail['msg']}" for detail in error.errors()
+    )
+
+def build_rtsp_url(device: models.Device, channel: int, sub_stream: int) -> Optional[str]:
+    """URL RTSP de un canal del dispositivo, o None si la marca no está soportada"""
+    builder = RTSP_URL_BUILDERS.get(device.brand)
+    if builder is None:
+        return None
+    return builder(device.ip, device.port, device.username, device.password, channel, sub_stream)
 
 @router.post("/start")
-def start_stream(
+async def start_stream(
     device_id: int,
     channel: int = Query(1, ge=1, le=64),
     sub_stream: int = Query(0, ge=0, le=1),
     duration: int = Query(3600, ge=60, le=86400),
+    supervised: bool = Query(True, description="Reiniciar FFmpeg automáticamente si se cae"),
+    profile: str = Query("ts", description="Perfil HLS: ts (MPEG-TS) o ll (fMP4 baja latencia)"),
+    retain: bool = Query(False, description="Retener los segmentos en almacenamiento persistente (DVR)"),
+    dvr_window: Optional[int] = Query(None, ge=60, le=DVR_MAX_WINDOW, description="Ventana de time-shift en segundos (implica retain)"),
+    abr: bool = Query(False, description="Main y sub como variantes de una master playlist (ignora sub_stream; "
+                                          "retain y dvr_window se aplican a ambas variantes)"),
+    tile_width: Optional[int] = Query(None, ge=16, le=7680, description="Ancho del tile en píxeles físicos (elige sub_stream)"),
+    tile_height: Optional[int] = Query(None, ge=16, le=4320, description="Alto del tile en píxeles físicos (elige sub_stream)"),
+    tiles: int = Query(1, ge=1, le=256, description="Tiles visibles en la vista del operador"),
     db: Session = Depends(get_db),
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    stream_manager: StreamManager = Depends(get_stream_manager)
 ):
-    """Iniciar un stream HLS desde un dispositivo"""
-    device = crud.get_device(db, device_id=device_id)
+    """
+    Iniciar un stream HLS desde un dispositivo
+    
+    Cada petición recibe su propio `lease_id`, que se libera con
+    /streams/stop. Con `abr` se obtienen leases sobre las dos variantes del
+    canal (`lease_ids`) y `playlist_url` es la master playlist; con `retain`
+    o `dvr_window` cada variante retiene sus segmentos y su time-shift se
+    sirve en /hls/{stream_id}/dvr/ de esa variante.
+    
+    Con `tile_width` y `tile_height` se ignora `sub_stream` y se elige la
+    variante más barata que cubre el tile teniendo en cuenta los `tiles` de
+    la vista (ver /streams/select).
+    """
+    if profile not in HLS_PROFILES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Perfil no soportado. Opciones: {', '.join(HLS_PROFILES)}"
+        )
+    
+    # Las consultas síncronas van al threadpool: el event loop supervisa los FFmpeg
+    device = await asyncio.to_thread(crud.get_device, db, device_id)
     if device is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -37,50 +92,85 @@ def start_stream(
         )
     
     try:
-        # Generar URL RTSP según la marca del dispositivo
-        if device.brand == "hikvision":
-            sdk = HikvisionSDK()
-            rtsp_url = sdk.get_rtsp_url(
-                device.ip, device.port, device.username, 
-                device.password, channel, sub_stream
+        auto_selected = not abr and tile_width is not None and tile_height is not None
+        if auto_selected:
+            sub_stream = await asyncio.to_thread(
+                stream_manager.select_sub_stream, device_id, channel, tile_width, tile_height, tiles
             )
-        elif device.brand == "dahua":
-            sdk = DahuaSDK()
-            rtsp_url = sdk.get_rtsp_url(
-                device.ip, device.port, device.username, 
-                device.password, channel, sub_stream
-            )
-        else:
+        
+        # Generar URL RTSP según la marca del dispositivo (sin cargar el SDK)
+        rtsp_url = build_rtsp_url(device, channel, sub_stream)
+        if rtsp_url is None:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Marca de dispositivo no soportada"
             )
         
-        # Iniciar stream HLS
-        stream_id, playlist_url = stream_manager.start_hls(rtsp_url, duration=duration)
+        if abr:
+            stream_ids, lease_ids, playlist_url, created = await stream_manager.acquire_abr(
+                device_id, channel,
+                {variant: build_rtsp_url(device, channel, variant) for variant in ABR_VARIANTS},
+                duration=duration, supervised=supervised, profile=profile,
+                retain=retain or dvr_window is not None, dvr_window=dvr_window or DVR_WINDOW
+            )
+            return {
+                "stream_id": stream_ids[0],
+                "stream_ids": stream_ids,
+                "lease_id": lease_ids[0],
+                "lease_ids": lease_ids,
+                "playlist_url": playlist_url,
+                "device_id": device_id,
+                "device_name": device.name,
+                "channel": channel,
+                "abr": True,
+                "profile": profile,
+                "live_sync_segments": HLS_PROFILES[profile]["hold_back"],
+                "retain": retain or dvr_window is not None,
+                "dvr_window": (dvr_window or DVR_WINDOW) if retain or dvr_window is not None else None,
+                "duration": duration,
+                "status": "started" if created else "shared"
+            }
         
-        # Guardar información del stream en la base de datos
-        stream_data = schemas.StreamCreate(
-            device_id=device_id,
-            channel=channel,
-            sub_stream=sub_stream,
-            rtsp_url=rtsp_url,
-            hls_url=playlist_url
+        # Iniciar stream HLS o adjuntarse al existente para el mismo canal
+        # (el gestor registra el stream en la base de datos compartida)
+        stream_id, playlist_url, created, lease_id = await stream_manager.acquire_stream(
+            device_id, channel, sub_stream, rtsp_url, duration=duration, supervised=supervised,
+            profile=profile, retain=retain or dvr_window is not None,
+            dvr_window=dvr_window or DVR_WINDOW
         )
-        stream_data.stream_id = stream_id
-        crud.create_stream(db, stream_data)
+        
+        stream_info = await asyncio.to_thread(stream_manager.get_stream_info, stream_id) or {}
         
         return {
             "stream_id": stream_id,
+            "stream_ids": [stream_id],
+            "lease_id": lease_id,
+            "lease_ids": [lease_id],
             "playlist_url": playlist_url,
             "device_id": device_id,
             "device_name": device.name,
             "channel": channel,
+            "abr": False,
             "sub_stream": sub_stream,
-            "duration": duration,
-            "status": "started"
+            "auto_selected": auto_selected,
+            "profile": profile,
+            "live_sync_segments": HLS_PROFILES[profile]["hold_back"],
+            "retain": stream_info.get("retain", retain),
+            "dvr_window": stream_info.get("dvr_window") if stream_info.get("retain") else None,
+            "duration": stream_info.get("duration", duration),
+            "viewers": stream_info.get("viewers", 1),
+            "status": "started" if created else "shared"
         }
-        
+    
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        # Presupuesto del dispositivo agotado: 429; recursos del nodo: 503
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS if e.scope == "device" else status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Capacidad insuficiente: {e.reason}",
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -88,31 +178,46 @@ def start_stream(
         )
 
 @router.post("/stop")
-def stop_stream(
-    stream_id: str,
-    db: Session = Depends(get_db),
-    current_user: str = Depends(verify_token)
+async def stop_stream(
+    lease_id: str,
+    current_user: str = Depends(verify_token),
+    stream_manager: StreamManager = Depends(get_stream_manager)
 ):
-    """Detener un stream HLS"""
+    """
+    Liberar el lease de un viewer (el proceso se detiene al salir el último viewer)
+    
+    Es idempotente: repetir la petición con el mismo lease no resta otro viewer.
+    """
     try:
-        # Detener el stream en el gestor
-        success = stream_manager.stop_hls(stream_id)
+        # Liberar el lease en el gestor
+        released = await stream_manager.release_stream(lease_id)
         
-        if not success:
+        if released is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
-                detail="Stream no encontrado o ya detenido"
+                detail="Lease no encontrado"
             )
         
-        # Actualizar estado en la base de datos
-        crud.stop_stream(db, stream_id)
+        stream_id, viewers = released
+        if viewers > 0:
+            return {
+                "stream_id": stream_id,
+                "lease_id": lease_id,
+                "status": "released",
+                "viewers": viewers,
+                "message": "Lease liberado, el stream sigue activo para otros viewers"
+            }
         
         return {
             "stream_id": stream_id,
+            "lease_id": lease_id,
             "status": "stopped",
+            "viewers": 0,
             "message": "Stream detenido correctamente"
         }
-        
+    
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -121,7 +226,8 @@ def stop_stream(
 
 @router.get("/active")
 def list_active_streams(
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    stream_manager: StreamManager = Depends(get_stream_manager)
 ):
     """Listar todos los streams activos"""
     try:
@@ -136,10 +242,44 @@ def list_active_streams(
             detail=f"Error obteniendo streams activos: {str(e)}"
         )
 
+@router.get("/select")
+def select_stream_variant(
+    device_id: int,
+    channel: int = Query(1, ge=1, le=64),
+    tile_width: int = Query(..., ge=16, le=7680, description="Ancho del tile en píxeles físicos"),
+    tile_height: int = Query(..., ge=16, le=4320, description="Alto del tile en píxeles físicos"),
+    tiles: int = Query(1, ge=1, le=256, description="Tiles visibles en la vista del operador"),
+    current_user: str = Depends(verify_token),
+    stream_manager: StreamManager = Depends(get_stream_manager)
+):
+    """
+    Variante (sub_stream) que corresponde a un tile, sin iniciar nada
+    
+    El cliente la consulta cuando cambia el tamaño del tile (maximizar o
+    restaurar). Si cambia, inicia la nueva variante, cambia el player cuando
+    puede reproducirla y solo entonces libera el lease anterior.
+    """
+    try:
+        resolutions = stream_manager.variant_resolutions([(device_id, channel)])[(device_id, channel)]
+        sub_stream = select_variant(resolutions, tile_width, tile_height, tiles)
+        width, height = resolutions[sub_stream]
+        return {
+            "device_id": device_id,
+            "channel": channel,
+            "sub_stream": sub_stream,
+            "resolution": f"{width}x{height}"
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error seleccionando la variante: {str(e)}"
+        )
+
 @router.get("/{stream_id}")
 def get_stream_info(
     stream_id: str,
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    stream_manager: StreamManager = Depends(get_stream_manager)
 ):
     """Obtener información de un stream específico"""
     try:
@@ -157,9 +297,21 @@ def get_stream_info(
             "started_at": stream_info["started_at"].isoformat(),
             "duration": stream_info["duration"],
             "rtsp_url": stream_info["rtsp_url"],
+            "viewers": stream_info["viewers"],
+            "owner": stream_info.get("owner", stream_manager.owner_id),
+            "supervised": stream_info.get("supervised"),
+            "restarts": stream_info.get("restarts", 0),
+            "stalls": stream_info.get("stalls", 0),
+            "last_exit_code": stream_info.get("last_exit_code"),
+            "profile": stream_info.get("profile"),
+            "retain": stream_info.get("retain", False),
+            "dvr_window": stream_info.get("dvr_window") if stream_info.get("retain") else None,
+            "latency_estimate_s": stream_manager.estimate_latency(stream_info),
+            "metrics": stream_info["drain"].metrics if "drain" in stream_info else None,
+            "recent_log": stream_info["drain"].tail(10) if "drain" in stream_info else [],
             "status": "active"
         }
-        
+    
     except HTTPException:
         raise
     except Exception as e:
@@ -168,9 +320,94 @@ def get_stream_info(
             detail=f"Error obteniendo información del stream: {str(e)}"
         )
 
+@router.post("/{stream_id}/retain")
+def set_stream_retain(
+    stream_id: str,
+    enabled: bool = Query(True, description="Activar o desactivar la retención"),
+    window: int = Query(DVR_WINDOW, ge=60, le=DVR_MAX_WINDOW, description="Ventana de time-shift en segundos"),
+    current_user: str = Depends(verify_token),
+    stream_manager: StreamManager = Depends(get_stream_manager)
+):
+    """
+    Activar o desactivar la retención (DVR) de un stream activo
+    
+    Con retención, cada segmento completo se copia en segundo plano a
+    almacenamiento persistente; sin ella, en modo memory los segmentos en
+    vivo nunca tocan el disco.
+    """
+    try:
+        if not stream_manager.set_retain(stream_id, enabled, window):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Stream no encontrado o ya detenido"
+            )
+        
+        return {
+            "stream_id": stream_id,
+            "retain": enabled,
+            "dvr_window": window if enabled else None,
+            "storage": stream_manager.storage,
+            "dvr_playlist_url": f"/hls/{stream_id}/dvr/{PLAYLIST_NAME}" if enabled else None
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error actualizando la retención del stream: {str(e)}"
+        )
+
+@router.get("/{stream_id}/dvr")
+def get_stream_dvr(
+    stream_id: str,
+    at: Optional[datetime] = Query(None, description="Buscar esta hora (UTC) en la ventana de time-shift"),
+    current_user: str = Depends(verify_token),
+    stream_manager: StreamManager = Depends(get_stream_manager)
+):
+    """
+    Ventana de time-shift disponible de un stream y búsqueda por hora
+    
+    Con `at` devuelve el segmento que contiene esa hora, el desplazamiento
+    dentro de él y la URL de una playlist que empieza exactamente ahí.
+    """
+    try:
+        index = stream_manager.get_dvr_index(stream_id)
+        if index is None or not index.segments:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="El stream no tiene time-shift"
+            )
+        
+        playlist_url = f"/hls/{stream_id}/dvr/{PLAYLIST_NAME}"
+        result = {
+            "stream_id": stream_id,
+            **index.get_info(),
+            "playlist_url": playlist_url
+        }
+        if at is not None:
+            i, offset = index.seek(to_epoch(at))
+            segment = index.segments[i]
+            result["seek"] = {
+                "segment": segment.name,
+                "media_sequence": segment.msn,
+                "offset_seconds": round(offset, 3),
+                "playlist_url": f"{playlist_url}?start={quote(at.isoformat())}"
+            }
+        return result
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error obteniendo el time-shift del stream: {str(e)}"
+        )
+
 @router.get("/stats/overview")
 def get_stream_stats(
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    stream_manager: StreamManager = Depends(get_stream_manager)
 ):
     """Obtener estadísticas de streams"""
     try:
@@ -183,53 +420,115 @@ def get_stream_stats(
         )
 
 @router.post("/bulk/start")
-def start_multiple_streams(
+async def start_multiple_streams(
     requests: List[dict],
+    stream: bool = Query(False, description="Devolver los resultados como NDJSON a medida que terminan"),
+    concurrency: int = Query(BULK_CONCURRENCY, ge=1, le=64, description="Procesos FFmpeg lanzados a la vez"),
     db: Session = Depends(get_db),
-    current_user: str = Depends(verify_token)
+    current_user: str = Depends(verify_token),
+    stream_manager: StreamManager = Depends(get_stream_manager)
 ):
-    """Iniciar múltiples streams simultáneamente"""
+    """
+    Iniciar múltiples streams simultáneamente
+    
+    Cada item se valida por separado (ver schemas.BulkStreamRequest): uno
+    inválido devuelve su error sin hacer fallar el lote. Las peticiones con `tile_width` y `tile_height` eligen la variante como
+    /streams/start; `tiles` es por defecto el número de peticiones (un
+    mosaico de 64 cámaras va por las sub-streams).
+    """
     results = []
+    items = []
     
-    for req in requests:
+    parsed = {}
+    for index, req in enumerate(requests):
         try:
-            device_id = req.get("device_id")
-            channel = req.get("channel", 1)
-            sub_stream = req.get("sub_stream", 0)
-            duration = req.get("duration", 3600)
-            
-            if not device_id:
-                results.append({
-                    "device_id": device_id,
-                    "status": "error",
-                    "message": "device_id es requerido"
-                })
-                continue
-            
-            # Iniciar stream individual
-            result = start_stream(
-                device_id=device_id,
-                channel=channel,
-                sub_stream=sub_stream,
-                duration=duration,
-                db=db,
-                current_user=current_user
-            )
-            
-            results.append({
-                "device_id": device_id,
-                "channel": channel,
-                "status": "success",
-                "stream_id": result["stream_id"],
-                "playlist_url": result["playlist_url"]
-            })
-            
-        except Exception as e:
+            parsed[index] = schemas.BulkStreamRequest(**req)
+        except ValidationError as e:
             results.append({
+                "index": index,
                 "device_id": req.get("device_id"),
                 "status": "error",
-                "message": str(e)
+                "message": _validation_message(e)
             })
+
+    # Todos los dispositivos en una sola consulta
+    device_ids = {req.device_id for req in parsed.values()}
+    devices = {device.id: device for device in await asyncio.to_thread(crud.get_devices_by_ids, db, list(device_ids))}
+
+    # Resoluciones de las variantes de los canales con selección automática, también en una consulta
+    auto_channels = [
+        (req.device_id, req.channel) for req in parsed.values()
+        if req.device_id in devices and req.tile_width is not None and req.tile_height is not None
+    ]
+    resolutions = await asyncio.to_thread(stream_manager.variant_resolutions, auto_channels) if auto_channels else {}
+    
+    for index, req in parsed.items():
+        device_id, channel, sub_stream, profile = req.device_id, req.channel, req.sub_stream, req.profile
+        if (device_id, channel) in resolutions:
+            sub_stream = select_variant(resolutions[(device_id, channel)], req.tile_width, req.tile_height,
+                                        req.tiles or min(len(requests), 256))
+        base = {"index": index, "device_id": device_id, "channel": channel, "sub_stream": sub_stream}
+        
+        device = devices.get(device_id)
+        if device is None:
+            message = "Dispositivo no encontrado"
+        elif not device.is_active:
+            message = "El dispositivo está inactivo"
+        elif profile not in HLS_PROFILES:
+            message = f"Perfil no soportado. Opciones: {', '.join(HLS_PROFILES)}"
+        else:
+            rtsp_url = build_rtsp_url(device, channel, sub_stream)
+            message = None if rtsp_url else "Marca de dispositivo no soportada"
+        
+        if message:
+            results.append({**base, "status": "error", "message": message})
+            continue
+        
+        items.append({
+            **base,
+            "profile": profile,
+            "rtsp_url": rtsp_url,
+            "duration": req.duration,
+            "supervised": req.supervised,
+            "retain": req.retain or req.dvr_window is not None,
+            "dvr_window": req.dvr_window or DVR_WINDOW
+        })
+    
+    items_by_index = {item["index"]: item for item in items}
+
+    def item_result(result: dict) -> dict:
+        """Resultado del gestor con los datos de la petición original"""
+        item = items_by_index[result["index"]]
+        entry = {
+            "index": item["index"],
+            "device_id": item["device_id"],
+            "channel": item["channel"],
+            "sub_stream": item["sub_stream"]
+        }
+        if result["status"] == "error":
+            entry.update(status="error", message=result["message"])
+        else:
+            entry.update(
+                status="success",
+                stream_status=result["status"],
+                stream_id=result["stream_id"],
+                lease_id=result["lease_id"],
+                playlist_url=result["playlist_url"]
+            )
+        return entry
+    
+    if stream:
+        async def ndjson():
+            for result in results:
+                yield json.dumps(result) + "\n"
+            async for result in stream_manager.acquire_streams(items, concurrency=concurrency):
+                yield json.dumps(item_result(result)) + "\n"
+        
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    
+    async for result in stream_manager.acquire_streams(items, concurrency=concurrency):
+        results.append(item_result(result))
+    results.sort(key=lambda r: r["index"])
     
     return {
         "total_requests": len(requests),
@@ -239,30 +538,54 @@ def start_multiple_streams(
     }
 
 @router.post("/bulk/stop")
-def stop_multiple_streams(
-    stream_ids: List[str],
-    current_user: str = Depends(verify_token)
+async def stop_multiple_streams(
+    ids: List[str],
+    force: bool = Query(False, description="Los ids son stream_ids y se detienen aunque tengan otros viewers"),
+    current_user: str = Depends(verify_token),
+    stream_manager: StreamManager = Depends(get_stream_manager)
 ):
-    """Detener múltiples streams simultáneamente"""
+    """
+    Liberar o detener múltiples streams simultáneamente
+    
+    Sin `force` los ids son los lease_ids devueltos por /streams/bulk/start
+    (o /streams/start) y se liberan como /streams/stop; con `force` son
+    stream_ids y los streams se detienen para todos sus viewers.
+    """
     results = []
     
-    for stream_id in stream_ids:
-        try:
-            success = stream_manager.stop_hls(stream_id)
-            results.append({
-                "stream_id": stream_id,
-                "status": "success" if success else "error",
-                "message": "Stream detenido" if success else "Stream no encontrado"
-            })
-        except Exception as e:
-            results.append({
-                "stream_id": stream_id,
-                "status": "error",
-                "message": str(e)
-            })
+    try:
+        if force:
+            stopped = await stream_manager.stop_streams(ids)
+            for stream_id in ids:
+                found = stopped.get(stream_id) != "not_found"
+                results.append({
+                    "stream_id": stream_id,
+                    "status": "success" if found else "error",
+                    "message": "Stream detenido" if found else "Stream no encontrado"
+                })
+        else:
+            released = await stream_manager.release_streams(ids)
+            for lease_id in ids:
+                if lease_id not in released:
+                    results.append({"lease_id": lease_id, "status": "error", "message": "Lease no encontrado"})
+                    continue
+                stream_id, viewers = released[lease_id]
+                results.append({
+                    "lease_id": lease_id,
+                    "stream_id": stream_id,
+                    "status": "success",
+                    "viewers": viewers,
+                    "message": "Lease liberado" if viewers > 0 else "Stream detenido"
+                })
+    
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error deteniendo streams: {str(e)}"
+        )
     
     return {
-        "total_streams": len(stream_ids),
+        "total_streams": len(ids),
         "successful": len([r for r in results if r["status"] == "success"]),
         "failed": len([r for r in results if r["status"] == "error"]),
         "results": results
@@ -1,12 +1,13 @@
 from pydantic import BaseModel, Field
 from typing import Optional, Dict, Any
 from datetime import datetime
+from .dvr import DVR_MAX_WINDOW
 
 # Device schemas
 class DeviceBase(BaseModel):
     name: str = Field(..., min_length=1, max_length=255)
-    brand: str = Field(..., regex="^(hikvision|dahua)$")
-    ip: str = Field(..., regex="^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$")
+    brand: str = Field(..., pattern="^(hikvision|dahua)$")
+    ip: str = Field(..., pattern="^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$")
     port: int = Field(default=80, ge=1, le=65535)
     username: str = Field(..., min_length=1, max_length=100)
     password: str = Field(..., min_length=1, max_length=255)
@@ -18,8 +19,8 @@ class DeviceCreate(DeviceBase):
 
 class DeviceUpdate(BaseModel):
     name: Optional[str] = Field(None, min_length=1, max_length=255)
-    brand: Optional[str] = Field(None, regex="^(hikvision|dahua)$")
-    ip: Optional[str] = Field(None, regex="^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$")
+    brand: Optional[str] = Field(None, pattern="^(hikvision|dahua)$")
+    ip: Optional[str] = Field(None, pattern="^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$")
     port: Optional[int] = Field(None, ge=1, le=65535)
     username: Optional[str] = Field(None, min_length=1, max_length=100)
     password: Optional[str] = Field(None, min_length=1, max_length=255)
@@ -38,11 +39,35 @@ class Device(DeviceBase):
 
 # Stream schemas
 class StreamCreate(BaseModel):
+    stream_id: Optional[str] = None
     device_id: int
     channel: int = Field(default=1, ge=1, le=64)
     sub_stream: int = Field(default=0, ge=0, le=1)
     rtsp_url: Optional[str] = None
     hls_url: Optional[str] = None
+    owner: Optional[str] = None
+    pid: Optional[int] = None
+    profile: str = "ts"
+    viewers: int = 1
+    retain: bool = False
+    dvr_window: Optional[int] = None
+    expires_at: Optional[datetime] = None
+
+class BulkStreamRequest(BaseModel):
+    """Item de /streams/bulk/start, con los mismos límites que /streams/start"""
+    device_id: int
+    channel: int = Field(default=1, ge=1, le=64)
+    sub_stream: int = Field(default=0, ge=0, le=1)
+    profile: str = "ts"
+    duration: int = Field(default=3600, ge=60, le=86400)
+    supervised: bool = True
+    retain: bool = False
+    dvr_window: Optional[int] = Field(default=None, ge=60, le=DVR_MAX_WINDOW)
+    # Tamaño del tile en píxeles físicos: con ambos se elige sub_stream automáticamente
+    tile_width: Optional[int] = Field(default=None, ge=16, le=7680)
+    tile_height: Optional[int] = Field(default=None, ge=16, le=4320)
+    # Tiles visibles en la vista; por defecto, el número de items del lote
+    tiles: Optional[int] = Field(default=None, ge=1, le=256)
 
 class Stream(BaseModel):
     id: int
@@ -55,6 +80,14 @@ class Stream(BaseModel):
     is_active: bool
     started_at: datetime
     stopped_at: Optional[datetime]
+    owner: Optional[str]
+    pid: Optional[int]
+    viewers: int
+    profile: Optional[str]
+    retain: Optional[bool]
+    dvr_window: Optional[int]
+    expires_at: Optional[datetime]
+    media_info: Optional[dict]
 
     class Config:
         from_attributes = True
@@ -67,7 +100,7 @@ class RecordingCreate(BaseModel):
     end_time: datetime
     file_path: Optional[str] = None
     file_size: Optional[int] = None
-    recording_type: str = Field(default="normal", regex="^(normal|alarm|motion)$")
+    recording_type: str = Field(default="normal", pattern="^(normal|alarm|motion)$")
     meta: Optional[Dict[str, Any]] = Field(default={})
 
 class Recording(BaseModel):
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, TypeVar
+
+logger = logging.getLogger(__name__)
+
+# Hilos dedicados por fabricante para las llamadas bloqueantes de ctypes
+SDK_WORKERS = int(os.getenv("SDK_WORKERS_PER_VENDOR", "8"))
+# Tiempo máximo de una llamada al SDK desde el punto de vista de la petición
+SDK_CALL_TIMEOUT = float(os.getenv("SDK_CALL_TIMEOUT", "15"))
+# Timeout de conexión TCP de los SDK (NET_DVR_SetConnectTime / CLIENT_SetConnectTime)
+SDK_CONNECT_TIMEOUT_MS = int(os.getenv("SDK_CONNECT_TIMEOUT_MS", "3000"))
+SDK_CONNECT_TRIES = int(os.getenv("SDK_CONNECT_TRIES", "1"))
+
+T = TypeVar("T")
+
+class SDKTimeoutError(TimeoutError):
+    """La llamada al SDK no terminó dentro del tiempo de la petición"""
+
+class SDKExecutor:
+    """
+    Pool de hilos acotado para las llamadas bloqueantes de un fabricante
+    
+    Las llamadas de ctypes (login, búsquedas...) pueden bloquear hasta el
+    timeout TCP de una cámara inaccesible. Ejecutarlas aquí, y no en el
+    threadpool por defecto de Starlette, evita que unos pocos dispositivos
+    lentos dejen sin hilos al resto de la API. Una llamada que excede su
+    timeout se abandona (o se cancela si aún no había empezado) y la petición
+    recibe SDKTimeoutError.
+    """
+    def __init__(self, vendor: str, workers: int = SDK_WORKERS):
+        self.vendor = vendor
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"sdk-{vendor}")
+        self.pending = 0
+        self.timeouts = 0
+
+    async def run(self, fn: Callable[..., T], *args: Any, timeout: float = SDK_CALL_TIMEOUT) -> T:
+        """Ejecutar `fn(*args)` en un hilo del fabricante con timeout"""
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, fn, *args)
+        self.pending += 1
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning(f"Llamada al SDK {self.vendor} excedió {timeout}s")
+            raise SDKTimeoutError(f"El dispositivo no respondió en {timeout:g}s")
+        finally:
+            self.pending -= 1
+
+    def submit(self, fn: Callable[..., Any], *args: Any):
+        """Encolar `fn(*args)` sin esperar el resultado (limpiezas)"""
+        return self._executor.submit(fn, *args)
+
+    def shutdown(self):
+        """Descartar las llamadas en cola y no esperar a las que están en curso"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> Dict:
+        return {"workers": self.workers, "pending": self.pending, "timeouts": self.timeouts}
+
+# Un executor por fabricante, creado al primer uso
+_executors: Dict[str, SDKExecutor] = {}
+
+def get_executor(vendor: str) -> SDKExecutor:
+    executor = _executors.get(vendor)
+    if executor is None:
+        executor = _executors[vendor] = SDKExecutor(vendor)
+    return executor
+
+def shutdown_executors():
+    """Cerrar los executors de SDK (lifespan de la aplicación)"""
+    for executor in _executors.values():
+        executor.shutdown()
+    _executors.clear()
+
+def get_executor_stats() -> Dict[str, Dict]:
+    return {vendor: executor.get_stats() for vendor, executor in _executors.items()}
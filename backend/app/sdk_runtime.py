@@ -0,0 +1,86 @@
+import threading
+import logging
+from ctypes import cdll
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+class SDKRuntime:
+    """
+    Librería de un fabricante cargada e inicializada una sola vez por proceso
+    
+    Las instancias de HikvisionSDK/DahuaSDK son handles ligeros que toman una
+    referencia al runtime (`acquire`) y la sueltan al cerrarse (`release`).
+    La limpieza global del SDK (NET_DVR_Cleanup / CLIENT_Cleanup) solo se hace
+    en `shutdown`, desde el lifespan de la aplicación, y se aplaza hasta que
+    se suelta el último handle: una petición en curso nunca ve el SDK
+    desinicializado por otra.
+    """
+    def __init__(self, name: str, path: str,
+                 setup: Callable, init: Callable, cleanup: Callable):
+        self.name = name
+        self.path = path
+        self._setup = setup
+        self._init = init
+        self._cleanup = cleanup
+        self._lock = threading.Lock()
+        self._lib = None
+        self._refs = 0
+        self._closing = False
+        RUNTIMES.append(self)
+
+    def acquire(self):
+        """Obtener la librería inicializada (cargándola la primera vez)"""
+        with self._lock:
+            if self._lib is None:
+                lib = cdll.LoadLibrary(self.path)
+                self._setup(lib)
+                self._init(lib)
+                self._lib = lib
+                self._closing = False
+                logger.info(f"SDK {self.name} cargado desde {self.path}")
+            self._refs += 1
+            return self._lib
+
+    def release(self):
+        """Soltar una referencia; limpia el SDK si se pidió el cierre y era la última"""
+        with self._lock:
+            self._refs = max(0, self._refs - 1)
+            if self._closing and self._refs == 0:
+                self._cleanup_locked()
+
+    def shutdown(self):
+        """Limpiar el SDK ahora o, si hay handles vivos, al soltarse el último"""
+        with self._lock:
+            if self._lib is None:
+                return
+            self._closing = True
+            if self._refs == 0:
+                self._cleanup_locked()
+            else:
+                logger.warning(f"SDK {self.name} con {self._refs} handles activos, limpieza aplazada")
+
+    @property
+    def loaded(self) -> bool:
+        return self._lib is not None
+
+    @property
+    def refs(self) -> int:
+        return self._refs
+
+    def _cleanup_locked(self):
+        lib, self._lib = self._lib, None
+        self._closing = False
+        try:
+            self._cleanup(lib)
+            logger.info(f"SDK {self.name} liberado")
+        except Exception as e:
+            logger.error(f"Error liberando SDK {self.name}: {e}")
+
+# Runtimes registrados (uno por fabricante)
+RUNTIMES: List[SDKRuntime] = []
+
+def shutdown_runtimes():
+    """Liberar todos los SDK cargados (lifespan de la aplicación)"""
+    for runtime in RUNTIMES:
+        runtime.shutdown()
@@ -0,0 +1,374 @@
+import asyncio
+import os
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from itertools import islice
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+from fastapi import Request
+from . import hikvision_sdk, dahua_sdk
+from .sdk_executor import SDK_CALL_TIMEOUT, get_executor
+
+logger = logging.getLogger(__name__)
+
+# Segundos que una sesión puede estar sin usarse antes de cerrarla
+SESSION_IDLE_TTL = int(os.getenv("SDK_SESSION_IDLE_TTL", "300"))
+# Una sesión reutilizada se comprueba contra el dispositivo si no se usó en este tiempo
+SESSION_CHECK_INTERVAL = int(os.getenv("SDK_SESSION_CHECK_INTERVAL", "60"))
+# Sesiones simultáneas por dispositivo (los NVR limitan los usuarios conectados)
+MAX_SESSIONS_PER_DEVICE = int(os.getenv("SDK_MAX_SESSIONS_PER_DEVICE", "2"))
+# Espera máxima por una sesión libre cuando el dispositivo está al límite
+SESSION_WAIT_TIMEOUT = float(os.getenv("SDK_SESSION_WAIT_TIMEOUT", "30"))
+# Intervalo del reaper de sesiones ociosas
+REAPER_INTERVAL = 30
+
+# SDK y códigos de error de sesión por marca
+VENDORS = {
+    "hikvision": (hikvision_sdk.HikvisionSDK, hikvision_sdk.SESSION_ERROR_CODES),
+    "dahua": (dahua_sdk.DahuaSDK, dahua_sdk.SESSION_ERROR_CODES)
+}
+
+T = TypeVar("T")
+
+class DeviceSession:
+    """Sesión autenticada (user_id) contra un dispositivo"""
+    def __init__(self, sdk, user_id: int, device_info: Dict):
+        self.sdk = sdk
+        self.user_id = user_id
+        self.device_info = device_info
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.in_use = False
+
+class _PageReader:
+    """Generador del SDK con su sesión tomada, leído por páginas desde el executor"""
+    def __init__(self, pool: "SDKSessionPool", device, fn: Callable[[Any, int], Iterator]):
+        self.pool = pool
+        self.device = device
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._context = None
+        self._session: Optional[DeviceSession] = None
+        self._records: Optional[Iterator] = None
+        self._closed = False
+
+    def open(self):
+        context = self.pool.session(self.device)
+        session = context.__enter__()
+        with self._lock:
+            if not self._closed:
+                self._context, self._session = context, session
+                self._records = self.fn(session.sdk, session.user_id)
+                return
+        # Cerrado mientras se hacía login (timeout de la petición)
+        context.__exit__(None, None, None)
+
+    def next_page(self, size: int) -> List:
+        with self._lock:
+            if self._records is None:
+                return []
+            try:
+                return list(islice(self._records, size))
+            except Exception as e:
+                _, error_codes = VENDORS[self.device.brand]
+                error_code = getattr(e, "error_code", None)
+                if error_code is None:
+                    error_code = _last_error(self._session.sdk)
+                if error_code in error_codes:
+                    # Sesión inválida: se descarta al liberarla
+                    self.pool._logout(self._session)
+                raise
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            records, context = self._records, self._context
+            self._records = self._context = self._session = None
+        try:
+            if records is not None:
+                records.close()
+        except Exception as e:
+            logger.error(f"Error cerrando búsqueda en {self.device.ip}: {e}")
+        finally:
+            if context is not None:
+                context.__exit__(None, None, None)
+
+class SDKSessionPool:
+    """
+    Pool de sesiones de los SDK de fabricante por dispositivo
+    
+    Mantiene los `user_id` de login abiertos entre peticiones: el login
+    (300-2000 ms) solo se paga la primera vez o tras un error de sesión. Las
+    sesiones ociosas se cierran pasado SESSION_IDLE_TTL, una sesión que lleva
+    tiempo sin usarse se comprueba contra el dispositivo antes de reutilizarla
+    y una llamada que falla con un código de sesión inválida se repite una
+    vez con un login nuevo.
+    
+    Las llamadas al SDK se ejecutan en los hilos del executor de cada
+    fabricante (`acall`), así que el pool se protege con un lock de threading.
+    """
+    def __init__(self):
+        self._lock = threading.Condition()
+        # (device_id, brand, ip, port, username, password) -> sesiones
+        self._sessions: Dict[Tuple, List[DeviceSession]] = {}
+        # Una instancia de SDK por marca, compartida por todas las sesiones
+        self._sdks: Dict[str, Any] = {}
+        self._reaper_task: Optional[asyncio.Task] = None
+        # Llamadas en curso por dispositivo: un dispositivo lento no acapara los hilos del fabricante
+        self._device_slots: Dict[int, asyncio.Semaphore] = {}
+        self.logins = 0
+        self.reuses = 0
+        self.relogins = 0
+
+    async def start(self):
+        """Iniciar el cierre periódico de sesiones ociosas"""
+        if self._reaper_task is None or self._reaper_task.done():
+            self._reaper_task = asyncio.create_task(self._reap_loop())
+
+    async def shutdown(self):
+        """Detener el reaper y cerrar todas las sesiones"""
+        if self._reaper_task is not None:
+            self._reaper_task.cancel()
+            try:
+                await self._reaper_task
+            except asyncio.CancelledError:
+                pass
+            self._reaper_task = None
+        await asyncio.to_thread(self.close_all)
+
+    @staticmethod
+    def supports(brand: str) -> bool:
+        return brand in VENDORS
+
+    def call(self, device, fn: Callable[[Any, int], T]) -> T:
+        """
+        Ejecutar `fn(sdk, user_id)` con una sesión del pool
+        
+        Si falla con un código que invalida la sesión, se descarta la sesión,
+        se hace login de nuevo y se reintenta una vez.
+        """
+        _, error_codes = VENDORS[device.brand]
+        for attempt in range(2):
+            with self.session(device) as session:
+                try:
+                    return fn(session.sdk, session.user_id)
+                except Exception as e:
+                    error_code = getattr(e, "error_code", None)
+                    if error_code is None:
+                        error_code = _last_error(session.sdk)
+                    if attempt == 0 and error_code in error_codes:
+                        logger.warning(f"Sesión de {device.ip} inválida (error {error_code}), reintentando con login nuevo")
+                        # Sin user_id la sesión se descarta al liberarla
+                        self._logout(session)
+                        self.relogins += 1
+                        continue
+                    raise
+
+    async def acall(self, device, fn: Callable[[Any, int], T], timeout: float = SDK_CALL_TIMEOUT) -> T:
+        """Versión async de `call`: se ejecuta en el executor del fabricante con timeout"""
+        async with self._device_slot(device):
+            return await get_executor(device.brand).run(self.call, device, fn, timeout=timeout)
+
+    async def device_info(self, device, verify: bool = False, timeout: float = SDK_CALL_TIMEOUT) -> Dict:
+        """Información del dispositivo obtenida en el login de una sesión del pool"""
+        def read_info():
+            with self.session(device, verify=verify) as session:
+                return session.device_info
+        
+        async with self._device_slot(device):
+            return await get_executor(device.brand).run(read_info, timeout=timeout)
+
+    async def aiter_pages(self, device, fn: Callable[[Any, int], Iterator[T]], page_size: int,
+                          timeout: float = SDK_CALL_TIMEOUT) -> AsyncIterator[List[T]]:
+        """
+        Recorrer por páginas el generador `fn(sdk, user_id)` en el executor del fabricante
+        
+        La sesión (y el handle de búsqueda del SDK) quedan tomados mientras
+        dure el recorrido; cada página es una llamada al executor con su propio
+        timeout. Cerrar el generador async (aclose) libera la sesión.
+        """
+        executor = get_executor(device.brand)
+        reader = _PageReader(self, device, fn)
+        async with self._device_slot(device):
+            try:
+                await executor.run(reader.open, timeout=timeout)
+                while True:
+                    page = await executor.run(reader.next_page, page_size, timeout=timeout)
+                    if not page:
+                        return
+                    yield page
+                    if len(page) < page_size:
+                        return
+            finally:
+                # En el executor: espera a que termine una página abandonada por timeout
+                executor.submit(reader.close)
+
+    def _device_slot(self, device) -> asyncio.Semaphore:
+        # Tantas llamadas simultáneas como sesiones: el resto espera en el event loop, no en un hilo
+        slot = self._device_slots.get(device.id)
+        if slot is None:
+            slot = self._device_slots[device.id] = asyncio.Semaphore(MAX_SESSIONS_PER_DEVICE)
+        return slot
+
+    @contextmanager
+    def session(self, device, verify: bool = False):
+        """
+        Tomar una sesión del dispositivo (reutilizada o nueva)
+        
+        Args:
+            device: Dispositivo (modelo Device)
+            verify: Comprobar la sesión contra el dispositivo aunque sea reciente
+        """
+        session = self._acquire(device, verify)
+        try:
+            yield session
+        finally:
+            self._release(device, session)
+
+    def _acquire(self, device, verify: bool) -> DeviceSession:
+        key = _device_key(device)
+        deadline = time.monotonic() + SESSION_WAIT_TIMEOUT
+        with self._lock:
+            while True:
+                sessions = self._sessions.setdefault(key, [])
+                idle = [s for s in sessions if not s.in_use]
+                if idle:
+                    session = max(idle, key=lambda s: s.last_used)
+                    session.in_use = True
+                    break
+                if len(sessions) < MAX_SESSIONS_PER_DEVICE:
+                    session = None
+                    # Reservar el hueco mientras se hace login fuera del lock
+                    placeholder = DeviceSession(None, None, {})
+                    placeholder.in_use = True
+                    sessions.append(placeholder)
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Sin sesiones libres para el dispositivo {device.ip}")
+                self._lock.wait(remaining)
+        
+        if session is not None:
+            stale = time.monotonic() - session.last_used >= SESSION_CHECK_INTERVAL
+            if not (verify or stale) or session.sdk.check_session(session.user_id):
+                self.reuses += 1
+                return session
+            logger.info(f"Sesión {session.user_id} de {device.ip} caducada, nuevo login")
+            self._logout(session)
+            placeholder = session
+        
+        try:
+            sdk = self._get_sdk(device.brand)
+            result = sdk.login(device.ip, device.port, device.username, device.password)
+        except Exception:
+            with self._lock:
+                if placeholder in self._sessions.get(key, []):
+                    self._sessions[key].remove(placeholder)
+                self._lock.notify()
+            raise
+        
+        self.logins += 1
+        placeholder.sdk = sdk
+        placeholder.user_id = result["user_id"]
+        placeholder.device_info = result.get("device_info", {})
+        placeholder.created_at = placeholder.last_used = time.monotonic()
+        return placeholder
+
+    def _release(self, device, session: DeviceSession):
+        key = _device_key(device)
+        with self._lock:
+            if session.user_id is None:
+                # Sesión invalidada durante la llamada: descartarla
+                if session in self._sessions.get(key, []):
+                    self._sessions[key].remove(session)
+            else:
+                session.last_used = time.monotonic()
+                session.in_use = False
+            self._lock.notify()
+
+    def _get_sdk(self, brand: str):
+        with self._lock:
+            sdk = self._sdks.get(brand)
+            if sdk is None:
+                sdk_class, _ = VENDORS[brand]
+                sdk = self._sdks[brand] = sdk_class()
+            return sdk
+
+    def _logout(self, session: DeviceSession):
+        if session.sdk is not None and session.user_id is not None:
+            session.sdk.logout(session.user_id)
+        session.user_id = None
+
+    def invalidate(self, device_id: int):
+        """Cerrar las sesiones libres de un dispositivo (p.ej. tras cambiar sus credenciales)"""
+        with self._lock:
+            closing = []
+            for key, sessions in self._sessions.items():
+                if key[0] != device_id:
+                    continue
+                closing += [s for s in sessions if not s.in_use]
+                sessions[:] = [s for s in sessions if s.in_use]
+        for session in closing:
+            self._logout(session)
+
+    def reap(self):
+        """Cerrar las sesiones ociosas más allá de SESSION_IDLE_TTL"""
+        now = time.monotonic()
+        with self._lock:
+            expired = []
+            for key in list(self._sessions):
+                sessions = self._sessions[key]
+                expired += [s for s in sessions if not s.in_use and now - s.last_used >= SESSION_IDLE_TTL]
+                sessions[:] = [s for s in sessions if s.in_use or now - s.last_used < SESSION_IDLE_TTL]
+                if not sessions:
+                    del self._sessions[key]
+        for session in expired:
+            logger.info(f"Cerrando sesión ociosa {session.user_id}")
+            self._logout(session)
+
+    def close_all(self):
+        """Cerrar todas las sesiones libres y soltar los handles de SDK"""
+        with self._lock:
+            sessions = [s for group in self._sessions.values() for s in group if not s.in_use]
+            self._sessions.clear()
+            sdks = list(self._sdks.values())
+            self._sdks.clear()
+        for session in sessions:
+            self._logout(session)
+        for sdk in sdks:
+            sdk.close()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            sessions = [s for group in self._sessions.values() for s in group if s.user_id is not None]
+            return {
+                "devices": len(self._sessions),
+                "sessions": len(sessions),
+                "in_use": len([s for s in sessions if s.in_use]),
+                "logins": self.logins,
+                "reuses": self.reuses,
+                "relogins": self.relogins
+            }
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(REAPER_INTERVAL)
+            try:
+                await asyncio.to_thread(self.reap)
+            except Exception as e:
+                logger.error(f"Error cerrando sesiones ociosas: {e}")
+
+def _device_key(device) -> Tuple:
+    # Las credenciales forman parte de la clave: al editarlas se abre una sesión nueva
+    return (device.id, device.brand, device.ip, device.port, device.username, device.password)
+
+def _last_error(sdk) -> Optional[int]:
+    try:
+        return sdk.last_error()
+    except Exception:
+        return None
+
+def get_sdk_sessions(request: Request) -> SDKSessionPool:
+    """Dependencia de FastAPI: pool de sesiones de la aplicación"""
+    return request.app.state.sdk_sessions
@@ -1,29 +1,617 @@
-import subprocess
+import asyncio
 import os
-import shlex
-import uuid
-import threading
+import random
+import re
+import shutil
+import signal
+import socket
 import time
+import uuid
 import logging
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
+from fastapi import Request
+from sqlalchemy.exc import IntegrityError
+from .database import SessionLocal
+from . import crud, schemas
+from .ffmpeg_drain import FFmpegDrain
+from .admission import AdmissionController, AdmissionRejected, QUEUE_TIMEOUT
+from .hls_cache import HLSCache
+from .dvr import DVRIndex, DVR_WINDOW, INDEX_NAME, segment_duration
 
 logger = logging.getLogger(__name__)
 
 HLS_ROOT = os.getenv("HLS_ROOT", "/var/www/hls")
 FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
 
+# Almacenamiento de los segmentos en vivo
+#   disk: FFmpeg escribe directamente en HLS_ROOT
+#   memory: FFmpeg escribe en HLS_LIVE_ROOT (tmpfs) y solo los segmentos de
+#           streams con retención se copian a HLS_ROOT en segundo plano
+HLS_STORAGE_MODES = ("disk", "memory")
+HLS_STORAGE = os.getenv("HLS_STORAGE", "disk")
+HLS_LIVE_ROOT = os.getenv("HLS_LIVE_ROOT", "/dev/shm/vms-hls")
+# Memoria máxima del directorio en vivo de cada stream (modo memory)
+HLS_LIVE_MAX_BYTES = int(os.getenv("HLS_LIVE_MAX_BYTES", str(64 * 1024 ** 2)))
+# Subdirectorio de HLS_ROOT/<stream_id> con los segmentos retenidos (DVR)
+HLS_SPILL_DIR = "dvr"
+# Copias simultáneas a almacenamiento persistente
+HLS_SPILL_CONCURRENCY = int(os.getenv("HLS_SPILL_CONCURRENCY", "4"))
+# Segundos que se conservan los segmentos retenidos de streams ya detenidos
+# (en los activos manda la ventana de time-shift, ver dvr.py)
+HLS_SPILL_RETENTION = int(os.getenv("HLS_SPILL_RETENTION", "1800"))
+
+# Intervalo del supervisor (expiración de streams y limpieza de directorios)
+SUPERVISOR_INTERVAL = int(os.getenv("STREAM_SUPERVISOR_INTERVAL", "60"))
+# Segundos de espera tras SIGTERM antes de forzar SIGKILL
+STOP_TIMEOUT = 5
+# Heartbeat de los streams propios en la tabla compartida `streams`
+HEARTBEAT_INTERVAL = int(os.getenv("STREAM_HEARTBEAT_INTERVAL", "10"))
+# Un worker sin heartbeat durante este tiempo se considera caído
+HEARTBEAT_TTL = int(os.getenv("STREAM_HEARTBEAT_TTL", "30"))
+
+# Duración de cada segmento HLS en segundos (perfil por defecto)
+HLS_TIME = 4
+# Segmentos en la playlist en vivo (perfil por defecto)
+HLS_LIST_SIZE = 5
+# Perfiles de salida HLS
+#   ts: MPEG-TS clásico, máxima compatibilidad
+#   ll: fMP4/CMAF con segmentos de 1s para baja latencia (PTZ). Con `-c:v copy` FFmpeg
+#       solo corta en keyframes, así que el GOP de la cámara debe ser <= 1s
+# hold_back: segmentos que el player mantiene por detrás del borde en vivo (liveSyncDurationCount de hls.js)
+# program_date_time permite a hls.js alinear las variantes main/sub de un canal (ABR)
+HLS_PROFILES = {
+    "ts": {
+        "hls_time": HLS_TIME,
+        "list_size": HLS_LIST_SIZE,
+        "segment_type": "mpegts",
+        "extension": "ts",
+        "flags": ["program_date_time"],
+        "hold_back": 3
+    },
+    "ll": {
+        "hls_time": 1,
+        "list_size": 6,
+        "segment_type": "fmp4",
+        "extension": "m4s",
+        "flags": ["independent_segments", "program_date_time"],
+        "hold_back": 1
+    }
+}
+DEFAULT_PROFILE = "ts"
+# Variantes ABR de un canal: sub_stream -> BANDWIDTH (bps) hasta tener segmentos medidos
+ABR_VARIANTS = {0: 4000000, 1: 512000}
+# Resolución nominal de cada variante hasta que el stream está activo y se mide la real
+VARIANT_RESOLUTIONS = {0: (1920, 1080), 1: (640, 360)}
+# Píxeles que decodifica el navegador como máximo en una vista (cuatro 1080p): en vistas
+# con muchos tiles cada uno recibe la parte proporcional y se fuerza la variante barata
+LIVE_DECODE_BUDGET = int(os.getenv("LIVE_DECODE_BUDGET", str(4 * 1920 * 1080)))
+# Escalado máximo del vídeo en el tile que se acepta antes de pasar a la variante mayor
+VARIANT_UPSCALE = 1.25
+# Un cambio de bitrate menor que esta fracción no se vuelve a publicar en la tabla compartida
+MEDIA_INFO_TOLERANCE = 0.1
+# Línea de log de FFmpeg al abrir un archivo de salida
+_OPENING_RE = re.compile(r"Opening '(?P<path>[^']+)' for writing")
+# Vídeo de entrada: "Stream #0:0: Video: h264 (Main), yuv420p(progressive), 1920x1080, 25 fps, ..."
+_VIDEO_RE = re.compile(
+    r"Stream #0:\d+.*?: Video: (?P<codec>\w+).*?, (?P<width>\d{2,5})x(?P<height>\d{2,5})"
+    r"(?:.*?, (?P<fps>[\d.]+) fps)?"
+)
+# Un stream sin segmentos nuevos durante N x HLS_TIME se considera atascado
+STALL_SEGMENTS = int(os.getenv("STREAM_STALL_SEGMENTS", "3"))
+# Backoff exponencial con jitter para reinicios de FFmpeg (segundos)
+RESTART_BACKOFF_BASE = float(os.getenv("STREAM_RESTART_BACKOFF_BASE", "1"))
+RESTART_BACKOFF_MAX = float(os.getenv("STREAM_RESTART_BACKOFF_MAX", "60"))
+# Un proceso que sobrevive este tiempo reinicia el contador de backoff
+RESTART_RESET_AFTER = 60
+# Lanzamientos de FFmpeg simultáneos en un arranque masivo
+BULK_CONCURRENCY = int(os.getenv("STREAM_BULK_CONCURRENCY", "16"))
+# Segundos que se conservan los leases liberados: repetir /streams/stop dentro
+# de este plazo no resta otro viewer
+LEASE_RETENTION = int(os.getenv("STREAM_LEASE_RETENTION", "3600"))
+
 class StreamManager:
-    def __init__(self):
+    """
+    Gestor de streams HLS de la aplicación
+    
+    Cada worker de uvicorn tiene una única instancia (ver `get_stream_manager`)
+    que supervisa sus propios procesos FFmpeg. La tabla `streams` actúa como
+    estado compartido entre workers: cada fila activa pertenece a un worker
+    ("host:pid") y guarda el PID de FFmpeg y el número de viewers, de modo que
+    la deduplicación, los contadores y la limpieza son correctos aunque los
+    viewers de un mismo canal lleguen a workers distintos.
+    """
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self.host = socket.gethostname()
+        self.owner_id = f"{self.host}:{os.getpid()}"
         self.hls_root = Path(HLS_ROOT)
         self.hls_root.mkdir(parents=True, exist_ok=True)
-        self.processes: Dict[str, subprocess.Popen] = {}
+        if HLS_STORAGE not in HLS_STORAGE_MODES:
+            raise ValueError(f"HLS_STORAGE desconocido: {HLS_STORAGE}")
+        self.storage = HLS_STORAGE
+        # Directorio de trabajo de FFmpeg: en modo memory, tmpfs fuera de HLS_ROOT
+        self.live_root = Path(HLS_LIVE_ROOT) if self.storage == "memory" else self.hls_root
+        self.live_root.mkdir(parents=True, exist_ok=True)
+        self.processes: Dict[str, asyncio.subprocess.Process] = {}
         self.stream_info: Dict[str, Dict] = {}
-        self.cleanup_thread = threading.Thread(target=self._cleanup_old_streams, daemon=True)
-        self.cleanup_thread.start()
+        # Registro de streams compartidos: (device_id, channel, sub_stream, profile) -> stream_id
+        self.stream_keys: Dict[Tuple[int, int, int, str], str] = {}
+        # Canales que un arranque masivo está lanzando fuera del lock; se avisa al registrarlos
+        self._launching: Dict[Tuple[int, int, int, str], asyncio.Event] = {}
+        self._lock = asyncio.Lock()
+        # Tareas que esperan la salida de cada proceso FFmpeg
+        self._watchers: Dict[str, asyncio.Task] = {}
+        self._supervisor_task: Optional[asyncio.Task] = None
+        self.admission = AdmissionController(self)
+        # Playlists y segmentos en memoria para servir /hls sin leer el disco por viewer
+        self.hls_cache = HLSCache(self.live_root)
+        # Copias de segmentos retenidos a almacenamiento persistente
+        self._spill_slots = asyncio.Semaphore(HLS_SPILL_CONCURRENCY)
+        self.spilled_segments = 0
+        self.spilled_bytes = 0
+        self.spill_failures = 0
+        # Índices de time-shift de streams de otros workers leídos del disco
+        self._dvr_readers: "OrderedDict[str, DVRIndex]" = OrderedDict()
+
+    async def start(self):
+        """Iniciar el supervisor de streams en el event loop actual"""
+        if self._supervisor_task is None or self._supervisor_task.done():
+            self._supervisor_task = asyncio.create_task(self._supervise())
+            logger.info("Supervisor de streams iniciado")
+
+    async def shutdown(self):
+        """Detener el supervisor y todos los streams activos"""
+        if self._supervisor_task is not None:
+            self._supervisor_task.cancel()
+            try:
+                await self._supervisor_task
+            except asyncio.CancelledError:
+                pass
+            self._supervisor_task = None
+        
+        await self.stop_streams(list(self.processes.keys()))
+        logger.info("Supervisor de streams detenido")
+
+    async def acquire_stream(self, device_id: int, channel: int, sub_stream: int, rtsp_url: str,
+                             duration: int = 3600, supervised: bool = True,
+                             profile: str = DEFAULT_PROFILE,
+                             queue_timeout: float = QUEUE_TIMEOUT,
+                             retain: bool = False, dvr_window: int = DVR_WINDOW) -> Tuple[str, str, bool, str]:
+        """
+        Obtener un lease sobre el stream de (device_id, channel, sub_stream, profile)
+        
+        El primer viewer inicia el proceso FFmpeg; los siguientes se adjuntan
+        a la playlist HLS existente y solo incrementan el contador de viewers.
+        Cada llamada registra un lease propio en la tabla compartida: el
+        viewer lo libera con `release_stream(lease_id)`.
+        Antes de lanzar un FFmpeg nuevo se pasa por el control de admisión: sin
+        capacidad la petición espera en cola hasta `queue_timeout` y después se
+        rechaza con AdmissionRejected.
+        
+        Args:
+            device_id: ID del dispositivo
+            channel: Canal del dispositivo
+            sub_stream: Sub-stream (0=main, 1=sub)
+            rtsp_url: URL RTSP de origen
+            duration: Duración en segundos del lease; un stream compartido dura
+                hasta el plazo más lejano pedido por sus viewers
+            supervised: Reiniciar FFmpeg automáticamente si cae o se atasca
+            profile: Perfil de salida HLS (ver HLS_PROFILES)
+            queue_timeout: Segundos de espera en cola si no hay capacidad
+            retain: Retener los segmentos (DVR); en un stream ya activo se activa sin reiniciarlo
+            dvr_window: Ventana de time-shift en segundos de los segmentos retenidos
+        
+        Returns:
+            Tuple (stream_id, playlist_url, created, lease_id)
+        """
+        key = (device_id, channel, sub_stream, profile)
+        deadline = time.monotonic() + queue_timeout
+        lease_id = uuid.uuid4().hex
+        
+        while True:
+            async with self._lock:
+                acquired = await self._acquire_locked(key, lease_id, rtsp_url, duration, supervised, retain, dvr_window)
+            if isinstance(acquired, asyncio.Event):
+                # Un arranque masivo está lanzando este canal: adjuntarse cuando termine
+                await acquired.wait()
+                continue
+            if not isinstance(acquired, AdmissionRejected):
+                if retain and not acquired[2]:
+                    self.set_retain(acquired[0], True, dvr_window)
+                return (*acquired, lease_id)
+            
+            # Sin capacidad: esperar en cola (fuera del lock) y reintentar
+            await self.admission.wait(acquired, deadline)
+
+    async def _acquire_locked(self, key: Tuple[int, int, int, str], lease_id: str, rtsp_url: str,
+                              duration: int, supervised: bool, retain: bool = False,
+                              dvr_window: int = DVR_WINDOW):
+        """Adjuntarse o iniciar el stream de `key` con el lock tomado, registrando `lease_id`"""
+        device_id, channel, sub_stream, profile = key
+        
+        launching = self._launching.get(key)
+        if launching is not None:
+            return launching
+        
+        existing = self._attach_existing(key, duration, [lease_id])
+        if existing:
+            return existing[0], existing[1], False
+        
+        # Un FFmpeg nuevo solo se lanza si cabe en los presupuestos
+        rejection = self.admission.check(device_id)
+        if rejection is not None:
+            return rejection
+        self.admission.admitted += 1
+        
+        stream_id, playlist_url = await self.start_hls(
+            rtsp_url, duration=duration, supervised=supervised, profile=profile,
+            retain=retain, dvr_window=dvr_window
+        )
+        self.stream_info[stream_id]["key"] = key
+        self.stream_keys[key] = stream_id
+        
+        if not self._register_stream(stream_id, [lease_id]):
+            # Otro worker registró el mismo canal primero: usar el suyo
+            shared = await self._yield_to_shared(stream_id, key, [lease_id], duration=duration)
+            return shared[0], shared[1], False
+        
+        return stream_id, playlist_url, True
+
+    def _attach_existing(self, key: Tuple[int, int, int, str], duration: int,
+                         lease_ids: List[str]) -> Optional[Tuple[str, str]]:
+        """
+        Adjuntarse a un stream ya activo de `key` (local o de otro worker)
+        
+        Se suma un viewer por cada lease de `lease_ids`. El stream se alarga si
+        este viewer pide más tiempo del que le queda.
+        """
+        expires_at = datetime.utcnow() + timedelta(seconds=duration)
+        stream_id = self.stream_keys.get(key)
+        if stream_id and stream_id in self.processes:
+            viewers = self._add_viewers(stream_id, len(lease_ids), expires_at, lease_ids)
+            if viewers is not None:
+                logger.info(f"Stream {stream_id} compartido, viewers: {viewers}")
+                return stream_id, self.stream_info[stream_id]["playlist_url"]
+            # Otro worker liberó el último lease; el supervisor detendrá este proceso
+            del self.stream_keys[key]
+        
+        # ¿Otro worker ya sirve este canal?
+        return self._attach_shared(key, lease_ids, expires_at=expires_at)
+
+    async def _yield_to_shared(self, stream_id: str, key: Tuple[int, int, int, str],
+                               lease_ids: List[str], duration: int = 3600) -> Tuple[str, str]:
+        """Detener un stream propio que perdió la carrera de registro y adjuntar sus leases al ganador"""
+        await self.stop_hls(stream_id)
+        shared = self._attach_shared(key, lease_ids, expires_at=datetime.utcnow() + timedelta(seconds=duration))
+        if shared is None:
+            raise RuntimeError(f"No se pudo registrar el stream del canal {key}")
+        return shared
+
+    async def acquire_abr(self, device_id: int, channel: int, rtsp_urls: Dict[int, str],
+                          duration: int = 3600, supervised: bool = True,
+                          profile: str = DEFAULT_PROFILE,
+                          queue_timeout: float = QUEUE_TIMEOUT,
+                          retain: bool = False, dvr_window: int = DVR_WINDOW) -> Tuple[List[str], List[str], str, bool]:
+        """
+        Leases sobre las variantes (main y sub) de un canal para reproducción ABR
+        
+        Cada variante es un stream normal (remux con `-c:v copy`, sin
+        transcodificar) compartido con los viewers que piden esa variante
+        sola. Si una variante no arranca (p.ej. cámara sin sub-stream) la master
+        playlist se publica con las demás. `retain` y `dvr_window` se aplican
+        a todas las variantes.
+        
+        Args:
+            rtsp_urls: sub_stream -> URL RTSP de cada variante
+        
+        Returns:
+            Tuple (stream_ids de las variantes, lease_ids, master_url, created)
+        """
+        sub_streams = sorted(rtsp_urls)
+        results = await asyncio.gather(*(
+            self.acquire_stream(device_id, channel, sub_stream, rtsp_urls[sub_stream], duration=duration,
+                                supervised=supervised, profile=profile, queue_timeout=queue_timeout,
+                                retain=retain, dvr_window=dvr_window)
+            for sub_stream in sub_streams
+        ), return_exceptions=True)
+        
+        acquired = []
+        for sub_stream, result in zip(sub_streams, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Variante {sub_stream} del canal {channel} (dispositivo {device_id}) no disponible: {result}")
+            else:
+                acquired.append(result)
+        if not acquired:
+            raise next(result for result in results if isinstance(result, Exception))
+        
+        stream_ids = [stream_id for stream_id, _, _, _ in acquired]
+        lease_ids = [lease_id for _, _, _, lease_id in acquired]
+        return stream_ids, lease_ids, master_url(stream_ids), any(created for _, _, created, _ in acquired)
+
+    def master_playlist(self, stream_ids: List[str]) -> Optional[str]:
+        """
+        Master playlist ABR con una variante por stream activo
+        
+        BANDWIDTH es el bitrate pico medido en los segmentos de la ventana y
+        AVERAGE-BANDWIDTH el medio; RESOLUTION y FRAME-RATE salen del vídeo de
+        entrada. Con RESOLUTION, hls.js (capLevelToPlayerSize) elige la
+        variante sub en tiles pequeños y la main a pantalla completa.
+        """
+        with self._db() as db:
+            rows = {row.stream_id: row for row in crud.get_streams_by_ids(db, stream_ids)}
+        
+        variants = []
+        for stream_id in dict.fromkeys(stream_ids):
+            row = rows.get(stream_id)
+            if row is None or not row.is_active:
+                continue
+            info = self.stream_info.get(stream_id)
+            media_info = info["media_info"] if info is not None else (row.media_info or {})
+            bandwidth = media_info.get("bandwidth") or ABR_VARIANTS.get(row.sub_stream, ABR_VARIANTS[0])
+            variants.append((bandwidth, media_info, row))
+        if not variants:
+            return None
+        
+        version = 7 if any(HLS_PROFILES.get(row.profile, {}).get("segment_type") == "fmp4" for _, _, row in variants) else 3
+        lines = ["#EXTM3U", f"#EXT-X-VERSION:{version}"]
+        for bandwidth, media_info, row in sorted(variants, key=lambda variant: (variant[0], variant[1].get("width") or 0)):
+            attributes = [f"BANDWIDTH={bandwidth}"]
+            if media_info.get("average_bandwidth"):
+                attributes.append(f"AVERAGE-BANDWIDTH={min(media_info['average_bandwidth'], bandwidth)}")
+            if media_info.get("width"):
+                attributes.append(f"RESOLUTION={media_info['width']}x{media_info['height']}")
+            if media_info.get("fps"):
+                attributes.append(f"FRAME-RATE={media_info['fps']:.3f}")
+            lines += [f"#EXT-X-STREAM-INF:{','.join(attributes)}", row.hls_url]
+        return "\n".join(lines) + "\n"
+
+    def variant_resolutions(self, channels: List[Tuple[int, int]]) -> Dict[Tuple[int, int], Dict[int, Tuple[int, int]]]:
+        """
+        Resolución de las variantes de varios canales: (device_id, channel) -> sub_stream -> (ancho, alto)
+        
+        Se usa la medida de los streams activos (cualquier perfil) y, si no
+        hay, la nominal de VARIANT_RESOLUTIONS.
+        """
+        resolutions = {key: dict(VARIANT_RESOLUTIONS) for key in channels}
+        with self._db() as db:
+            rows = crud.get_active_streams_by_devices(db, list({device_id for device_id, _ in channels}))
+        for row in rows:
+            variants = resolutions.get((row.device_id, row.channel))
+            info = self.stream_info.get(row.stream_id)
+            media_info = info["media_info"] if info is not None else (row.media_info or {})
+            if variants is not None and media_info.get("width"):
+                variants[row.sub_stream] = (media_info["width"], media_info["height"])
+        return resolutions
+
+    def select_sub_stream(self, device_id: int, channel: int, tile_width: int, tile_height: int,
+                          tiles: int = 1) -> int:
+        """Variante más barata para un tile (ver `select_variant`)"""
+        resolutions = self.variant_resolutions([(device_id, channel)])[(device_id, channel)]
+        return select_variant(resolutions, tile_width, tile_height, tiles)
+
+    async def acquire_streams(self, items: List[Dict],
+                              concurrency: int = BULK_CONCURRENCY) -> AsyncIterator[Dict]:
+        """
+        Obtener leases sobre varios streams a la vez (arranque masivo)
+        
+        Cada item lleva device_id, channel, sub_stream, profile, rtsp_url,
+        duration, supervised, retain y dvr_window, más un `index` que se
+        devuelve en su resultado. Los adjuntos a streams existentes se
+        devuelven de inmediato; los FFmpeg nuevos se lanzan en paralelo (como
+        mucho `concurrency` a la vez) y se registran con un único INSERT. Items
+        repetidos del mismo canal comparten proceso. Los items sin capacidad
+        esperan en la cola de admisión como un arranque individual.
+        
+        Yields:
+            Dict con index, status ("started", "shared" o "error") y
+            stream_id/playlist_url/lease_id, o message/scope en caso de error
+        """
+        # El trabajo corre en su propia tarea: un cliente lento no retrasa el arranque
+        results: asyncio.Queue = asyncio.Queue()
+        producer = asyncio.create_task(self._acquire_batch(items, concurrency, results))
+        
+        while True:
+            result = await results.get()
+            if result is None:
+                break
+            yield result
+        await producer
+
+    async def _acquire_batch(self, items: List[Dict], concurrency: int, results: asyncio.Queue):
+        """
+        Resolver un arranque masivo, publicando resultados en `results`
+        
+        El lock solo se toma para los adjuntos y la admisión y para registrar
+        los streams lanzados: los FFmpeg arrancan fuera de él, de modo que los
+        acquire/release del resto del worker no esperan a todo el mosaico. Los
+        canales en lanzamiento quedan reservados en `_launching` y un acquire
+        concurrente del mismo canal espera para adjuntarse.
+        """
+        def error(item: Dict, message: str, scope: Optional[str] = None):
+            results.put_nowait({"index": item["index"], "status": "error", "message": message, "scope": scope})
+        
+        launches: Dict[Tuple[int, int, int, str], List[Dict]] = {}
+        # Un lease por item, también en los canales repetidos
+        leases = {item["index"]: uuid.uuid4().hex for item in items}
+        try:
+            # 1. Adjuntos a streams existentes y control de admisión
+            queued: List[Dict] = []
+            async with self._lock:
+                pending_by_device: Dict[int, int] = {}
+                for item in items:
+                    key = (item["device_id"], item["channel"], item["sub_stream"], item["profile"])
+                    if key in launches:
+                        launches[key].append(item)
+                        continue
+                    if key in self._launching:
+                        # Lo está lanzando otro arranque masivo
+                        queued.append(item)
+                        continue
+                    try:
+                        existing = self._attach_existing(key, item["duration"], [leases[item["index"]]])
+                        if existing:
+                            if item["retain"]:
+                                self.set_retain(existing[0], True, item["dvr_window"])
+                            results.put_nowait({
+                                "index": item["index"], "status": "shared",
+                                "stream_id": existing[0], "playlist_url": existing[1],
+                                "lease_id": leases[item["index"]]
+                            })
+                            continue
+                        
+                        rejection = self.admission.check(
+                            item["device_id"],
+                            pending_device=pending_by_device.get(item["device_id"], 0),
+                            pending_node=len(launches)
+                        )
+                    except Exception as e:
+                        error(item, str(e))
+                        continue
+                    if rejection is not None:
+                        # Espera capacidad en la cola de admisión (paso 4)
+                        queued.append(item)
+                        continue
+                    
+                    self.admission.admitted += 1
+                    launches[key] = [item]
+                    self._launching[key] = asyncio.Event()
+                    pending_by_device[item["device_id"]] = pending_by_device.get(item["device_id"], 0) + 1
+            
+            # 2. Lanzar los FFmpeg nuevos en paralelo, sin el lock y con concurrencia acotada
+            semaphore = asyncio.Semaphore(concurrency)
+            
+            async def launch(group):
+                # Un canal repetido dura lo que pida el item más largo y se retiene si alguno lo pide
+                retained = [item["dvr_window"] for item in group if item["retain"]]
+                async with semaphore:
+                    stream_id, _ = await self.start_hls(
+                        group[0]["rtsp_url"], duration=max(item["duration"] for item in group),
+                        supervised=group[0]["supervised"], profile=group[0]["profile"],
+                        retain=bool(retained), dvr_window=max(retained, default=DVR_WINDOW)
+                    )
+                return stream_id
+            
+            groups = list(launches.items())
+            launched = await asyncio.gather(*(launch(group) for _, group in groups), return_exceptions=True)
+            
+            # 3. Registrar todos los streams nuevos con un único INSERT
+            async with self._lock:
+                started = []
+                for (key, group), stream_id in zip(groups, launched):
+                    if isinstance(stream_id, Exception):
+                        for item in group:
+                            error(item, f"Error iniciando stream: {stream_id}")
+                        continue
+                    self.stream_info[stream_id]["key"] = key
+                    self.stream_info[stream_id]["viewers"] = len(group)
+                    self.stream_keys[key] = stream_id
+                    started.append((key, group, stream_id))
+                
+                def group_leases(group):
+                    return [leases[item["index"]] for item in group]
+                
+                conflicts = []
+                if started:
+                    try:
+                        with self._db() as db:
+                            crud.create_streams(
+                                db, [self._stream_row(stream_id) for _, _, stream_id in started],
+                                {stream_id: group_leases(group) for _, group, stream_id in started}
+                            )
+                    except IntegrityError:
+                        # Algún canal lo registró otro worker entre medias: registrar uno a uno
+                        conflicts = [entry for entry in started if not self._register_stream(entry[2], group_leases(entry[1]))]
+                    except Exception as e:
+                        logger.error(f"Error registrando streams del arranque masivo: {e}")
+                        for key, group, _ in started:
+                            del self.stream_keys[key]
+                            for item in group:
+                                error(item, f"Error registrando stream: {e}")
+                        unregistered, started = [stream_id for _, _, stream_id in started], []
+                        await self.stop_streams(unregistered)
+                
+                for key, group, stream_id in started:
+                    status, playlist_url = "started", self.stream_info.get(stream_id, {}).get("playlist_url")
+                    if (key, group, stream_id) in conflicts:
+                        try:
+                            stream_id, playlist_url = await self._yield_to_shared(
+                                stream_id, key, group_leases(group), duration=max(item["duration"] for item in group)
+                            )
+                            status = "shared"
+                        except Exception as e:
+                            for item in group:
+                                error(item, str(e))
+                            continue
+                    for position, item in enumerate(group):
+                        results.put_nowait({
+                            "index": item["index"],
+                            "status": status if position == 0 else "shared",
+                            "stream_id": stream_id,
+                            "playlist_url": playlist_url,
+                            "lease_id": leases[item["index"]]
+                        })
+                
+                # Los acquire que esperaban estos canales ya pueden adjuntarse
+                for key in launches:
+                    self._launching.pop(key).set()
+                launches = {}
+            
+            # 4. Items sin capacidad: cola de admisión, como /streams/start
+            async def acquire_queued(item):
+                try:
+                    async with semaphore:
+                        stream_id, playlist_url, created, lease_id = await self.acquire_stream(
+                            item["device_id"], item["channel"], item["sub_stream"], item["rtsp_url"],
+                            duration=item["duration"], supervised=item["supervised"], profile=item["profile"],
+                            retain=item["retain"], dvr_window=item["dvr_window"]
+                        )
+                except AdmissionRejected as e:
+                    error(item, e.reason, e.scope)
+                except Exception as e:
+                    error(item, f"Error iniciando stream: {e}")
+                else:
+                    results.put_nowait({
+                        "index": item["index"], "status": "started" if created else "shared",
+                        "stream_id": stream_id, "playlist_url": playlist_url, "lease_id": lease_id
+                    })
+            
+            await asyncio.gather(*(acquire_queued(item) for item in queued))
+        finally:
+            # Un fallo a medias no deja canales reservados
+            for key in launches:
+                event = self._launching.pop(key, None)
+                if event is not None:
+                    event.set()
+            # Fin de resultados
+            results.put_nowait(None)
 
-    def start_hls(self, rtsp_url: str, stream_id: str = None, duration: int = 3600) -> Tuple[str, str]:
+    async def release_stream(self, lease_id: str) -> Optional[Tuple[str, int]]:
+        """
+        Liberar el lease de un viewer
+        
+        El proceso FFmpeg solo se detiene cuando se libera el último lease.
+        Liberar otra vez el mismo lease no resta otro viewer.
+        
+        Args:
+            lease_id: Lease devuelto por acquire_stream
+        
+        Returns:
+            Tuple (stream_id, viewers restantes), o None si el lease no existe
+        """
+        released = (await self.release_streams([lease_id])).get(lease_id)
+        if released is None:
+            logger.warning(f"Lease {lease_id} no encontrado")
+        else:
+            logger.info(f"Lease {lease_id} liberado en stream {released[0]}, viewers: {released[1]}")
+        return released
+
+    async def start_hls(self, rtsp_url: str, stream_id: str = None, duration: int = 3600,
+                        supervised: bool = True, profile: str = DEFAULT_PROFILE,
+                        retain: bool = False, dvr_window: int = DVR_WINDOW) -> Tuple[str, str]:
         """
         Iniciar stream HLS desde RTSP
         
@@ -31,10 +619,18 @@ class StreamManager:
             rtsp_url: URL RTSP de origen
             stream_id: ID único del stream (se genera si no se proporciona)
             duration: Duración máxima en segundos
-            
+            supervised: Reiniciar FFmpeg con backoff si termina o se atasca,
+                conservando stream_id y playlist_url
+            profile: Perfil de salida HLS (ver HLS_PROFILES)
+            retain: Copiar cada segmento completo a HLS_ROOT (DVR)
+            dvr_window: Ventana de time-shift (segundos) del anillo de segmentos retenidos
+        
         Returns:
             Tuple (stream_id, playlist_url)
         """
+        if profile not in HLS_PROFILES:
+            raise ValueError(f"Perfil HLS desconocido: {profile}")
+        
         if not stream_id:
             stream_id = str(uuid.uuid4())
         
@@ -44,201 +640,1031 @@ class StreamManager:
             return stream_id, self.stream_info[stream_id]["playlist_url"]
         
         try:
-            # Crear directorio para el stream
-            stream_dir = self.hls_root / stream_id
+            # Crear directorio para el stream (tmpfs en modo memory)
+            stream_dir = self.live_root / stream_id
             stream_dir.mkdir(parents=True, exist_ok=True)
             
-            playlist_path = stream_dir / "stream.m3u8"
-            
-            # Comando FFmpeg para HLS
-            cmd = [
-                FFMPEG_PATH,
-                "-rtsp_transport", "tcp",
-                "-i", rtsp_url,
-                "-c:v", "copy",  # Copiar video sin re-encoding
-                "-c:a", "aac",   # Re-encoding de audio a AAC
-                "-f", "hls",
-                "-hls_time", "4",           # Duración de cada segmento (4 segundos)
-                "-hls_list_size", "5",      # Mantener 5 segmentos en la playlist
-                "-hls_flags", "delete_segments",  # Eliminar segmentos antiguos
-                "-hls_segment_filename", str(stream_dir / "segment_%03d.ts"),
-                "-t", str(duration),        # Duración máxima
-                str(playlist_path)
-            ]
+            cmd = self._build_command(stream_dir, rtsp_url, profile)
             
             logger.info(f"Iniciando stream {stream_id} con comando: {' '.join(cmd)}")
             
-            # Iniciar proceso FFmpeg
-            proc = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                cwd=str(stream_dir)
-            )
+            # Iniciar proceso FFmpeg y drenar sus pipes
+            drain = FFmpegDrain(stream_id, on_log_line=lambda line: self._on_ffmpeg_log(stream_id, line))
+            proc = await self._spawn(cmd, stream_dir, drain)
             
             # Guardar información del proceso
             self.processes[stream_id] = proc
             self.stream_info[stream_id] = {
                 "process": proc,
+                "drain": drain,
                 "rtsp_url": rtsp_url,
                 "playlist_url": f"/hls/{stream_id}/stream.m3u8",
                 "started_at": datetime.utcnow(),
                 "duration": duration,
-                "stream_dir": str(stream_dir)
+                "stream_dir": str(stream_dir),
+                "key": None,
+                "profile": profile,
+                "viewers": 1,
+                "supervised": supervised,
+                "process_started_at": time.monotonic(),
+                "restarts": 0,
+                "stalls": 0,
+                "last_exit_code": None,
+                "last_restart_at": None,
+                # Contadores incrementales de segmentos (sin recorrer el disco)
+                # Con delete_segments FFmpeg conserva la playlist + hls_delete_threshold (1) + el segmento en escritura
+                "segments": deque(maxlen=HLS_PROFILES[profile]["list_size"] + 2),
+                "segments_written": 0,
+                "last_segment_at": None,
+                # Intervalo medido entre segmentos (media móvil) para estimar la latencia
+                "segment_interval_s": None,
+                "retain": False,
+                "dvr": None,
+                "dvr_window": dvr_window,
+                # Hora UTC de apertura del segmento en escritura (inicio en el índice de time-shift)
+                "segment_opened_at": None,
+                # El init.mp4 (fMP4) se copia con el primer segmento retenido de cada proceso
+                "spill_init": True,
+                "spills": set(),
+                # Las copias de un stream se registran en el índice en orden
+                "spill_lock": asyncio.Lock(),
+                "spilled_segments": 0,
+                # Vídeo medido (resolución del log de FFmpeg y bitrate de los segmentos)
+                "media_info": {},
+                "media_info_published": None,
+                "segment_bits": deque(maxlen=HLS_PROFILES[profile]["list_size"]),
+                "live_bytes": 0,
+                "over_cap": 0
             }
             
-            # Iniciar thread para monitorear el proceso
-            monitor_thread = threading.Thread(
-                target=self._monitor_stream,
-                args=(stream_id,),
-                daemon=True
-            )
-            monitor_thread.start()
+            self._apply_retain(stream_id, self.stream_info[stream_id], retain, dvr_window)
+            
+            # Vigilar la salida del proceso desde el event loop
+            self._watchers[stream_id] = asyncio.create_task(self._watch_process(stream_id, proc))
+            await self.start()
             
             logger.info(f"Stream {stream_id} iniciado correctamente")
             return stream_id, self.stream_info[stream_id]["playlist_url"]
-            
+        
         except Exception as e:
             logger.error(f"Error iniciando stream {stream_id}: {e}")
             raise
 
-    def stop_hls(self, stream_id: str) -> bool:
+    def _build_command(self, stream_dir: Path, rtsp_url: str,
+                       profile: str = DEFAULT_PROFILE, restart: bool = False) -> List[str]:
+        """
+        Construir el comando FFmpeg para HLS
+        
+        En un reinicio se continúa la playlist existente (append_list) con una
+        discontinuidad, para que los players sigan en la misma URL. No lleva
+        `-t`: los viewers que se adjuntan pueden alargar el stream, así que el
+        fin lo decide el supervisor (`_expire_streams`) o el último lease.
+        """
+        settings = HLS_PROFILES[profile]
+        hls_flags = "+".join(["delete_segments"] + settings["flags"])
+        if restart:
+            hls_flags += "+append_list+discont_start"
+        
+        segment_options = ["-hls_segment_type", settings["segment_type"]]
+        if settings["segment_type"] == "fmp4":
+            segment_options += ["-hls_fmp4_init_filename", "init.mp4"]
+        
+        return [
+            FFMPEG_PATH,
+            "-rtsp_transport", "tcp",
+            "-i", rtsp_url,
+            "-c:v", "copy",  # Copiar video sin re-encoding
+            "-c:a", "aac",   # Re-encoding de audio a AAC
+            "-f", "hls",
+            "-hls_time", str(settings["hls_time"]),  # Duración de cada segmento
+            "-hls_list_size", str(settings["list_size"]),  # Segmentos en la playlist
+            "-hls_flags", hls_flags,     # Eliminar segmentos antiguos
+            *segment_options,
+            "-hls_segment_filename", str(stream_dir / f"segment_%03d.{settings['extension']}"),
+            "-nostats",                  # Sin líneas de estado en stderr
+            "-progress", "pipe:1",       # Métricas en vivo por stdout
+            str(stream_dir / "stream.m3u8")
+        ]
+
+    async def _spawn(self, cmd: List[str], stream_dir: Path, drain: FFmpegDrain) -> asyncio.subprocess.Process:
+        """Lanzar un proceso FFmpeg y empezar a drenar stdout/stderr"""
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=str(stream_dir)
+        )
+        drain.attach(proc)
+        return proc
+
+    async def stop_hls(self, stream_id: str) -> bool:
         """
         Detener stream HLS
         
         Args:
             stream_id: ID del stream a detener
-            
+        
         Returns:
             True si se detuvo correctamente
         """
+        if stream_id not in self.processes:
+            logger.warning(f"Stream {stream_id} no encontrado")
+            return False
+        
         try:
-            if stream_id not in self.processes:
-                logger.warning(f"Stream {stream_id} no encontrado")
-                return False
-            
-            proc = self.processes[stream_id]
+            result = await self.stop_streams([stream_id])
+            return result.get(stream_id) == "stopped"
+        except Exception as e:
+            logger.error(f"Error deteniendo stream {stream_id}: {e}")
+            return False
+
+    async def stop_streams(self, stream_ids: List[str], timeout: float = STOP_TIMEOUT) -> Dict[str, str]:
+        """
+        Detener varios streams a la vez
+        
+        Envía SIGTERM a todos los FFmpeg locales de golpe, espera a todos en
+        paralelo con un único deadline y fuerza SIGKILL a los que no terminen.
+        Todas las filas afectadas (también las de otros workers, cuyo
+        supervisor detiene el proceso al verlas inactivas) se marcan detenidas
+        con un único UPDATE.
+        
+        Args:
+            stream_ids: IDs de los streams a detener
+            timeout: Segundos de espera tras SIGTERM antes de SIGKILL
+        
+        Returns:
+            Dict stream_id -> "stopped", "stopped_remote" o "not_found"
+        """
+        stream_ids = list(dict.fromkeys(stream_ids))
+        targets = {}
+        for stream_id in stream_ids:
+            proc = self.processes.get(stream_id)
+            if proc is None:
+                continue
+            info = self.stream_info[stream_id]
+            watcher = self._watchers.get(stream_id)
+            self._forget_stream(stream_id)
             
-            # Terminar proceso
-            proc.terminate()
+            # Cancelar un posible reinicio pendiente (backoff) del supervisor
+            if watcher is not None and watcher is not asyncio.current_task():
+                watcher.cancel()
+            targets[stream_id] = (proc, info)
+        
+        marked = set(self._mark_stopped(stream_ids))
+        
+        # SIGTERM a todos a la vez
+        for proc, _ in targets.values():
+            if proc.returncode is None:
+                try:
+                    proc.terminate()
+                except ProcessLookupError:
+                    # El proceso terminó entre la comprobación y la señal
+                    pass
+        
+        # Esperar a todos con un único deadline y forzar kill a los rezagados
+        waits = {stream_id: asyncio.create_task(proc.wait()) for stream_id, (proc, _) in targets.items()}
+        if waits:
+            await asyncio.wait(waits.values(), timeout=timeout)
+        stragglers = [stream_id for stream_id, task in waits.items() if not task.done()]
+        for stream_id in stragglers:
+            logger.warning(f"Stream {stream_id} no terminó en {timeout}s, forzando kill")
+            try:
+                targets[stream_id][0].kill()
+            except ProcessLookupError:
+                pass
+        if stragglers:
+            await asyncio.gather(*(waits[stream_id] for stream_id in stragglers), return_exceptions=True)
+        
+        await asyncio.gather(*(self._release_live_dir(stream_id, info) for stream_id, (_, info) in targets.items()))
+        
+        results = {}
+        for stream_id in stream_ids:
+            if stream_id in targets:
+                targets[stream_id][1]["drain"].close()
+                logger.info(f"Stream {stream_id} detenido correctamente")
+                results[stream_id] = "stopped"
+            elif stream_id in marked:
+                results[stream_id] = "stopped_remote"
+            else:
+                results[stream_id] = "not_found"
+        return results
+
+    async def release_streams(self, lease_ids: List[str]) -> Dict[str, Tuple[str, int]]:
+        """
+        Liberar varios leases con un único UPDATE
+        
+        Los streams locales que se quedan sin viewers se detienen juntos con
+        stop_streams; los de otros workers los detiene su supervisor. Un lease
+        ya liberado devuelve los viewers actuales de su stream sin restar otro.
+        
+        Returns:
+            Dict lease_id -> (stream_id, viewers restantes); los leases desconocidos no aparecen
+        """
+        to_stop = []
+        async with self._lock:
+            with self._db() as db:
+                released = crud.release_leases(db, list(dict.fromkeys(lease_ids)))
             
-            # Esperar hasta 5 segundos para que termine gracefully
+            for stream_id, viewers in dict(released.values()).items():
+                info = self.stream_info.get(stream_id)
+                if info is None:
+                    continue
+                
+                info["viewers"] = viewers
+                if viewers == 0:
+                    # Desregistrar la clave para que nuevos viewers no se adjunten a un stream que se detiene
+                    if info.get("key") is not None and self.stream_keys.get(info["key"]) == stream_id:
+                        del self.stream_keys[info["key"]]
+                    to_stop.append(stream_id)
+        
+        await self.stop_streams(to_stop)
+        return released
+
+    def _forget_stream(self, stream_id: str):
+        """Eliminar un stream de los registros internos"""
+        self.processes.pop(stream_id, None)
+        self._watchers.pop(stream_id, None)
+        info = self.stream_info.pop(stream_id, None)
+        if info and info.get("key") is not None and self.stream_keys.get(info["key"]) == stream_id:
+            del self.stream_keys[info["key"]]
+        self.hls_cache.drop(stream_id)
+        # Hay capacidad libre para las peticiones en cola
+        self.admission.notify()
+
+    @contextmanager
+    def _db(self):
+        """Sesión corta contra el estado compartido"""
+        db = self.session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def _register_stream(self, stream_id: str, lease_ids: List[str]) -> bool:
+        """Registrar un stream propio y sus leases en la tabla compartida; False si otro worker ganó la carrera"""
+        with self._db() as db:
             try:
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                # Si no termina, forzar kill
-                proc.kill()
-                proc.wait()
-            
-            # Limpiar información
-            del self.processes[stream_id]
-            if stream_id in self.stream_info:
-                del self.stream_info[stream_id]
-            
-            logger.info(f"Stream {stream_id} detenido correctamente")
-            return True
+                crud.create_stream(db, self._stream_row(stream_id), lease_ids)
+                return True
+            except IntegrityError:
+                db.rollback()
+                return False
+
+    def _stream_row(self, stream_id: str) -> schemas.StreamCreate:
+        """Fila de la tabla compartida para un stream propio"""
+        info = self.stream_info[stream_id]
+        device_id, channel, sub_stream, profile = info["key"]
+        return schemas.StreamCreate(
+            stream_id=stream_id,
+            device_id=device_id,
+            channel=channel,
+            sub_stream=sub_stream,
+            profile=profile,
+            rtsp_url=info["rtsp_url"],
+            hls_url=info["playlist_url"],
+            owner=self.owner_id,
+            pid=info["process"].pid,
+            viewers=info["viewers"],
+            retain=info["retain"],
+            dvr_window=info["dvr_window"] if info["retain"] else None,
+            expires_at=info["started_at"] + timedelta(seconds=info["duration"])
+        )
+
+    def _attach_shared(self, key: Tuple[int, int, int, str], lease_ids: List[str],
+                       expires_at: Optional[datetime] = None) -> Optional[Tuple[str, str]]:
+        """Adjuntar `lease_ids` al stream activo de otro worker si su heartbeat es reciente"""
+        with self._db() as db:
+            row = crud.get_active_stream_by_key(db, *key)
+            if row is None:
+                return None
+            
+            heartbeat_cutoff = datetime.utcnow() - timedelta(seconds=HEARTBEAT_TTL)
+            orphaned = row.owner == self.owner_id and row.stream_id not in self.processes
+            # Una fila sin owner o sin heartbeat (versión anterior) no la sirve ningún worker
+            if orphaned or _is_stale(row, heartbeat_cutoff):
+                logger.warning(f"Stream {row.stream_id} de {row.owner} sin heartbeat, se descarta")
+                self._kill_orphan(row)
+                crud.stop_streams(db, [row.stream_id])
+                return None
             
+            viewers = crud.add_stream_viewers(db, row.stream_id, len(lease_ids), expires_at, lease_ids)
+            if viewers is None:
+                return None
+            
+            logger.info(f"Stream {row.stream_id} compartido desde {row.owner}, viewers: {viewers}")
+            return row.stream_id, row.hls_url
+
+    def _add_viewers(self, stream_id: str, delta: int, expires_at: Optional[datetime] = None,
+                     lease_ids: Optional[List[str]] = None) -> Optional[int]:
+        """Actualizar el contador compartido de viewers (y el fin del stream) y reflejarlo localmente"""
+        with self._db() as db:
+            viewers = crud.add_stream_viewers(db, stream_id, delta, expires_at, lease_ids)
+        info = self.stream_info.get(stream_id)
+        if viewers is not None and info is not None:
+            info["viewers"] = viewers
+            if expires_at is not None:
+                _extend_duration(info, expires_at)
+        return viewers
+
+    def _mark_stopped(self, stream_ids: List[str]) -> List[str]:
+        """Marcar streams como detenidos en la tabla compartida; devuelve los que estaban activos"""
+        try:
+            with self._db() as db:
+                return crud.stop_streams(db, stream_ids)
         except Exception as e:
-            logger.error(f"Error deteniendo stream {stream_id}: {e}")
-            return False
+            logger.error(f"Error actualizando estado de streams {stream_ids}: {e}")
+            return []
+
+    def _kill_orphan(self, row):
+        """Terminar el FFmpeg de un worker caído en este mismo host"""
+        if not row.pid or not row.owner:
+            return
+        host, _, worker_pid = row.owner.rpartition(":")
+        if host != self.host or row.owner == self.owner_id:
+            return
+        if worker_pid.isdigit() and _pid_alive(int(worker_pid)):
+            return
+        try:
+            # Comprobar que el PID sigue siendo el FFmpeg de este stream (los PID se reutilizan)
+            with open(f"/proc/{row.pid}/cmdline", "rb") as f:
+                cmdline = f.read().decode(errors="ignore")
+            if row.stream_id in cmdline:
+                os.kill(row.pid, signal.SIGTERM)
+                logger.info(f"FFmpeg huérfano {row.pid} del stream {row.stream_id} terminado")
+        except (OSError, ValueError):
+            pass
+
+    def _row_info(self, row) -> Dict:
+        """Información de un stream gestionado por otro worker"""
+        return {
+            "playlist_url": row.hls_url,
+            "started_at": row.started_at,
+            "duration": int((row.expires_at - row.started_at).total_seconds()) if row.expires_at and row.started_at else None,
+            "rtsp_url": row.rtsp_url,
+            "viewers": row.viewers,
+            "owner": row.owner,
+            "profile": row.profile,
+            "retain": bool(row.retain),
+            "dvr_window": row.dvr_window
+        }
 
     def get_stream_info(self, stream_id: str) -> Optional[Dict]:
         """Obtener información de un stream"""
-        return self.stream_info.get(stream_id)
+        info = self.stream_info.get(stream_id)
+        if info is not None:
+            return info
+        
+        with self._db() as db:
+            row = crud.get_stream(db, stream_id)
+            if row is None or not row.is_active:
+                return None
+            return self._row_info(row)
 
     def list_active_streams(self) -> Dict[str, Dict]:
-        """Listar todos los streams activos"""
-        return {
+        """Listar todos los streams activos (de todos los workers)"""
+        streams = {
             stream_id: {
                 "playlist_url": info["playlist_url"],
                 "started_at": info["started_at"].isoformat(),
                 "duration": info["duration"],
-                "rtsp_url": info["rtsp_url"]
+                "rtsp_url": info["rtsp_url"],
+                "viewers": info["viewers"],
+                "owner": self.owner_id,
+                "restarts": info["restarts"],
+                "stalls": info["stalls"],
+                "segments": len(info["segments"]),
+                "segments_written": info["segments_written"],
+                "profile": info["profile"],
+                "latency_estimate_s": self.estimate_latency(info),
+                "resources": info.get("resources"),
+                "retain": info["retain"],
+                "dvr_window": info["dvr_window"] if info["retain"] else None,
+                "live_bytes": info["live_bytes"],
+                "spilled_segments": info["spilled_segments"]
             }
             for stream_id, info in self.stream_info.items()
         }
+        
+        with self._db() as db:
+            for row in crud.get_active_streams(db):
+                if row.stream_id not in streams:
+                    info = self._row_info(row)
+                    info["started_at"] = row.started_at.isoformat() if row.started_at else None
+                    streams[row.stream_id] = info
+        
+        return streams
 
-    def _monitor_stream(self, stream_id: str):
-        """Monitorear un stream en background"""
+    async def _watch_process(self, stream_id: str, proc: asyncio.subprocess.Process):
+        """
+        Esperar la salida de un proceso FFmpeg sin ocupar un thread
+        
+        En modo supervisado, si FFmpeg termina antes de tiempo (caída RTSP o
+        atasco detectado por el supervisor) se reinicia con backoff exponencial
+        con jitter, conservando el mismo stream_id y la misma playlist.
+        """
+        attempt = 0
         try:
-            proc = self.processes.get(stream_id)
-            if not proc:
-                return
+            while True:
+                return_code = await proc.wait()
+                
+                # El stream fue detenido explícitamente
+                if self.processes.get(stream_id) is not proc:
+                    logger.info(f"Stream {stream_id} terminó con código {return_code}")
+                    return
+                
+                info = self.stream_info[stream_id]
+                info["last_exit_code"] = return_code
+                last_line = info["drain"].tail(1)
+                logger.info(f"Stream {stream_id} terminó con código {return_code}: {last_line[0] if last_line else ''}")
+                elapsed = (datetime.utcnow() - info["started_at"]).total_seconds()
+                remaining = int(info["duration"] - elapsed)
+                
+                # Sin supervisión, o ya al final de su duración: limpiar
+                if not info["supervised"] or remaining <= HLS_PROFILES[info["profile"]]["hls_time"]:
+                    self._forget_stream(stream_id)
+                    self._mark_stopped([stream_id])
+                    info["drain"].close()
+                    await self._release_live_dir(stream_id, info)
+                    return
+                
+                # Un proceso que corrió sano un buen rato reinicia el backoff
+                if time.monotonic() - info["process_started_at"] >= RESTART_RESET_AFTER:
+                    attempt = 0
+                delay = random.uniform(0, min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * (2 ** attempt)))
+                attempt += 1
+                
+                logger.warning(f"Reiniciando stream {stream_id} en {delay:.1f}s (intento {attempt})")
+                await asyncio.sleep(delay)
+                
+                if self.processes.get(stream_id) is not proc:
+                    return
+                
+                stream_dir = Path(info["stream_dir"])
+                cmd = self._build_command(stream_dir, info["rtsp_url"], info["profile"], restart=True)
+                try:
+                    proc = await self._spawn(cmd, stream_dir, info["drain"])
+                except Exception as e:
+                    # No se pudo lanzar FFmpeg: reintentar con el siguiente backoff
+                    logger.error(f"Error reiniciando stream {stream_id}: {e}")
+                    info["process_started_at"] = time.monotonic()
+                    continue
+                
+                self.processes[stream_id] = proc
+                info["process"] = proc
+                info["process_started_at"] = time.monotonic()
+                info["spill_init"] = True
+                info["restarts"] += 1
+                info["last_restart_at"] = datetime.utcnow()
+                self._update_pid(stream_id, proc.pid)
+                logger.info(f"Stream {stream_id} reiniciado (reinicios: {info['restarts']})")
+        
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error monitoreando stream {stream_id}: {e}")
+
+    def _on_ffmpeg_log(self, stream_id: str, line: str):
+        """Detectar segmentos nuevos y la resolución de entrada a partir del log de FFmpeg"""
+        match = _OPENING_RE.search(line)
+        if match is None:
+            video = _VIDEO_RE.search(line)
+            info = self.stream_info.get(stream_id)
+            # La primera línea de vídeo es la de entrada (con -c:v copy coincide con la salida)
+            if video is not None and info is not None and "width" not in info["media_info"]:
+                info["media_info"].update(
+                    codec=video.group("codec"),
+                    width=int(video.group("width")),
+                    height=int(video.group("height")),
+                    fps=float(video.group("fps")) if video.group("fps") else None
+                )
+            return
+        name = os.path.basename(match.group("path"))
+        if name.startswith("segment_"):
+            self._on_segment(stream_id, name)
+
+    def _on_segment(self, stream_id: str, name: str):
+        """FFmpeg abrió un segmento nuevo (el anterior quedó completo)"""
+        info = self.stream_info.get(stream_id)
+        if info is None:
+            return
+        now = time.monotonic()
+        completed = info["segments"][-1] if info["segments"] else None
+        if info["last_segment_at"] is not None and info["segments"]:
+            interval = now - info["last_segment_at"]
+            previous = info["segment_interval_s"]
+            info["segment_interval_s"] = interval if previous is None else 0.8 * previous + 0.2 * interval
+            self._measure_segment(info, completed, interval)
+        completed_at = info["segment_opened_at"]
+        info["segment_opened_at"] = time.time()
+        info["segments"].append(name)
+        info["segments_written"] += 1
+        info["last_segment_at"] = now
+        # FFmpeg ya reescribió la playlist con el segmento anterior: precargarlo en memoria
+        self.hls_cache.on_segment(stream_id)
+        
+        if info["retain"] and completed is not None and completed_at is not None:
+            self._spill(stream_id, info, completed, completed_at)
+        if self.storage == "memory":
+            self._enforce_live_cap(stream_id, info)
+
+    def _measure_segment(self, info: Dict, name: str, duration: float):
+        """Bitrate pico y medio de los segmentos de la ventana (BANDWIDTH de la master ABR)"""
+        try:
+            size = os.stat(os.path.join(info["stream_dir"], name)).st_size
+        except OSError:
+            return
+        if duration <= 0:
+            return
+        info["segment_bits"].append((size * 8, duration))
+        bits = sum(b for b, _ in info["segment_bits"])
+        seconds = sum(d for _, d in info["segment_bits"])
+        info["media_info"]["bandwidth"] = int(max(b / d for b, d in info["segment_bits"]))
+        info["media_info"]["average_bandwidth"] = int(bits / seconds)
+
+    def set_retain(self, stream_id: str, retain: bool, dvr_window: int = DVR_WINDOW) -> bool:
+        """
+        Activar o desactivar la retención (DVR) de un stream activo
+        
+        La marca vive en la tabla compartida: si el stream es de otro worker,
+        su supervisor la recoge en la siguiente reconciliación.
+        
+        Returns:
+            False si el stream no existe o no está activo
+        """
+        with self._db() as db:
+            updated = crud.set_stream_retain(db, stream_id, retain, dvr_window if retain else None)
+        info = self.stream_info.get(stream_id)
+        if updated and info is not None:
+            self._apply_retain(stream_id, info, retain, dvr_window)
+        return updated
+
+    def _apply_retain(self, stream_id: str, info: Dict, retain: bool, dvr_window: Optional[int]):
+        dvr_window = dvr_window or DVR_WINDOW
+        if retain and info["dvr"] is not None:
+            # Cambio de ventana: se aplica con el siguiente segmento
+            info["dvr"].window = info["dvr_window"] = dvr_window
+        if info["retain"] == retain:
+            return
+        info["retain"] = retain
+        info["spill_init"] = True
+        if retain:
+            # Al reactivarla se continúa el anillo ya guardado para no dejar segmentos huérfanos
+            directory = self.hls_root / stream_id / HLS_SPILL_DIR
+            info["dvr"] = DVRIndex.load(directory) or DVRIndex(directory)
+            info["dvr"].window = info["dvr_window"] = dvr_window
+        else:
+            # Los segmentos ya retenidos caducan con HLS_SPILL_RETENTION
+            info["dvr"] = None
+        logger.info(f"Retención del stream {stream_id} {'activada' if retain else 'desactivada'}")
+
+    def _spill(self, stream_id: str, info: Dict, name: str, started_at: float):
+        """Copiar en segundo plano un segmento completo a almacenamiento persistente"""
+        task = asyncio.create_task(self._spill_segment(stream_id, info, name, started_at))
+        info["spills"].add(task)
+        task.add_done_callback(info["spills"].discard)
+
+    async def _spill_segment(self, stream_id: str, info: Dict, name: str, started_at: float):
+        dvr = info["dvr"]
+        if dvr is None:
+            return
+        names = [name]
+        if info["spill_init"] and HLS_PROFILES[info["profile"]]["segment_type"] == "fmp4":
+            names.insert(0, "init.mp4")
+        info["spill_init"] = False
+        stream_dir = Path(info["stream_dir"])
+        
+        async with info["spill_lock"]:
+            async with self._spill_slots:
+                try:
+                    size = await asyncio.to_thread(_spill_files, stream_dir, dvr.directory, names)
+                    duration = await asyncio.to_thread(segment_duration, stream_dir / "stream.m3u8", name)
+                except OSError as e:
+                    # El segmento ya no está (tope de memoria o stream detenido): se pierde para el DVR
+                    self.spill_failures += 1
+                    if "init.mp4" in names:
+                        info["spill_init"] = True
+                    logger.warning(f"No se pudo retener {name} del stream {stream_id}: {e}")
+                    return
+                
+                if "init.mp4" in names:
+                    dvr.init = "init.mp4"
+                # Sin EXTINF (la playlist ya avanzó): el tiempo hasta la apertura del siguiente
+                if duration is None:
+                    duration = max((info["segment_opened_at"] or time.time()) - started_at, 0.001)
+                removed = dvr.add(name, started_at, duration, size)
+                try:
+                    await asyncio.to_thread(dvr.save, dvr.dump(), removed)
+                except OSError as e:
+                    logger.warning(f"No se pudo guardar el índice de time-shift del stream {stream_id}: {e}")
+        
+        info["spilled_segments"] += 1
+        self.spilled_segments += 1
+        self.spilled_bytes += size
+
+    def get_dvr_index(self, stream_id: str) -> Optional[DVRIndex]:
+        """
+        Índice de time-shift de un stream: el propio en memoria o, si es de
+        otro worker (o ya se detuvo), el guardado en disco
+        """
+        info = self.stream_info.get(stream_id)
+        if info is not None and info["dvr"] is not None:
+            return info["dvr"]
+        
+        index = DVRIndex.load(self.hls_root / stream_id / HLS_SPILL_DIR, self._dvr_readers.get(stream_id))
+        if index is None:
+            self._dvr_readers.pop(stream_id, None)
+            return None
+        self._dvr_readers[stream_id] = index
+        self._dvr_readers.move_to_end(stream_id)
+        while len(self._dvr_readers) > 256:
+            self._dvr_readers.popitem(last=False)
+        return index
+
+    def _enforce_live_cap(self, stream_id: str, info: Dict):
+        """
+        Mantener el directorio en vivo (tmpfs) de un stream bajo HLS_LIVE_MAX_BYTES
+        
+        FFmpeg ya limita el número de segmentos (delete_segments); el tope
+        cubre cámaras de bitrate alto y restos de procesos anteriores. Nunca se
+        borran los segmentos de la ventana de la playlist.
+        """
+        try:
+            entries = [entry for entry in os.scandir(info["stream_dir"]) if entry.is_file()]
+        except OSError:
+            return
+        sizes = {entry.name: entry.stat() for entry in entries}
+        info["live_bytes"] = sum(stat.st_size for stat in sizes.values())
+        if info["live_bytes"] <= HLS_LIVE_MAX_BYTES:
+            return
+        
+        # Ventana de la playlist + hls_delete_threshold + segmento en escritura
+        keep = HLS_PROFILES[info["profile"]]["list_size"] + 2
+        segments = sorted(
+            (name for name in sizes if name.startswith("segment_")),
+            key=lambda name: sizes[name].st_mtime_ns
+        )
+        for name in segments[:max(0, len(segments) - keep)]:
+            if info["live_bytes"] <= HLS_LIVE_MAX_BYTES:
+                break
+            try:
+                os.unlink(os.path.join(info["stream_dir"], name))
+            except FileNotFoundError:
+                pass
+            info["live_bytes"] -= sizes[name].st_size
+        
+        if info["live_bytes"] > HLS_LIVE_MAX_BYTES:
+            if not info["over_cap"]:
+                logger.warning(
+                    f"Stream {stream_id} supera el tope de memoria en vivo "
+                    f"({info['live_bytes']} > {HLS_LIVE_MAX_BYTES} bytes) solo con la ventana de la playlist"
+                )
+            info["over_cap"] += 1
+
+    async def _release_live_dir(self, stream_id: str, info: Dict):
+        """
+        Tras detener FFmpeg: retener el último segmento, esperar las copias
+        pendientes y, en modo memory, liberar el directorio en vivo
+        """
+        try:
+            if info["retain"] and info["segments"] and info["segment_opened_at"] is not None:
+                self._spill(stream_id, info, info["segments"][-1], info["segment_opened_at"])
+            if info["spills"]:
+                await asyncio.gather(*list(info["spills"]), return_exceptions=True)
+            if self.storage == "memory":
+                await asyncio.to_thread(shutil.rmtree, info["stream_dir"], True)
+        except Exception as e:
+            logger.error(f"Error liberando el directorio en vivo del stream {stream_id}: {e}")
+
+    def estimate_latency(self, info: Dict) -> Optional[float]:
+        """
+        Latencia estimada del stream en el player (segundos)
+        
+        Se basa en el intervalo medido entre segmentos (con `-c:v copy` depende
+        del GOP de la cámara, no solo de hls_time): el player se mantiene
+        `hold_back` segmentos por detrás del borde en vivo y el segmento en
+        escritura aún no está publicado.
+        """
+        interval = info.get("segment_interval_s")
+        if interval is None or info.get("profile") not in HLS_PROFILES:
+            return None
+        return round(interval * (HLS_PROFILES[info["profile"]]["hold_back"] + 1), 2)
+
+    def latency_by_profile(self) -> Dict[str, Dict]:
+        """Latencia estimada media por perfil de los streams locales"""
+        result = {}
+        for profile in HLS_PROFILES:
+            latencies = [
+                latency for latency in (
+                    self.estimate_latency(info) for info in self.stream_info.values()
+                    if info["profile"] == profile
+                ) if latency is not None
+            ]
+            result[profile] = {
+                "streams": len(latencies),
+                "latency_estimate_s": round(sum(latencies) / len(latencies), 2) if latencies else None
+            }
+        return result
+
+    def _check_stalls(self):
+        """Matar procesos FFmpeg supervisados que no producen segmentos nuevos"""
+        now = time.monotonic()
+        for stream_id, info in list(self.stream_info.items()):
+            proc = info["process"]
+            if not info["supervised"] or proc.returncode is not None:
+                continue
             
-            # Esperar a que termine el proceso
-            return_code = proc.wait()
+            # Con segmentos cortos (perfil ll) no bajar de HLS_TIME para tolerar el GOP de la cámara
+            stall_timeout = STALL_SEGMENTS * max(HLS_PROFILES[info["profile"]]["hls_time"], HLS_TIME)
             
-            logger.info(f"Stream {stream_id} terminó con código {return_code}")
+            # Margen desde el arranque del proceso para conectar con la cámara
+            last_activity = max(info["process_started_at"], info["last_segment_at"] or 0)
+            idle = now - last_activity
             
-            # Limpiar si el proceso terminó
-            if stream_id in self.processes:
-                del self.processes[stream_id]
-            if stream_id in self.stream_info:
-                del self.stream_info[stream_id]
-                
+            if idle >= stall_timeout:
+                logger.warning(f"Stream {stream_id} atascado ({idle:.0f}s sin segmentos), reiniciando")
+                info["stalls"] += 1
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+
+    def _update_pid(self, stream_id: str, pid: int):
+        """Actualizar el PID de FFmpeg en la tabla compartida tras un reinicio"""
+        try:
+            with self._db() as db:
+                crud.update_stream_pid(db, stream_id, pid)
         except Exception as e:
-            logger.error(f"Error monitoreando stream {stream_id}: {e}")
+            logger.error(f"Error actualizando PID del stream {stream_id}: {e}")
+
+    async def _reconcile(self):
+        """Heartbeat de los streams propios y reconciliación con el estado compartido"""
+        with self._db() as db:
+            crud.touch_streams(db, self.owner_id)
+            
+            # Streams propios cuyo último viewer se liberó desde otro worker
+            released = crud.get_stopped_stream_ids(db, list(self.processes.keys()))
+            # Retención activada o desactivada desde otro worker
+            retained = crud.get_retained_streams(db, self.owner_id)
+            # Streams alargados por viewers que se adjuntaron desde otro worker
+            expiries = crud.get_stream_expiries(db, self.owner_id)
+            # Vídeo medido para las master playlists ABR servidas por cualquier worker
+            changed = {
+                stream_id: dict(info["media_info"]) for stream_id, info in self.stream_info.items()
+                if info.get("key") is not None and _media_info_changed(info["media_info_published"], info["media_info"])
+            }
+            crud.update_stream_media_info(db, changed)
+            for stream_id, media_info in changed.items():
+                self.stream_info[stream_id]["media_info_published"] = media_info
+            
+            # Streams de workers caídos
+            heartbeat_cutoff = datetime.utcnow() - timedelta(seconds=HEARTBEAT_TTL)
+            stale = [
+                row for row in crud.get_stale_streams(db, heartbeat_cutoff)
+                if row.stream_id not in self.processes
+            ]
+            for row in stale:
+                logger.warning(f"Stream {row.stream_id} de {row.owner} sin heartbeat, se descarta")
+                self._kill_orphan(row)
+            crud.stop_streams(db, [row.stream_id for row in stale])
+        
+        for stream_id, info in self.stream_info.items():
+            if info.get("key") is not None:
+                self._apply_retain(stream_id, info, stream_id in retained, retained.get(stream_id))
+            if stream_id in expiries:
+                _extend_duration(info, expiries[stream_id])
+        
+        for stream_id in released:
+            info = self.stream_info.get(stream_id)
+            if info and info.get("key") is not None and self.stream_keys.get(info["key"]) == stream_id:
+                del self.stream_keys[info["key"]]
+        await self.stop_streams(released)
 
-    def _cleanup_old_streams(self):
-        """Limpiar streams antiguos en background"""
+    async def _supervise(self):
+        """Heartbeat, expiración de streams y limpieza de directorios desde el event loop"""
+        last_cleanup = 0.0
         while True:
             try:
-                current_time = datetime.utcnow()
-                streams_to_remove = []
-                
-                for stream_id, info in self.stream_info.items():
-                    # Eliminar streams que han excedido su duración
-                    if current_time - info["started_at"] > timedelta(seconds=info["duration"]):
-                        streams_to_remove.append(stream_id)
-                
-                # Eliminar streams marcados
-                for stream_id in streams_to_remove:
-                    logger.info(f"Limpiando stream expirado: {stream_id}")
-                    self.stop_hls(stream_id)
-                
-                # Limpiar directorios vacíos
-                self._cleanup_empty_directories()
-                
-                # Esperar 60 segundos antes de la siguiente limpieza
-                time.sleep(60)
+                await self._reconcile()
+                self._check_stalls()
+                self.admission.sample()
                 
+                if time.monotonic() - last_cleanup >= SUPERVISOR_INTERVAL:
+                    last_cleanup = time.monotonic()
+                    await self._expire_streams()
+                    # Limpiar segmentos retenidos caducados y directorios vacíos fuera del event loop
+                    await asyncio.to_thread(self._cleanup_spilled_segments)
+                    await asyncio.to_thread(self._cleanup_empty_directories)
+                    await asyncio.to_thread(self._purge_leases)
+                    if self.storage == "memory":
+                        await asyncio.to_thread(self._cleanup_live_directories)
+            
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logger.error(f"Error en limpieza de streams: {e}")
-                time.sleep(60)
+                logger.error(f"Error en supervisión de streams: {e}")
+            
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def _expire_streams(self):
+        """Detener streams que han excedido su duración"""
+        current_time = datetime.utcnow()
+        streams_to_remove = []
+        
+        for stream_id, info in self.stream_info.items():
+            if current_time - info["started_at"] > timedelta(seconds=info["duration"]):
+                streams_to_remove.append(stream_id)
+        
+        for stream_id in streams_to_remove:
+            logger.info(f"Limpiando stream expirado: {stream_id}")
+        await self.stop_streams(streams_to_remove)
+
+    def _purge_leases(self):
+        """Borrar leases liberados o de streams detenidos hace más de LEASE_RETENTION"""
+        try:
+            with self._db() as db:
+                purged = crud.purge_stream_leases(db, datetime.utcnow() - timedelta(seconds=LEASE_RETENTION))
+            if purged:
+                logger.debug(f"{purged} leases de viewers antiguos eliminados")
+        except Exception as e:
+            logger.error(f"Error limpiando leases: {e}")
 
     def _cleanup_empty_directories(self):
         """Eliminar directorios vacíos de streams"""
         try:
             for stream_dir in self.hls_root.iterdir():
+                # No tocar directorios de streams activos ni recién creados por otro worker
+                if stream_dir.name in self.stream_info:
+                    continue
+                if time.time() - stream_dir.stat().st_mtime < SUPERVISOR_INTERVAL:
+                    continue
                 if stream_dir.is_dir() and not any(stream_dir.iterdir()):
                     stream_dir.rmdir()
                     logger.debug(f"Directorio vacío eliminado: {stream_dir}")
         except Exception as e:
             logger.error(f"Error limpiando directorios: {e}")
 
-    def get_stream_stats(self) -> Dict:
+    def _cleanup_spilled_segments(self):
+        """Eliminar segmentos retenidos de streams detenidos más antiguos que HLS_SPILL_RETENTION"""
+        cutoff = time.time() - HLS_SPILL_RETENTION
+        try:
+            for spill_dir in self.hls_root.glob(f"*/{HLS_SPILL_DIR}"):
+                info = self.stream_info.get(spill_dir.parent.name)
+                if info is not None and info["dvr"] is not None:
+                    continue
+                # El anillo de un stream activo de otro worker se gestiona allí (índice reciente)
+                index = spill_dir / INDEX_NAME
+                if index.exists() and index.stat().st_mtime > time.time() - HEARTBEAT_TTL:
+                    continue
+                for entry in os.scandir(spill_dir):
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                if spill_dir.parent.name not in self.stream_info and not any(spill_dir.iterdir()):
+                    spill_dir.rmdir()
+        except Exception as e:
+            logger.error(f"Error limpiando segmentos retenidos: {e}")
+
+    def _cleanup_live_directories(self):
+        """Liberar directorios en vivo (tmpfs) de streams que ya no escriben (p.ej. de un worker caído)"""
+        try:
+            for stream_dir in self.live_root.iterdir():
+                if stream_dir.name in self.stream_info:
+                    continue
+                # Un FFmpeg activo crea y borra segmentos cada pocos segundos
+                if time.time() - stream_dir.stat().st_mtime < SUPERVISOR_INTERVAL:
+                    continue
+                shutil.rmtree(stream_dir, ignore_errors=True)
+                logger.debug(f"Directorio en vivo liberado: {stream_dir}")
+        except Exception as e:
+            logger.error(f"Error limpiando directorios en vivo: {e}")
+
+    def storage_stats(self) -> Dict:
+        """Uso del almacenamiento en vivo y de las copias a almacenamiento persistente"""
+        return {
+            "mode": self.storage,
+            "live_root": str(self.live_root),
+            "live_bytes": sum(info["live_bytes"] for info in self.stream_info.values()),
+            "live_max_bytes_per_stream": HLS_LIVE_MAX_BYTES if self.storage == "memory" else None,
+            "streams_over_cap": sum(1 for info in self.stream_info.values() if info["over_cap"]),
+            "retained_streams": sum(1 for info in self.stream_info.values() if info["retain"]),
+            "spill": {
+                "pending": sum(len(info["spills"]) for info in self.stream_info.values()),
+                "segments": self.spilled_segments,
+                "bytes": self.spilled_bytes,
+                "failures": self.spill_failures
+            }
+        }
+
+    def snapshot(self) -> Dict:
+        """Contadores en memoria de los streams locales (O(streams activos), sin disco)"""
+        return {
+            "local_streams": len(self.processes),
+            "total_segments": sum(len(info["segments"]) for info in self.stream_info.values()),
+            "segments_written": sum(info["segments_written"] for info in self.stream_info.values()),
+            "restarts": sum(info["restarts"] for info in self.stream_info.values()),
+            "viewers": sum(info["viewers"] for info in self.stream_info.values())
+        }
+
+    def get_stream_stats(self, include_streams: bool = True) -> Dict:
         """Obtener estadísticas de streams"""
-        active_count = len(self.processes)
-        total_segments = 0
-        
-        # Contar segmentos totales
-        for stream_dir in self.hls_root.iterdir():
-            if stream_dir.is_dir():
-                segments = list(stream_dir.glob("*.ts"))
-                total_segments += len(segments)
+        with self._db() as db:
+            active_count = crud.count_active_streams(db)
         
-        return {
+        stats = {
             "active_streams": active_count,
-            "total_segments": total_segments,
+            "owner": self.owner_id,
             "hls_root": str(self.hls_root),
-            "streams": self.list_active_streams()
+            **self.snapshot(),
+            "latency_by_profile": self.latency_by_profile(),
+            "admission": self.admission.get_stats(),
+            "hls_cache": self.hls_cache.get_stats(),
+            "storage": self.storage_stats()
         }
+        if include_streams:
+            stats["streams"] = self.list_active_streams()
+        return stats
+
+def master_url(stream_ids: List[str]) -> str:
+    """URL de la master playlist ABR de unas variantes"""
+    return f"/hls/master.m3u8?streams={','.join(stream_ids)}"
+
+def select_variant(resolutions: Dict[int, Tuple[int, int]], tile_width: int, tile_height: int,
+                   tiles: int = 1) -> int:
+    """
+    Variante más barata que cubre un tile de `tile_width` x `tile_height` píxeles físicos
+    
+    Las variantes se prueban de menor a mayor bitrate. Con `tiles` en pantalla
+    solo se consideran las que caben en la parte de LIVE_DECODE_BUDGET de cada
+    tile (como mínimo la más barata): en un mosaico 8x8 todos los tiles van
+    por la sub aunque el monitor sea 4K. Si ninguna cubre el tile se usa la
+    mayor permitida.
+    """
+    ordered = sorted(resolutions, key=lambda sub_stream: ABR_VARIANTS.get(sub_stream, ABR_VARIANTS[0]))
+    budget = LIVE_DECODE_BUDGET / max(tiles, 1)
+    allowed = [sub_stream for sub_stream in ordered
+               if resolutions[sub_stream][0] * resolutions[sub_stream][1] <= budget] or ordered[:1]
+    for sub_stream in allowed:
+        width, height = resolutions[sub_stream]
+        if width * VARIANT_UPSCALE >= tile_width and height * VARIANT_UPSCALE >= tile_height:
+            return sub_stream
+    return allowed[-1]
+
+def _is_stale(row, heartbeat_cutoff: datetime) -> bool:
+    """Fila de `streams` sin worker vivo detrás (misma condición que crud.get_stale_streams)"""
+    return row.owner is None or row.heartbeat_at is None or row.heartbeat_at < heartbeat_cutoff
 
-    def __del__(self):
-        """Cleanup al destruir la instancia"""
+def _extend_duration(info: Dict, expires_at: datetime):
+    """Alargar la duración de un stream propio hasta `expires_at` (nunca acortarla)"""
+    info["duration"] = max(info["duration"], int((expires_at - info["started_at"]).total_seconds()))
+
+def _media_info_changed(published: Optional[Dict], current: Dict) -> bool:
+    """Publicar la primera medida, un cambio de resolución o un cambio de bitrate relevante"""
+    if not current:
+        return False
+    if published is None:
+        return True
+    for key in ("codec", "width", "height", "fps"):
+        if published.get(key) != current.get(key):
+            return True
+    for key in ("bandwidth", "average_bandwidth"):
+        old, new = published.get(key), current.get(key)
+        if bool(old) != bool(new) or (old and abs(new - old) > MEDIA_INFO_TOLERANCE * old):
+            return True
+    return False
+
+def _spill_files(source_dir: Path, target_dir: Path, names: List[str]) -> int:
+    """
+    Copiar archivos del directorio en vivo al de retención; devuelve los bytes copiados
+    
+    En el mismo sistema de archivos (modo disk) basta un hard link. El archivo
+    se publica con rename para que nunca se sirva a medias.
+    """
+    target_dir.mkdir(parents=True, exist_ok=True)
+    total = 0
+    for name in names:
+        partial = target_dir / f".{name}.part"
+        partial.unlink(missing_ok=True)
         try:
-            # Detener todos los streams activos
-            for stream_id in list(self.processes.keys()):
-                self.stop_hls(stream_id)
-        except:
-            pass
+            os.link(source_dir / name, partial)
+        except FileNotFoundError:
+            # El origen ya no existe: copiar tampoco serviría
+            raise
+        except OSError:
+            # Otro sistema de archivos (tmpfs -> disco)
+            shutil.copyfile(source_dir / name, partial)
+        total += partial.stat().st_size
+        os.replace(partial, target_dir / name)
+    return total
+
+def _pid_alive(pid: int) -> bool:
+    """Comprobar si un proceso existe en este host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def get_stream_manager(request: Request) -> StreamManager:
+    """Dependencia FastAPI: gestor de streams único de la aplicación"""
+    return request.app.state.stream_manager
@@ -0,0 +1,72 @@
+import os
+import tempfile
+
+# La app se importa sin Postgres ni /var: base de datos y directorios de prueba
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("HLS_ROOT", tempfile.mkdtemp(prefix="vms-hls-"))
+os.environ.setdefault("EXPORT_ROOT", tempfile.mkdtemp(prefix="vms-exports-"))
+
+import signal
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import StaticPool
+from app import admission, stream_manager
+from app.migrations import run_migrations
+from app.stream_manager import StreamManager
+
+@pytest.fixture
+def engine():
+    """SQLite en memoria con el esquema de la app (una conexión compartida)"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    run_migrations(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def db(engine):
+    with Session(bind=engine) as session:
+        yield session
+
+@pytest.fixture
+def ffmpeg(tmp_path, monkeypatch):
+    """FFmpeg de prueba: un proceso que no escribe nada y espera a que lo detengan"""
+    script = tmp_path / "ffmpeg"
+    script.write_text("#!/bin/sh\nexec sleep 3600\n")
+    script.chmod(0o755)
+    monkeypatch.setattr(stream_manager, "FFMPEG_PATH", str(script))
+    return script
+
+@pytest.fixture
+def make_manager(engine, tmp_path, monkeypatch, ffmpeg):
+    """
+    Gestores de streams sobre la base de datos de prueba, uno por worker simulado
+    
+    Sin supervisor en segundo plano: los tests llaman a `_reconcile`,
+    `_check_stalls` o `_expire_streams` cuando los necesitan. Los owners no son
+    de este host, así que nunca se matan procesos ajenos como huérfanos.
+    """
+    monkeypatch.setattr(stream_manager, "HLS_ROOT", str(tmp_path / "hls"))
+    for name in ("MAX_STREAMS", "MAX_STREAMS_PER_DEVICE", "MAX_DEVICE_BITRATE_KBPS", "MAX_CPU_PERCENT",
+                 "MIN_FREE_MEMORY_MB", "MIN_FREE_DISK_MB", "MIN_FREE_FDS"):
+        monkeypatch.setattr(admission, name, 0)
+    managers = []
+
+    async def no_supervisor():
+        pass
+
+    def factory(owner: str = "node1:1") -> StreamManager:
+        manager = StreamManager(sessionmaker(bind=engine))
+        manager.owner_id = owner
+        manager.start = no_supervisor
+        managers.append(manager)
+        return manager
+    
+    yield factory
+    # Un test que falla a medias no deja procesos vivos
+    for manager in managers:
+        for proc in manager.processes.values():
+            try:
+                os.kill(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
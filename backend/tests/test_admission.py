@@ -0,0 +1,99 @@
+import asyncio
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+import pytest
+from sqlalchemy.orm import Session
+from app import admission, models
+from app.admission import AdmissionController, AdmissionRejected
+
+class FakeManager:
+    """Lo que AdmissionController usa de StreamManager"""
+    def __init__(self, engine, tmp_path: Path):
+        self.engine = engine
+        self.host = "node1"
+        self.hls_root = tmp_path
+        self.stream_info = {}
+
+    @contextmanager
+    def _db(self):
+        with Session(bind=self.engine) as db:
+            yield db
+
+def add_stream(db, stream_id: str, device_id: int, owner: str = "node1:100", channel: int = 1):
+    db.add(models.Stream(stream_id=stream_id, device_id=device_id, channel=channel, owner=owner, is_active=True))
+    db.commit()
+
+def local_stream(device_id: int, bitrate_kbps=None, cpu_percent=None):
+    info = {"key": (device_id, 1, 0, "ts"), "drain": SimpleNamespace(metrics={"bitrate_kbps": bitrate_kbps})}
+    if cpu_percent is not None:
+        info["resources"] = {"cpu_percent": cpu_percent, "rss_mb": 10, "bitrate_kbps": bitrate_kbps}
+    return info
+
+@pytest.fixture
+def controller(engine, tmp_path, monkeypatch):
+    # Solo los presupuestos que prueba cada test
+    for name in ("MAX_STREAMS", "MAX_STREAMS_PER_DEVICE", "MAX_DEVICE_BITRATE_KBPS", "MAX_CPU_PERCENT",
+                 "MIN_FREE_MEMORY_MB", "MIN_FREE_DISK_MB", "MIN_FREE_FDS"):
+        monkeypatch.setattr(admission, name, 0)
+    return AdmissionController(FakeManager(engine, tmp_path))
+
+def test_no_budgets_admits(controller):
+    assert controller.check(1) is None
+
+def test_device_budget_counts_pending_streams(controller, db, monkeypatch):
+    monkeypatch.setattr(admission, "MAX_STREAMS_PER_DEVICE", 3)
+    add_stream(db, "a", 1)
+    add_stream(db, "b", 1, channel=2)
+    add_stream(db, "c", 2)
+    
+    assert controller.check(1) is None
+    rejection = controller.check(1, pending_device=1)
+    assert isinstance(rejection, AdmissionRejected)
+    assert rejection.scope == "device"
+    assert controller.check(2, pending_device=1) is None
+
+def test_node_budget_counts_only_this_host(controller, db, monkeypatch):
+    monkeypatch.setattr(admission, "MAX_STREAMS", 2)
+    add_stream(db, "a", 1)
+    add_stream(db, "b", 2, owner="node2:100")
+    
+    assert controller.check(3) is None
+    rejection = controller.check(3, pending_node=1)
+    assert rejection.scope == "node"
+
+def test_device_bitrate_budget(controller, monkeypatch):
+    monkeypatch.setattr(admission, "MAX_DEVICE_BITRATE_KBPS", 5000)
+    controller.stream_manager.stream_info = {
+        "a": local_stream(1, bitrate_kbps=3000),
+        "b": local_stream(1, bitrate_kbps=2500),
+        "c": local_stream(2, bitrate_kbps=4000)
+    }
+    
+    assert controller.check(1).scope == "device"
+    assert controller.check(2) is None
+
+def test_cpu_projection_adds_unsampled_streams(controller, monkeypatch):
+    monkeypatch.setattr(admission, "MAX_CPU_PERCENT", 85)
+    monkeypatch.setattr(admission, "CPU_COUNT", 4)
+    monkeypatch.setattr(admission, "DEFAULT_STREAM_CPU_PERCENT", 5)
+    controller.node_cpu_percent = 80
+    
+    # 80 + 1 stream nuevo x 5% / 4 cores = 81.25
+    assert controller.check(1) is None
+    # 80 + (3 pendientes + 1) x 5% / 4 cores = 85
+    assert controller.check(1, pending_node=3).scope == "node"
+
+def test_estimated_stream_cpu_uses_sampled_average(controller):
+    controller.stream_manager.stream_info = {
+        "a": local_stream(1, cpu_percent=4),
+        "b": local_stream(1, cpu_percent=8),
+        "c": local_stream(2)
+    }
+    assert controller._estimated_stream_cpu() == 6
+
+def test_wait_rejects_after_deadline(controller):
+    rejection = AdmissionRejected("lleno")
+    with pytest.raises(AdmissionRejected):
+        asyncio.run(controller.wait(rejection, deadline=0))
+    assert controller.rejected == 1
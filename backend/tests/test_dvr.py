@@ -0,0 +1,95 @@
+from datetime import datetime, timezone
+from app.dvr import DVRIndex, segment_duration, to_epoch
+
+T0 = datetime(2024, 1, 1, 10, 0, tzinfo=timezone.utc).timestamp()
+
+def filled(tmp_path, count: int, window: int = 3600, max_bytes: int = 10 ** 9) -> DVRIndex:
+    index = DVRIndex(tmp_path, window=window, max_bytes=max_bytes)
+    for i in range(count):
+        index.add(f"segment_{i:03d}.ts", T0 + 4 * i, 4, 1000)
+    return index
+
+def test_window_trims_oldest_segments(tmp_path):
+    index = DVRIndex(tmp_path, window=10)
+    removed = []
+    for i in range(6):
+        removed += index.add(f"segment_{i:03d}.ts", T0 + 4 * i, 4, 1000)
+
+    # Termina en T0 + 24: quedan los segmentos que acaban después de T0 + 14
+    assert [segment.name for segment in index.segments] == ["segment_003.ts", "segment_004.ts", "segment_005.ts"]
+    assert [segment.name for segment in removed] == ["segment_000.ts", "segment_001.ts", "segment_002.ts"]
+    assert index.bytes == 3000
+    assert index.next_msn == 6
+
+def test_byte_cap_trims_even_inside_window(tmp_path):
+    index = filled(tmp_path, 5, max_bytes=2500)
+    assert len(index.segments) == 2
+    assert index.bytes == 2000
+
+def test_rewritten_name_replaces_segment(tmp_path):
+    index = filled(tmp_path, 3)
+    index.add("segment_000.ts", T0 + 12, 4, 500)
+    assert [segment.name for segment in index.segments] == ["segment_001.ts", "segment_002.ts", "segment_000.ts"]
+    assert index.bytes == 2500
+
+def test_clock_going_back_keeps_order(tmp_path):
+    index = filled(tmp_path, 2)
+    index.add("segment_002.ts", T0, 4, 1000)
+    assert index.segments[-1].start == T0 + 8
+
+def test_seek(tmp_path):
+    index = filled(tmp_path, 5)
+    assert index.seek(T0 + 9.5) == (2, 1.5)
+    # Antes de la ventana: el segmento más antiguo
+    assert index.seek(T0 - 100) == (0, 0.0)
+    # Después del final: el último segmento, sin pasarse de su duración
+    assert index.seek(T0 + 1000) == (4, 4)
+
+def test_live_playlist_covers_whole_window(tmp_path):
+    playlist = filled(tmp_path, 3).playlist()
+    
+    assert "#EXT-X-MEDIA-SEQUENCE:0" in playlist
+    assert "#EXT-X-PLAYLIST-TYPE:EVENT" not in playlist
+    assert playlist.count("#EXTINF:4.000,") == 3
+    assert "#EXT-X-PROGRAM-DATE-TIME:2024-01-01T10:00:00.000Z" in playlist
+
+def test_playlist_from_start_is_anchored_event(tmp_path):
+    playlist = filled(tmp_path, 5).playlist(T0 + 9.5)
+    lines = playlist.splitlines()
+    
+    assert "#EXT-X-PLAYLIST-TYPE:EVENT" in lines
+    assert "#EXT-X-START:TIME-OFFSET=1.500,PRECISE=YES" in lines
+    assert "#EXT-X-MEDIA-SEQUENCE:2" in lines
+    assert [line for line in lines if not line.startswith("#")] == ["segment_002.ts", "segment_003.ts", "segment_004.ts"]
+
+def test_gap_adds_discontinuity(tmp_path):
+    index = filled(tmp_path, 2)
+    index.add("segment_002.ts", T0 + 60, 4, 1000)
+    assert index.playlist().count("#EXT-X-DISCONTINUITY") == 1
+
+def test_save_and_load_round_trip(tmp_path):
+    index = filled(tmp_path, 3, window=8)
+    index.init = "init.mp4"
+    (tmp_path / "segment_old.ts").write_bytes(b"x")
+    removed = index.add("segment_old.ts", T0 + 12, 4, 1000)
+    # El nombre reutilizado no sale del anillo; los que sí salen se borran del disco
+    for segment in removed:
+        (tmp_path / segment.name).write_bytes(b"x")
+    index.save(index.dump(), removed)
+    
+    loaded = DVRIndex.load(tmp_path)
+    assert loaded.playlist() == index.playlist()
+    assert loaded.init == "init.mp4"
+    assert all(not (tmp_path / segment.name).exists() for segment in removed)
+    # Sin cambios en el archivo se reutiliza el índice cargado
+    assert DVRIndex.load(tmp_path, loaded) is loaded
+    assert DVRIndex.load(tmp_path / "nope") is None
+
+def test_segment_duration_from_live_playlist(tmp_path):
+    playlist = tmp_path / "stream.m3u8"
+    playlist.write_text("#EXTM3U\n#EXTINF:3.960,\nsegment_001.ts\n#EXTINF:4.040,\nsegment_002.ts\n")
+    assert segment_duration(playlist, "segment_002.ts") == 4.04
+    assert segment_duration(playlist, "segment_009.ts") is None
+
+def test_to_epoch_treats_naive_as_utc():
+    assert to_epoch(datetime(2024, 1, 1, 10, 0)) == T0
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from app import crud, models, recording_exports
+
+LEASE = datetime(2030, 1, 1)
+
+def queue(db, export_id: str, device_id: int, minute: int, status: str = "queued"):
+    db.add(models.RecordingExport(
+        id=export_id, device_id=device_id, channel=1,
+        start_time=datetime(2024, 1, 1), end_time=datetime(2024, 1, 1, 0, 10),
+        status=status, created_at=datetime(2024, 1, 1) + timedelta(minutes=minute)
+    ))
+    db.commit()
+
+def test_claims_oldest_queued_export(db):
+    queue(db, "b", 1, 2)
+    queue(db, "a", 1, 1)
+    
+    claimed = crud.claim_export(db, "w1", LEASE, max_per_device=2)
+    
+    assert claimed.id == "a"
+    assert claimed.status == "running"
+    assert claimed.locked_by == "w1"
+    assert claimed.locked_until == LEASE
+
+def test_per_device_cap_skips_busy_device(db):
+    queue(db, "running", 1, 0, status="running")
+    queue(db, "a", 1, 1)
+    queue(db, "b", 2, 2)
+
+    # El NVR 1 ya tiene su exportación: se toma la del NVR 2 aunque sea más nueva
+    assert crud.claim_export(db, "w1", LEASE, max_per_device=1).id == "b"
+    assert crud.claim_export(db, "w1", LEASE, max_per_device=1) is None
+    assert crud.claim_export(db, "w1", LEASE, max_per_device=2).id == "a"
+
+def test_lost_race_moves_on_to_next_candidate(db, engine):
+    queue(db, "a", 1, 1)
+    queue(db, "b", 2, 2)
+
+    # Otro worker toma "a" entre la lectura de candidatos y el UPDATE condicional
+    def steal(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("UPDATE recording_exports") and not getattr(steal, "done", False):
+            steal.done = True
+            cursor.execute("UPDATE recording_exports SET status = 'running', locked_by = 'w2' WHERE id = 'a'")
+    event.listen(engine, "before_cursor_execute", steal)
+    try:
+        claimed = crud.claim_export(db, "w1", LEASE, max_per_device=2)
+    finally:
+        event.remove(engine, "before_cursor_execute", steal)
+    
+    assert claimed.id == "b"
+    assert db.get(models.RecordingExport, "a").locked_by == "w2"
+
+def test_download_refreshes_lru_without_counting_hits(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(recording_exports, "EXPORT_ROOT", str(tmp_path))
+    exports = recording_exports.RecordingExportManager()
+    queue(db, "a", 1, 1, status="done")
+
+    def state():
+        db.expire_all()
+        export = crud.get_export(db, "a")
+        return export.hits or 0, export.last_accessed_at
+    
+    exports.touch(db, "a")
+    hits, first = state()
+    assert hits == 0 and first is not None
+
+    # Los trozos de una descarga reanudada o del seek no tocan la fila
+    exports.touch(db, "a", "bytes=1048576-")
+    assert state() == (0, first)
+    
+    exports.touch(db, "a", "bytes=0-")
+    hits, second = state()
+    assert hits == 0 and second > first
+
+    # Solo una petición deduplicada a un archivo existente es un acierto
+    crud.touch_export(db, "a")
+    assert state()[0] == 1
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import threading
+import pytest
+from app import hls_cache
+from app.hls_cache import HLSCache, media_type, valid_name
+
+def write_playlist(stream_dir, first_msn: int, count: int):
+    """Playlist en vivo como la escribe FFmpeg (rename atómico) con sus segmentos"""
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:4", f"#EXT-X-MEDIA-SEQUENCE:{first_msn}"]
+    for msn in range(first_msn, first_msn + count):
+        name = f"segment_{msn:03d}.ts"
+        (stream_dir / name).write_bytes(b"x" * (100 + msn))
+        lines += ["#EXTINF:4.000,", name]
+    partial = stream_dir / "stream.m3u8.tmp"
+    partial.write_text("\n".join(lines) + "\n")
+    os.replace(partial, stream_dir / "stream.m3u8")
+
+@pytest.fixture
+def stream_dir(tmp_path):
+    path = tmp_path / "s1"
+    path.mkdir()
+    write_playlist(path, 0, 3)
+    return path
+
+def test_playlist_is_parsed_and_segments_preloaded(tmp_path, stream_dir):
+    cache = HLSCache(tmp_path)
+    playlist = asyncio.run(cache.get_playlist("s1", "stream.m3u8"))
+    
+    assert playlist.media_sequence == 0
+    assert playlist.segments == ["segment_000.ts", "segment_001.ts", "segment_002.ts"]
+    assert playlist.last_msn == 2
+    assert playlist.target_duration == 4
+    # Los segmentos de la playlist quedan en memoria: servirlos no toca el disco
+    reads = cache.disk_reads
+    assert asyncio.run(cache.get_file("s1", "segment_001.ts")).data == b"x" * 101
+    assert cache.disk_reads == reads
+    assert cache.hits == 1
+
+def test_etag_is_stable_until_playlist_changes(tmp_path, stream_dir):
+    cache = HLSCache(tmp_path)
+    first = asyncio.run(cache.get_playlist("s1", "stream.m3u8"))
+    assert asyncio.run(cache.get_playlist("s1", "stream.m3u8")).etag == first.etag
+    
+    write_playlist(stream_dir, 1, 3)
+    second = asyncio.run(cache.get_playlist("s1", "stream.m3u8"))
+    assert second.etag != first.etag
+    assert second.media_sequence == 1
+
+def test_rollover_keeps_only_extra_segments(tmp_path, stream_dir, monkeypatch):
+    monkeypatch.setattr(hls_cache, "HLS_CACHE_EXTRA_SEGMENTS", 1)
+    cache = HLSCache(tmp_path)
+    asyncio.run(cache.get_playlist("s1", "stream.m3u8"))
+    
+    write_playlist(stream_dir, 3, 3)
+    asyncio.run(cache.get_playlist("s1", "stream.m3u8"))
+    
+    files = list(cache._streams["s1"].files)
+    # Tres segmentos nuevos y solo el más reciente de los que salieron de la playlist
+    assert files == ["segment_002.ts", "segment_003.ts", "segment_004.ts", "segment_005.ts"]
+    assert cache.bytes == sum(100 + msn for msn in (2, 3, 4, 5))
+
+def test_budget_evicts_oldest_segments(tmp_path, stream_dir):
+    cache = HLSCache(tmp_path, max_bytes=250)
+    asyncio.run(cache.get_playlist("s1", "stream.m3u8"))
+    # 100 + 101 + 102 bytes: basta con descartar el más antiguo
+    assert list(cache._streams["s1"].files) == ["segment_001.ts", "segment_002.ts"]
+    assert cache.bytes == 203
+
+def test_disk_io_runs_off_the_event_loop(tmp_path, stream_dir, monkeypatch):
+    threads = []
+    for name in ("_load_playlist", "_read"):
+        original = getattr(hls_cache, name)
+        def traced(*args, original=original):
+            threads.append(threading.current_thread())
+            return original(*args)
+        monkeypatch.setattr(hls_cache, name, traced)
+    cache = HLSCache(tmp_path)
+
+    async def main():
+        # Peticiones concurrentes de la misma playlist: una sola versión en la caché
+        playlists = await asyncio.gather(*(cache.get_playlist("s1", "stream.m3u8") for _ in range(3)))
+        (stream_dir / "init.mp4").write_bytes(b"i")
+        await cache.get_file("s1", "init.mp4")
+        return playlists
+    
+    playlists = asyncio.run(main())
+    assert threads and threading.main_thread() not in threads
+    assert {playlist.etag for playlist in playlists} == {playlists[0].etag}
+    assert cache.bytes == sum(100 + msn for msn in range(3)) + 1
+
+def test_missing_stream(tmp_path):
+    cache = HLSCache(tmp_path)
+    assert asyncio.run(cache.get_playlist("nope", "stream.m3u8")) is None
+    assert asyncio.run(cache.get_file("nope", "segment_000.ts")) is None
+
+def test_wait_for_msn_returns_published_segment(tmp_path, stream_dir):
+    cache = HLSCache(tmp_path)
+    playlist = asyncio.run(cache.wait_for_msn("s1", "stream.m3u8", 2, timeout=1))
+    assert playlist.last_msn == 2
+
+def test_wait_for_msn_wakes_on_new_segment(tmp_path, stream_dir):
+    cache = HLSCache(tmp_path)
+    asyncio.run(cache.get_playlist("s1", "stream.m3u8"))
+
+    async def publish():
+        await asyncio.sleep(0.05)
+        write_playlist(stream_dir, 1, 3)
+        cache.on_segment("s1")
+
+    async def main():
+        waiter = asyncio.create_task(cache.wait_for_msn("s1", "stream.m3u8", 3, timeout=5))
+        await publish()
+        return await asyncio.wait_for(waiter, 1)
+    
+    assert asyncio.run(main()).last_msn == 3
+    assert cache.blocking_timeouts == 0
+
+def test_wait_for_msn_times_out(tmp_path, stream_dir):
+    cache = HLSCache(tmp_path)
+    assert asyncio.run(cache.wait_for_msn("s1", "stream.m3u8", 10, timeout=0.1)) is None
+    assert cache.blocking_timeouts == 1
+
+@pytest.mark.parametrize("name, valid", [
+    ("segment_001.ts", True), ("init.mp4", True), ("../secret", False), (".hidden", False), ("a/b.ts", False)
+])
+def test_valid_name(name, valid):
+    assert valid_name(name) is valid
+
+def test_media_type():
+    assert media_type("stream.m3u8") == "application/vnd.apple.mpegurl"
+    assert media_type("segment_001.m4s") == "video/iso.segment"
+    assert media_type("index") == "application/octet-stream"
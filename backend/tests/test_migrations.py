@@ -0,0 +1,70 @@
+from datetime import datetime
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+from app import models
+from app.migrations import STREAMS_ACTIVE_INDEX, run_migrations
+
+# Tabla streams de la versión sin owner/heartbeat (antes de compartir streams entre workers)
+BASELINE_STREAMS = """
+CREATE TABLE streams (
+    id INTEGER NOT NULL PRIMARY KEY,
+    stream_id VARCHAR(255) NOT NULL UNIQUE,
+    device_id INTEGER NOT NULL,
+    channel INTEGER,
+    sub_stream INTEGER,
+    rtsp_url TEXT,
+    hls_url TEXT,
+    is_active BOOLEAN,
+    started_at TIMESTAMP,
+    stopped_at TIMESTAMP
+)
+"""
+
+def baseline_engine(rows):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    with engine.begin() as conn:
+        conn.execute(text(BASELINE_STREAMS))
+        for stream_id, device_id, channel, is_active in rows:
+            conn.execute(
+                text("INSERT INTO streams (stream_id, device_id, channel, sub_stream, is_active, started_at) "
+                     "VALUES (:stream_id, :device_id, :channel, 0, :is_active, :started_at)"),
+                {"stream_id": stream_id, "device_id": device_id, "channel": channel,
+                 "is_active": is_active, "started_at": datetime(2024, 1, 1)}
+            )
+    return engine
+
+def test_baseline_duplicates_are_stopped_before_the_unique_index():
+    # Dos filas activas del mismo canal: lo normal en la versión anterior
+    engine = baseline_engine([("a", 1, 1, True), ("b", 1, 1, True), ("c", 2, 1, True), ("d", 1, 1, False)])
+    run_migrations(engine)
+    
+    with engine.connect() as conn:
+        assert STREAMS_ACTIVE_INDEX in {index["name"] for index in inspect(conn).get_indexes("streams")}
+    with Session(bind=engine) as db:
+        rows = db.query(models.Stream).order_by(models.Stream.stream_id).all()
+        assert [row.is_active for row in rows] == [False, False, False, False]
+        assert [row.stopped_at is not None for row in rows] == [True, True, True, False]
+        assert all(row.profile == "ts" for row in rows)
+
+def test_rerun_keeps_owned_streams_and_dedupes_without_index():
+    engine = baseline_engine([])
+    run_migrations(engine)
+    with Session(bind=engine) as db:
+        db.add(models.Stream(stream_id="live", device_id=1, channel=1, owner="node1:100", is_active=True))
+        db.commit()
+
+    # Idempotente: un stream con owner sigue activo
+    run_migrations(engine)
+    with Session(bind=engine) as db:
+        assert db.query(models.Stream).filter(models.Stream.is_active == True).count() == 1
+
+    # Duplicados con owner sin el índice (p.ej. borrado a mano): se conserva el más reciente
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP INDEX {STREAMS_ACTIVE_INDEX}"))
+        conn.execute(text("INSERT INTO streams (stream_id, device_id, channel, sub_stream, profile, owner, is_active) "
+                          "VALUES ('newer', 1, 1, 0, 'ts', 'node1:200', 1)"))
+    run_migrations(engine)
+    with Session(bind=engine) as db:
+        active = db.query(models.Stream.stream_id).filter(models.Stream.is_active == True).all()
+        assert [row[0] for row in active] == ["newer"]
@@ -0,0 +1,87 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from app.recording_search import RecordingSearch, decode_cursor, encode_cursor
+
+def record(start: str, name: str):
+    return {"start": start, "end": start, "type": "normal", "file_path": name, "size": 1, "channel": 1}
+
+# Tres archivos con el mismo inicio: el cursor debe distinguirlos
+RECORDINGS = [
+    record("2024-01-01 00:00:00", "a"),
+    record("2024-01-01 01:00:00", "b"),
+    record("2024-01-01 01:00:00", "c"),
+    record("2024-01-01 01:00:00", "d"),
+    record("2024-01-01 02:00:00", "e"),
+]
+
+class FakeSDK:
+    def __init__(self):
+        self.searches = []
+
+    def iter_recordings(self, user_id, channel, start, end, file_type=None):
+        self.searches.append(start)
+        for recording in RECORDINGS:
+            if recording["start"] >= start:
+                yield dict(recording)
+
+class FakePool:
+    """aiter_pages sin executor: pagina el generador en el event loop"""
+    def __init__(self):
+        self.sdk = FakeSDK()
+        self.pages = 0
+
+    async def aiter_pages(self, device, fn, page_size):
+        records = fn(self.sdk, 1)
+        try:
+            while True:
+                page = [r for _, r in zip(range(page_size), records)]
+                if not page:
+                    return
+                self.pages += 1
+                yield page
+                if len(page) < page_size:
+                    return
+        finally:
+            records.close()
+
+def search(pool, limit, cursor=None, page_size=2, monkeypatch=None):
+    if monkeypatch is not None:
+        monkeypatch.setattr("app.recording_search.PAGE_SIZE", page_size)
+    finder = RecordingSearch(pool, SimpleNamespace(id=1), 1, "2024-01-01 00:00:00", "2024-01-02 00:00:00",
+                             limit=limit, cursor=cursor)
+    return finder, asyncio.run(finder.collect())
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("2024-01-01 01:00:00", ["b", "c"])
+    assert decode_cursor(cursor) == ("2024-01-01 01:00:00", ["b", "c"])
+
+@pytest.mark.parametrize("cursor", ["%%%", "bm90LWpzb24=", encode_cursor("x", [])[:-4]])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+def test_pages_until_limit_and_returns_cursor(monkeypatch):
+    pool = FakePool()
+    finder, recordings = search(pool, limit=3, monkeypatch=monkeypatch)
+    
+    assert [r["file_path"] for r in recordings] == ["a", "b", "c"]
+    assert finder.total == 3
+    # La página de 2 se recorta al límite sin leer más
+    assert pool.pages == 2
+    assert decode_cursor(finder.next_cursor) == ("2024-01-01 01:00:00", ["b", "c"])
+
+def test_cursor_resumes_without_duplicates(monkeypatch):
+    pool = FakePool()
+    first, page1 = search(pool, limit=3, monkeypatch=monkeypatch)
+    second, page2 = search(pool, limit=3, cursor=first.next_cursor, monkeypatch=monkeypatch)
+    
+    assert [r["file_path"] for r in page1 + page2] == ["a", "b", "c", "d", "e"]
+    # La búsqueda se retoma desde el inicio del cursor, no desde el principio del rango
+    assert pool.sdk.searches[-1] == "2024-01-01 01:00:00"
+    assert second.next_cursor is None
+
+def test_no_cursor_when_results_fit(monkeypatch):
+    finder, recordings = search(FakePool(), limit=10, monkeypatch=monkeypatch)
+    assert len(recordings) == 5
+    assert finder.next_cursor is None
@@ -0,0 +1,69 @@
+import base64
+from datetime import date, datetime
+from types import SimpleNamespace
+from app import models
+from app.recording_timeline import (
+    MINUTES_PER_DAY, auto_bucket, build_timeline, day_bitmaps, recording_days, refresh_rollups, _encode, _mask, _runs
+)
+
+def recording(start: str, end: str, recording_type: str = "normal"):
+    return SimpleNamespace(start_time=datetime.fromisoformat(start), end_time=datetime.fromisoformat(end),
+                           recording_type=recording_type)
+
+def bits(encoded: str, width: int) -> str:
+    return format(int.from_bytes(base64.b64decode(encoded), "big"), f"0{len(base64.b64decode(encoded)) * 8}b")[:width]
+
+def test_mask_sets_bits_from_most_significant():
+    assert format(_mask(1, 3, 8), "08b") == "01100000"
+    assert format(_mask(0, 8, 8), "08b") == "11111111"
+
+def test_encode_pads_to_whole_bytes():
+    encoded = _encode(0b101, 3)
+    assert base64.b64decode(encoded) == bytes([0b10100000])
+
+def test_recording_days_excludes_exact_midnight_end():
+    assert recording_days(datetime(2024, 1, 1, 23), datetime(2024, 1, 2)) == [date(2024, 1, 1)]
+    assert recording_days(datetime(2024, 1, 1, 23), datetime(2024, 1, 2, 0, 1)) == [date(2024, 1, 1), date(2024, 1, 2)]
+
+def test_day_bitmaps_round_partial_minutes_out():
+    bitmaps = day_bitmaps([
+        recording("2024-01-01T00:01:30", "2024-01-01T00:03:10"),
+        recording("2024-01-01T10:00:00", "2024-01-01T10:02:00", "motion")
+    ], date(2024, 1, 1))
+    
+    assert set(bitmaps) == {"normal", "motion"}
+    assert all(len(bitmap) == MINUTES_PER_DAY // 8 for bitmap in bitmaps.values())
+    # Un minuto cuenta si tiene algún segundo grabado: 00:01, 00:02 y 00:03
+    assert _runs(bitmaps["normal"]) == [(1, 4)]
+    assert _runs(bitmaps["motion"]) == [(600, 602)]
+
+def test_day_bitmaps_clip_to_the_day():
+    bitmaps = day_bitmaps([recording("2023-12-31T23:00:00", "2024-01-01T00:30:00")], date(2024, 1, 1))
+    assert _runs(bitmaps["normal"]) == [(0, 30)]
+
+def test_auto_bucket_keeps_bucket_count_under_limit(monkeypatch):
+    monkeypatch.setattr("app.recording_timeline.TIMELINE_MAX_BUCKETS", 1440)
+    assert auto_bucket(datetime(2024, 1, 1), datetime(2024, 1, 2)) == 60
+    assert auto_bucket(datetime(2024, 1, 1), datetime(2024, 1, 8)) == 10 * 60
+
+def test_build_timeline_from_rollups(db):
+    db.add_all([
+        models.Recording(device_id=1, channel=1, start_time=datetime(2024, 1, 1, 23, 50),
+                         end_time=datetime(2024, 1, 2, 0, 20), recording_type="normal"),
+        models.Recording(device_id=1, channel=2, start_time=datetime(2024, 1, 2, 0, 5),
+                         end_time=datetime(2024, 1, 2, 0, 6), recording_type="alarm")
+    ])
+    db.commit()
+    refresh_rollups(db, 1, 1, [date(2024, 1, 1), date(2024, 1, 2)])
+    refresh_rollups(db, 1, 2, [date(2024, 1, 2)])
+    
+    timeline = build_timeline(db, 1, [1, 2, 3], datetime(2024, 1, 1, 23, 40), datetime(2024, 1, 2, 0, 40), 600)
+    
+    assert timeline["buckets"] == 6
+    assert timeline["end_time"] == "2024-01-02 00:40:00"
+    channels = {channel["channel"]: channel for channel in timeline["channels"]}
+    # Buckets de 10 minutos desde 23:40: grabado de 23:50 a 00:20, a ambos lados de medianoche
+    assert bits(channels[1]["coverage"], 6) == "011100"
+    assert bits(channels[2]["types"]["alarm"], 6) == "001000"
+    assert bits(channels[3]["coverage"], 6) == "000000"
+    assert channels[3]["types"] == {}
@@ -0,0 +1,26 @@
+from app.stream_manager import LIVE_DECODE_BUDGET, VARIANT_RESOLUTIONS, select_variant
+
+def test_single_large_tile_gets_main_variant():
+    assert select_variant(VARIANT_RESOLUTIONS, 2560, 1440, 1) == 0
+    assert select_variant(VARIANT_RESOLUTIONS, 1200, 675, 4) == 0
+
+def test_small_tile_gets_sub_variant():
+    assert select_variant(VARIANT_RESOLUTIONS, 480, 270, 1) == 1
+    assert select_variant(VARIANT_RESOLUTIONS, 700, 400, 4) == 1
+
+def test_upscale_tolerance():
+    # 640 * 1.25 = 800: hasta ahí se acepta escalar la variante ligera
+    assert select_variant(VARIANT_RESOLUTIONS, 800, 450, 1) == 1
+    assert select_variant(VARIANT_RESOLUTIONS, 801, 450, 1) == 0
+
+def test_decode_budget_caps_large_grids():
+    # Con 64 mosaicos el 1080p no cabe en el presupuesto aunque el mosaico sea grande
+    assert 1920 * 1080 > LIVE_DECODE_BUDGET / 64
+    assert select_variant(VARIANT_RESOLUTIONS, 2560, 1440, 64) == 1
+    assert select_variant(VARIANT_RESOLUTIONS, 480, 270, 64) == 1
+
+def test_cheapest_variant_when_nothing_fits():
+    assert select_variant(VARIANT_RESOLUTIONS, 2560, 1440, 10 ** 6) == 1
+
+def test_single_variant():
+    assert select_variant({0: (1920, 1080)}, 320, 180, 256) == 0
@@ -0,0 +1,149 @@
+import asyncio
+from datetime import timedelta
+from app import models
+
+def stream_row(db, stream_id: str) -> models.Stream:
+    db.expire_all()
+    return db.query(models.Stream).filter(models.Stream.stream_id == stream_id).one()
+
+def bulk_item(index: int, channel: int = 1, duration: int = 600) -> dict:
+    return {
+        "index": index, "device_id": 1, "channel": channel, "sub_stream": 0, "profile": "ts",
+        "rtsp_url": f"rtsp://camera/{channel}", "duration": duration, "supervised": True,
+        "retain": False, "dvr_window": 600
+    }
+
+def test_viewers_of_a_channel_share_one_process(make_manager, db):
+    async def scenario():
+        manager = make_manager()
+        first = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        second = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        other = await manager.acquire_stream(1, 2, 0, "rtsp://camera/2")
+        
+        assert first[2] and not second[2] and other[2]
+        assert first[0] == second[0] != other[0]
+        assert first[3] != second[3]
+        assert len(manager.processes) == 2
+        assert manager.stream_info[first[0]]["viewers"] == 2
+        assert stream_row(db, first[0]).viewers == 2
+        await manager.shutdown()
+    
+    asyncio.run(scenario())
+
+def test_release_is_idempotent_per_lease(make_manager, db):
+    async def scenario():
+        manager = make_manager()
+        stream_id, _, _, lease = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        _, _, _, other_lease = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        proc = manager.processes[stream_id]
+        
+        # Un reintento del mismo viewer no quita el lease del otro
+        assert await manager.release_stream(lease) == (stream_id, 1)
+        assert await manager.release_stream(lease) == (stream_id, 1)
+        assert await manager.release_streams([lease, lease]) == {lease: (stream_id, 1)}
+        assert stream_id in manager.processes
+        assert stream_row(db, stream_id).is_active
+        
+        assert await manager.release_stream(other_lease) == (stream_id, 0)
+        assert stream_id not in manager.processes
+        assert proc.returncode is not None
+        assert not stream_row(db, stream_id).is_active
+        assert await manager.release_stream(other_lease) == (stream_id, 0)
+        assert await manager.release_stream("unknown") is None
+    
+    asyncio.run(scenario())
+
+def test_stopped_stream_takes_a_new_process(make_manager):
+    async def scenario():
+        manager = make_manager()
+        stream_id, _, _, lease = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        await manager.release_stream(lease)
+        
+        restarted = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        assert restarted[2] and restarted[0] != stream_id
+        await manager.shutdown()
+    
+    asyncio.run(scenario())
+
+def test_attach_extends_the_shared_stream(make_manager, db):
+    async def scenario():
+        manager = make_manager()
+        stream_id, _, _, _ = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1", duration=600)
+        expires_at = stream_row(db, stream_id).expires_at
+        
+        await manager.acquire_stream(1, 1, 0, "rtsp://camera/1", duration=7200)
+        assert manager.stream_info[stream_id]["duration"] >= 7199
+        assert stream_row(db, stream_id).expires_at >= expires_at + timedelta(seconds=6599)
+        
+        # Un viewer que pide menos no acorta el stream
+        await manager.acquire_stream(1, 1, 0, "rtsp://camera/1", duration=60)
+        assert manager.stream_info[stream_id]["duration"] >= 7199
+        await manager.shutdown()
+    
+    asyncio.run(scenario())
+
+def test_expired_stream_is_stopped(make_manager, db):
+    async def scenario():
+        manager = make_manager()
+        stream_id, _, _, _ = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1", duration=600)
+        manager.stream_info[stream_id]["started_at"] -= timedelta(seconds=601)
+        
+        await manager._expire_streams()
+        assert stream_id not in manager.processes
+        assert not stream_row(db, stream_id).is_active
+    
+    asyncio.run(scenario())
+
+def test_bulk_start_gives_each_item_its_own_lease(make_manager, db):
+    async def scenario():
+        manager = make_manager()
+        items = [bulk_item(0), bulk_item(1), bulk_item(2, duration=3600), bulk_item(3, channel=2)]
+        results = {result["index"]: result async for result in manager.acquire_streams(items)}
+        
+        assert [results[i]["status"] for i in range(4)] == ["started", "shared", "shared", "started"]
+        assert len({result["lease_id"] for result in results.values()}) == 4
+        stream_id = results[0]["stream_id"]
+        assert results[1]["stream_id"] == results[2]["stream_id"] == stream_id
+        assert len(manager.processes) == 2
+        # Un canal repetido dura lo que pide el item más largo
+        assert manager.stream_info[stream_id]["duration"] == 3600
+        assert stream_row(db, stream_id).viewers == 3
+        
+        released = await manager.release_streams([results[0]["lease_id"], results[0]["lease_id"], results[3]["lease_id"]])
+        assert released[results[0]["lease_id"]] == (stream_id, 2)
+        assert released[results[3]["lease_id"]] == (results[3]["stream_id"], 0)
+        assert list(manager.processes) == [stream_id]
+        await manager.shutdown()
+    
+    asyncio.run(scenario())
+
+def test_released_leases_are_purged(make_manager, db, monkeypatch):
+    async def scenario():
+        manager = make_manager()
+        _, _, _, lease = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        _, _, _, kept = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        await manager.release_stream(lease)
+        
+        monkeypatch.setattr("app.stream_manager.LEASE_RETENTION", -1)
+        manager._purge_leases()
+        assert [row.lease_id for row in db.query(models.StreamLease).all()] == [kept]
+        # Tras la retención el lease ya no se reconoce
+        assert await manager.release_stream(lease) is None
+        await manager.shutdown()
+    
+    asyncio.run(scenario())
+
+def test_abr_variants_keep_retention(make_manager, db):
+    async def scenario():
+        manager = make_manager()
+        stream_ids, lease_ids, _, created = await manager.acquire_abr(
+            1, 1, {0: "rtsp://camera/1/main", 1: "rtsp://camera/1/sub"}, retain=True, dvr_window=900
+        )
+        
+        assert created and len(stream_ids) == len(set(lease_ids)) == 2
+        for stream_id in stream_ids:
+            row = stream_row(db, stream_id)
+            assert row.retain and row.dvr_window == 900
+        await manager.shutdown()
+    
+    asyncio.run(scenario())
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from sqlalchemy import event
+from app import models, stream_manager
+
+def stream_row(db, stream_id: str) -> models.Stream:
+    db.expire_all()
+    return db.query(models.Stream).filter(models.Stream.stream_id == stream_id).one()
+
+def test_stop_streams_local_remote_and_missing(make_manager, engine, db):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("UPDATE streams"):
+            statements.append(statement)
+
+    async def scenario():
+        owner, other = make_manager("node1:1"), make_manager("node1:2")
+        first, _, _, _ = await owner.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        second, _, _, _ = await owner.acquire_stream(1, 2, 0, "rtsp://camera/2")
+        remote, _, _, _ = await other.acquire_stream(1, 3, 0, "rtsp://camera/3")
+        procs = [owner.processes[first], owner.processes[second]]
+        
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            results = await owner.stop_streams([first, second, remote, "missing", first])
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        
+        assert results == {first: "stopped", second: "stopped", remote: "stopped_remote", "missing": "not_found"}
+        # Todas las filas con un único UPDATE
+        assert len(statements) == 1
+        assert all(proc.returncode is not None for proc in procs)
+        assert not owner.processes and not owner.stream_keys
+        for stream_id in (first, second, remote):
+            row = stream_row(db, stream_id)
+            assert not row.is_active and row.viewers == 0
+        
+        # El dueño del stream remoto lo detiene al reconciliar
+        await other._reconcile()
+        assert not other.processes
+    
+    asyncio.run(scenario())
+
+def test_stop_streams_kills_stragglers_after_the_shared_deadline(make_manager, ffmpeg, monkeypatch):
+    # FFmpeg que ignora SIGTERM (la señal ignorada se hereda con exec)
+    stubborn = ffmpeg.with_name("ffmpeg-stubborn")
+    stubborn.write_text("#!/bin/sh\ntrap '' TERM\nexec sleep 3600\n")
+    stubborn.chmod(0o755)
+
+    async def scenario():
+        manager = make_manager()
+        quick, _, _, _ = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        monkeypatch.setattr(stream_manager, "FFMPEG_PATH", str(stubborn))
+        slow = [(await manager.acquire_stream(1, channel, 0, f"rtsp://camera/{channel}"))[0] for channel in (2, 3)]
+        procs = dict(manager.processes)
+        # Dar tiempo al shell a instalar el trap antes del exec
+        await asyncio.sleep(0.2)
+        
+        started = time.monotonic()
+        results = await manager.stop_streams([quick, *slow], timeout=0.5)
+        elapsed = time.monotonic() - started
+        
+        assert set(results.values()) == {"stopped"}
+        assert procs[quick].returncode == -15
+        assert all(procs[stream_id].returncode == -9 for stream_id in slow)
+        # Un único deadline para todos, no uno por proceso
+        assert 0.5 <= elapsed < 1
+    
+    asyncio.run(scenario())
+
+def test_shutdown_stops_every_local_stream(make_manager, db):
+    async def scenario():
+        manager = make_manager()
+        stream_ids = [(await manager.acquire_stream(1, channel, 0, f"rtsp://camera/{channel}"))[0] for channel in (1, 2)]
+        await manager.shutdown()
+        
+        assert not manager.processes
+        assert not any(stream_row(db, stream_id).is_active for stream_id in stream_ids)
+    
+    asyncio.run(scenario())
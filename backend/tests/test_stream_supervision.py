@@ -0,0 +1,99 @@
+import asyncio
+import os
+import signal
+from datetime import timedelta
+from app import models, stream_manager
+
+def stream_row(db, stream_id: str) -> models.Stream:
+    db.expire_all()
+    return db.query(models.Stream).filter(models.Stream.stream_id == stream_id).one()
+
+async def wait_for(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timeout"
+        await asyncio.sleep(0.01)
+
+def crash(proc):
+    """FFmpeg termina por su cuenta (caída RTSP)"""
+    os.kill(proc.pid, signal.SIGKILL)
+
+def test_crashed_ffmpeg_restarts_in_place(make_manager, db, monkeypatch):
+    bounds = []
+    monkeypatch.setattr(stream_manager.random, "uniform", lambda low, high: bounds.append(high) or 0)
+
+    async def scenario():
+        manager = make_manager()
+        stream_id, playlist_url, _, _ = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        info = manager.stream_info[stream_id]
+        
+        for restarts in (1, 2):
+            proc = manager.processes[stream_id]
+            crash(proc)
+            await wait_for(lambda: info["restarts"] == restarts)
+            assert manager.processes[stream_id] is not proc
+        
+        # Mismo stream y misma playlist; el PID nuevo se publica en la tabla compartida
+        assert info["playlist_url"] == playlist_url
+        assert info["last_exit_code"] == -signal.SIGKILL
+        assert stream_row(db, stream_id).pid == manager.processes[stream_id].pid
+        assert stream_row(db, stream_id).is_active
+        # Backoff exponencial mientras el proceso no aguanta RESTART_RESET_AFTER
+        assert bounds == [stream_manager.RESTART_BACKOFF_BASE, 2 * stream_manager.RESTART_BACKOFF_BASE]
+        await manager.shutdown()
+    
+    asyncio.run(scenario())
+
+def test_restart_command_continues_the_playlist(make_manager, tmp_path):
+    manager = make_manager()
+    command = manager._build_command(tmp_path, "rtsp://camera/1", "ts", restart=True)
+    flags = command[command.index("-hls_flags") + 1]
+    assert "append_list" in flags and "discont_start" in flags
+    # Sin -t: el fin lo decide el supervisor o el último lease
+    assert "-t" not in command
+
+def test_stalled_ffmpeg_is_killed_and_restarted(make_manager, monkeypatch):
+    monkeypatch.setattr(stream_manager, "RESTART_BACKOFF_BASE", 0)
+
+    async def scenario():
+        manager = make_manager()
+        stream_id, _, _, _ = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        info = manager.stream_info[stream_id]
+        
+        # Recién lanzado aún tiene margen para conectar con la cámara
+        manager._check_stalls()
+        assert info["stalls"] == 0
+        
+        info["process_started_at"] -= stream_manager.STALL_SEGMENTS * stream_manager.HLS_TIME
+        manager._check_stalls()
+        assert info["stalls"] == 1
+        await wait_for(lambda: info["restarts"] == 1)
+        await manager.shutdown()
+    
+    asyncio.run(scenario())
+
+def test_unsupervised_exit_stops_the_stream(make_manager, db):
+    async def scenario():
+        manager = make_manager()
+        stream_id, _, _, _ = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1", supervised=False)
+        crash(manager.processes[stream_id])
+        
+        await wait_for(lambda: stream_id not in manager.processes)
+        assert not stream_row(db, stream_id).is_active
+        assert not manager.stream_keys
+    
+    asyncio.run(scenario())
+
+def test_exit_at_the_end_of_the_duration_is_not_restarted(make_manager, db):
+    async def scenario():
+        manager = make_manager()
+        stream_id, _, _, _ = await manager.acquire_stream(1, 1, 0, "rtsp://camera/1", duration=600)
+        info = manager.stream_info[stream_id]
+        info["started_at"] -= timedelta(seconds=600)
+        crash(manager.processes[stream_id])
+        
+        await wait_for(lambda: stream_id not in manager.processes)
+        assert info["restarts"] == 0
+        assert not stream_row(db, stream_id).is_active
+    
+    asyncio.run(scenario())
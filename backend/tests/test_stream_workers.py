@@ -0,0 +1,102 @@
+import asyncio
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from app import models
+
+def stream_row(db, stream_id: str) -> models.Stream:
+    db.expire_all()
+    return db.query(models.Stream).filter(models.Stream.stream_id == stream_id).one()
+
+def add_remote_stream(db, stream_id: str, owner="node2:1", heartbeat_at=None, channel: int = 1):
+    db.add(models.Stream(
+        stream_id=stream_id, device_id=1, channel=channel, sub_stream=0, profile="ts",
+        hls_url=f"/hls/{stream_id}/stream.m3u8", owner=owner, is_active=True, viewers=1
+    ))
+    db.commit()
+    # heartbeat_at tiene valor por defecto: se fija aparte para poder dejarlo a NULL
+    db.execute(update(models.Stream).where(models.Stream.stream_id == stream_id).values(heartbeat_at=heartbeat_at))
+    db.commit()
+
+def test_second_worker_attaches_to_the_first(make_manager, db):
+    async def scenario():
+        first, second = make_manager("node1:1"), make_manager("node1:2")
+        stream_id, playlist_url, created, _ = await first.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        shared = await second.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        
+        assert created and shared[:3] == (stream_id, playlist_url, False)
+        assert not second.processes
+        assert stream_row(db, stream_id).viewers == 2
+        assert first.get_stream_info(stream_id)["viewers"] == 1
+        assert second.get_stream_info(stream_id)["owner"] == "node1:1"
+        await first.shutdown()
+    
+    asyncio.run(scenario())
+
+def test_last_release_on_another_worker_stops_the_owner(make_manager, db):
+    async def scenario():
+        owner, other = make_manager("node1:1"), make_manager("node1:2")
+        stream_id, _, _, owner_lease = await owner.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        _, _, _, other_lease = await other.acquire_stream(1, 1, 0, "rtsp://camera/1")
+        
+        assert await owner.release_stream(owner_lease) == (stream_id, 1)
+        assert stream_id in owner.processes
+        # El último lease se libera en el otro worker: la fila queda inactiva
+        assert await other.release_stream(other_lease) == (stream_id, 0)
+        assert not stream_row(db, stream_id).is_active
+        
+        # El dueño detiene su FFmpeg en la siguiente reconciliación y libera la clave
+        proc = owner.processes[stream_id]
+        await owner._reconcile()
+        assert stream_id not in owner.processes and proc.returncode is not None
+        assert not owner.stream_keys
+        assert (await owner.acquire_stream(1, 1, 0, "rtsp://camera/1"))[2]
+        await owner.shutdown()
+    
+    asyncio.run(scenario())
+
+def test_extension_on_another_worker_reaches_the_owner(make_manager, db):
+    async def scenario():
+        owner, other = make_manager("node1:1"), make_manager("node1:2")
+        stream_id, _, _, _ = await owner.acquire_stream(1, 1, 0, "rtsp://camera/1", duration=600)
+        await other.acquire_stream(1, 1, 0, "rtsp://camera/1", duration=7200)
+        assert owner.stream_info[stream_id]["duration"] == 600
+        
+        await owner._reconcile()
+        assert owner.stream_info[stream_id]["duration"] >= 7199
+        await owner.shutdown()
+    
+    asyncio.run(scenario())
+
+def test_stale_owner_is_not_attached(make_manager, db):
+    async def scenario():
+        manager = make_manager()
+        add_remote_stream(db, "dead", heartbeat_at=datetime.utcnow() - timedelta(minutes=5))
+        add_remote_stream(db, "legacy", owner=None, channel=2)
+        add_remote_stream(db, "no-heartbeat", channel=3)
+        
+        for channel, stale in ((1, "dead"), (2, "legacy"), (3, "no-heartbeat")):
+            stream_id, _, created, _ = await manager.acquire_stream(1, channel, 0, f"rtsp://camera/{channel}")
+            assert created and stream_id != stale
+            assert not stream_row(db, stale).is_active
+        await manager.shutdown()
+    
+    asyncio.run(scenario())
+
+def test_reconcile_reaps_stale_rows_only(make_manager, db):
+    async def scenario():
+        manager = make_manager()
+        add_remote_stream(db, "dead", heartbeat_at=datetime.utcnow() - timedelta(minutes=5))
+        add_remote_stream(db, "no-heartbeat", channel=2)
+        add_remote_stream(db, "alive", heartbeat_at=datetime.utcnow(), channel=3)
+        stream_id, _, _, _ = await manager.acquire_stream(1, 4, 0, "rtsp://camera/4")
+        
+        await manager._reconcile()
+        assert not stream_row(db, "dead").is_active
+        assert not stream_row(db, "no-heartbeat").is_active
+        assert stream_row(db, "alive").is_active
+        # Los streams propios renuevan su heartbeat
+        assert stream_row(db, stream_id).is_active
+        assert stream_row(db, stream_id).heartbeat_at > datetime.utcnow() - timedelta(seconds=5)
+        await manager.shutdown()
+    
+    asyncio.run(scenario())
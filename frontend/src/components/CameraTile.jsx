@@ -1,21 +1,141 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import axios from "axios";
 import VideoPlayer from "./VideoPlayer";
-import { PlayIcon, StopIcon, PauseIcon } from "@heroicons/react/24/solid";
+import { 
+  PlayIcon, 
+  StopIcon, 
+  PauseIcon,
+  ArrowsPointingOutIcon,
+  ArrowsPointingInIcon
+} from "@heroicons/react/24/solid";
+
+// Espera tras un cambio de tamaño antes de consultar la variante del tile
+const RESIZE_DEBOUNCE_MS = 500;
 
 export default function CameraTile({ 
   device, 
   channel = 1, 
   subStream = 0,
+  profile = "ts",
+  abr = false,
+  // Tiles visibles en la vista: el backend elige main o sub según el tamaño del tile
+  tiles = null,
+  maximized = false,
+  onToggleMaximize = null,
   className = "",
   onStreamStart = null,
   onStreamStop = null
 }) {
   const [isStreaming, setIsStreaming] = useState(false);
   const [streamId, setStreamId] = useState(null);
+  // Leases a liberar al detener (dos variantes en modo ABR)
+  const [leaseIds, setLeaseIds] = useState([]);
   const [playlistUrl, setPlaylistUrl] = useState(null);
+  const [liveSyncSegments, setLiveSyncSegments] = useState(null);
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState(null);
+  // Variante en reproducción y la que se está preparando para sustituirla
+  const [activeSubStream, setActiveSubStream] = useState(subStream);
+  const [pending, setPending] = useState(null);
+  const videoAreaRef = useRef(null);
+  const checkVariantRef = useRef(null);
+  const checkingRef = useRef(false);
+  const autoVariant = tiles !== null && !abr;
+
+  // Tamaño del tile en píxeles físicos
+  const measureTile = () => {
+    const rect = videoAreaRef.current.getBoundingClientRect();
+    const ratio = window.devicePixelRatio || 1;
+    return {
+      tile_width: Math.max(16, Math.round(rect.width * ratio)),
+      tile_height: Math.max(16, Math.round(rect.height * ratio)),
+      tiles: tiles
+    };
+  };
+
+  // Cada lease se libera una sola vez en el backend aunque se repita la petición
+  const releaseLeases = (ids) => Promise.all(ids.map(id => axios.post('/api/streams/stop', {
+    lease_id: id
+  })));
+
+  // Al maximizar o restaurar el tile: si cambia la variante se inicia la nueva
+  // en paralelo y el player cambia cuando ya puede reproducirla (sin corte)
+  const checkVariant = async () => {
+    if (!autoVariant || !isStreaming || pending || isLoading || checkingRef.current) return;
+    
+    checkingRef.current = true;
+    try {
+      const response = await axios.get('/api/streams/select', {
+        params: { device_id: device.id, channel: channel, ...measureTile() }
+      });
+      if (response.data.sub_stream === activeSubStream) return;
+      
+      const started = await axios.post('/api/streams/start', {
+        device_id: device.id,
+        channel: channel,
+        sub_stream: response.data.sub_stream,
+        profile: profile,
+        duration: 3600
+      });
+      setPending({
+        streamId: started.data.stream_id,
+        leaseIds: started.data.lease_ids || [started.data.lease_id],
+        playlistUrl: started.data.playlist_url,
+        liveSyncSegments: started.data.live_sync_segments || null,
+        subStream: started.data.sub_stream
+      });
+    } catch (err) {
+      // Se sigue con la variante actual
+      console.error('Error cambiando de variante:', err);
+    } finally {
+      checkingRef.current = false;
+    }
+  };
+  checkVariantRef.current = checkVariant;
+
+  const promotePending = () => {
+    if (!pending) return;
+    const previousIds = leaseIds;
+    delete playerHandlers.current[playlistUrl];
+    
+    setStreamId(pending.streamId);
+    setLeaseIds(pending.leaseIds);
+    setPlaylistUrl(pending.playlistUrl);
+    setLiveSyncSegments(pending.liveSyncSegments);
+    setActiveSubStream(pending.subStream);
+    setPending(null);
+    
+    // El lease anterior se libera solo cuando la nueva variante ya se ve
+    releaseLeases(previousIds).catch(err => console.error('Error liberando variante anterior:', err));
+  };
+
+  const discardPending = () => {
+    if (!pending) return;
+    delete playerHandlers.current[pending.playlistUrl];
+    releaseLeases(pending.leaseIds).catch(err => console.error('Error liberando variante:', err));
+    setPending(null);
+  };
+
+  useEffect(() => {
+    if (!autoVariant || !videoAreaRef.current) return;
+    
+    let timer = null;
+    const observer = new ResizeObserver(() => {
+      clearTimeout(timer);
+      timer = setTimeout(() => checkVariantRef.current(), RESIZE_DEBOUNCE_MS);
+    });
+    observer.observe(videoAreaRef.current);
+    
+    return () => {
+      clearTimeout(timer);
+      observer.disconnect();
+    };
+  }, [autoVariant]);
+
+  useEffect(() => {
+    // Cambio del número de tiles de la vista (p.ej. otro tamaño de mosaico)
+    if (isStreaming) checkVariantRef.current();
+  }, [tiles]);
 
   const startStream = async () => {
     if (isStreaming) return;
@@ -28,11 +148,17 @@ export default function CameraTile({
         device_id: device.id,
         channel: channel,
         sub_stream: subStream,
+        profile: profile,
+        abr: abr,
+        ...(autoVariant ? measureTile() : {}),
         duration: 3600 // 1 hora
       });
       
       setStreamId(response.data.stream_id);
+      setLeaseIds(response.data.lease_ids || [response.data.lease_id]);
       setPlaylistUrl(response.data.playlist_url);
+      setLiveSyncSegments(response.data.live_sync_segments || null);
+      setActiveSubStream(response.data.sub_stream ?? subStream);
       setIsStreaming(true);
       
       if (onStreamStart) {
@@ -53,11 +179,11 @@ export default function CameraTile({
     setIsLoading(true);
     
     try {
-      await axios.post('/api/streams/stop', {
-        stream_id: streamId
-      });
+      await releaseLeases(pending ? [...leaseIds, ...pending.leaseIds] : leaseIds);
       
+      setPending(null);
       setStreamId(null);
+      setLeaseIds([]);
       setPlaylistUrl(null);
       setIsStreaming(false);
       
@@ -82,6 +208,31 @@ export default function CameraTile({
     setError(null);
   };
 
+  // Callbacks estables por URL: VideoPlayer recrea hls.js si cambian sus props,
+  // y así el player de la variante nueva pasa a ser el principal sin recargarse
+  const playerHandlers = useRef({});
+  const handlersRef = useRef(null);
+  handlersRef.current = {
+    canPlay: (url) => (pending && url === pending.playlistUrl ? promotePending() : handleVideoCanPlay()),
+    error: (url, e) => (pending && url === pending.playlistUrl ? discardPending() : handleVideoError(e))
+  };
+  const getPlayerHandlers = (url) => {
+    if (!playerHandlers.current[url]) {
+      playerHandlers.current[url] = {
+        onCanPlay: () => handlersRef.current.canPlay(url),
+        onError: (e) => handlersRef.current.error(url, e)
+      };
+    }
+    return playerHandlers.current[url];
+  };
+
+  // Player actual y, detrás y transparente, el de la variante que lo sustituye.
+  // Al cambiar se quita el primero: el segundo no se mueve en el DOM ni se pausa
+  const players = playlistUrl ? [
+    { url: playlistUrl, liveSyncSegments: liveSyncSegments },
+    ...(pending ? [{ url: pending.playlistUrl, liveSyncSegments: pending.liveSyncSegments }] : [])
+  ] : [];
+
   return (
     <div className={`bg-gray-900 text-white rounded-lg overflow-hidden shadow-lg ${className}`}>
       {/* Header */}
@@ -96,6 +247,19 @@ export default function CameraTile({
         </div>
         
         <div className="flex items-center space-x-1">
+          {onToggleMaximize && (
+            <button
+              onClick={onToggleMaximize}
+              className="p-1.5 bg-gray-700 hover:bg-gray-600 rounded transition-colors"
+              title={maximized ? "Restaurar" : "Maximizar"}
+            >
+              {maximized ? (
+                <ArrowsPointingInIcon className="h-4 w-4" />
+              ) : (
+                <ArrowsPointingOutIcon className="h-4 w-4" />
+              )}
+            </button>
+          )}
           {!isStreaming ? (
             <button
               onClick={startStream}
@@ -127,7 +291,7 @@ export default function CameraTile({
       </div>
 
       {/* Video Area */}
-      <div className="relative aspect-video bg-black">
+      <div ref={videoAreaRef} className="relative aspect-video bg-black">
         {error ? (
           <div className="absolute inset-0 flex items-center justify-center bg-gray-800">
             <div className="text-center p-4">
@@ -142,15 +306,22 @@ export default function CameraTile({
             </div>
           </div>
         ) : playlistUrl ? (
-          <VideoPlayer
-            url={playlistUrl}
-            className="w-full h-full"
-            onError={handleVideoError}
-            onCanPlay={handleVideoCanPlay}
-            controls={false}
-            autoPlay={true}
-            muted={true}
-          />
+          players.map(player => (
+            <div
+              key={player.url}
+              className={`absolute inset-0 ${player.url === playlistUrl ? '' : 'opacity-0 pointer-events-none'}`}
+            >
+              <VideoPlayer
+                url={player.url}
+                className="w-full h-full"
+                liveSyncSegments={player.liveSyncSegments}
+                {...getPlayerHandlers(player.url)}
+                controls={false}
+                autoPlay={true}
+                muted={true}
+              />
+            </div>
+          ))
         ) : (
           <div className="absolute inset-0 flex items-center justify-center bg-gray-800">
             <div className="text-center">
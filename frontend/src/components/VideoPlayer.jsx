@@ -7,6 +7,7 @@ export default function VideoPlayer({
   controls = true, 
   autoPlay = true,
   muted = true,
+  liveSyncSegments = null,
   onError = null,
   onLoadStart = null,
   onCanPlay = null
@@ -36,7 +37,12 @@ export default function VideoPlayer({
       const hls = new Hls({
         enableWorker: true,
         lowLatencyMode: true,
-        backBufferLength: 90
+        backBufferLength: 90,
+        // Con master playlist ABR no subir de la variante que cabe en el player:
+        // sub en tiles pequeños, main a pantalla completa
+        capLevelToPlayerSize: true,
+        // Segmentos por detrás del borde en vivo según el perfil del stream
+        ...(liveSyncSegments ? { liveSyncDurationCount: liveSyncSegments } : {})
       });
       
       hlsRef.current = hls;
@@ -109,7 +115,7 @@ export default function VideoPlayer({
         hlsRef.current = null;
       }
     };
-  }, [url, autoPlay, onError, onLoadStart, onCanPlay]);
+  }, [url, autoPlay, liveSyncSegments, onError, onLoadStart, onCanPlay]);
 
   if (hasError) {
     return (
@@ -19,6 +19,10 @@ export default function LiveView() {
   const [selectedDevice, setSelectedDevice] = useState(null);
   const [gridSize, setGridSize] = useState(8); // 8x8 = 64 cámaras
   const [autoStart, setAutoStart] = useState(false);
+  // Tile ampliado: pasa a la variante main y vuelve a la sub al restaurarlo
+  const [maximizedDevice, setMaximizedDevice] = useState(null);
+  // Leases obtenidos con "iniciar todos": se liberan con "detener todos"
+  const [bulkLeaseIds, setBulkLeaseIds] = useState([]);
 
   useEffect(() => {
     loadDevices();
@@ -56,14 +60,24 @@ export default function LiveView() {
   const startAllStreams = async () => {
     setIsLoading(true);
     try {
+      // Tamaño aproximado de cada tile en píxeles físicos: el backend elige la
+      // variante (en mosaicos grandes, la sub-stream de cada cámara)
+      const ratio = window.devicePixelRatio || 1;
+      const tileWidth = Math.round(window.innerWidth / gridSize * ratio);
       const requests = devices.map(device => ({
         device_id: device.id,
         channel: 1,
-        sub_stream: 0,
+        tile_width: tileWidth,
+        tile_height: Math.round(tileWidth * 9 / 16),
+        tiles: Math.min(devices.length, gridSize * gridSize),
         duration: 3600
       }));
 
       const response = await axios.post('/api/streams/bulk/start', requests);
+      setBulkLeaseIds(leaseIds => [
+        ...leaseIds,
+        ...response.data.results.filter(result => result.lease_id).map(result => result.lease_id)
+      ]);
       
       toast.success(`${response.data.successful} streams iniciados correctamente`);
       loadActiveStreams();
@@ -79,14 +93,14 @@ export default function LiveView() {
   const stopAllStreams = async () => {
     setIsLoading(true);
     try {
-      const streamIds = Object.keys(activeStreams);
-      
-      if (streamIds.length === 0) {
+      if (bulkLeaseIds.length === 0) {
         toast.info('No hay streams activos');
         return;
       }
 
-      const response = await axios.post('/api/streams/bulk/stop', streamIds);
+      // Solo los leases de esta vista: los demás viewers de cada stream no se ven afectados
+      const response = await axios.post('/api/streams/bulk/stop', bulkLeaseIds);
+      setBulkLeaseIds([]);
       
       toast.success(`${response.data.successful} streams detenidos correctamente`);
       loadActiveStreams();
@@ -213,14 +227,25 @@ export default function LiveView() {
                 key={device.id}
                 device={device}
                 channel={1}
-                subStream={0}
+                subStream={1}
+                tiles={maximizedDevice === device.id ? 1 : Math.min(filteredDevices.length, gridSize * gridSize)}
+                maximized={maximizedDevice === device.id}
+                onToggleMaximize={() => setMaximizedDevice(maximizedDevice === device.id ? null : device.id)}
                 onStreamStart={handleStreamStart}
                 onStreamStop={handleStreamStop}
-                className="h-48"
+                className={maximizedDevice === device.id
+                  ? "fixed z-50 top-4 left-1/2 -translate-x-1/2 w-[min(96vw,150vh)]"
+                  : "h-48"}
               />
             ))}
           </div>
         )}
+        {maximizedDevice && (
+          <div
+            className="fixed inset-0 z-40 bg-black bg-opacity-75"
+            onClick={() => setMaximizedDevice(null)}
+          />
+        )}
       </div>
 
       {/* Footer Info */}
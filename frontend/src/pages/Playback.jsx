@@ -11,6 +11,58 @@ import {
 import { format, subDays } from "date-fns";
 import toast from "react-hot-toast";
 
+// Tramos [inicio, fin) de buckets con grabación de un bitmap base64 de /timeline
+const bitmapRuns = (bitmap, buckets) => {
+  const bytes = atob(bitmap);
+  const runs = [];
+  let start = null;
+  for (let i = 0; i <= buckets; i++) {
+    const set = i < buckets && (bytes.charCodeAt(i >> 3) & (0x80 >> (i & 7))) !== 0;
+    if (set && start === null) start = i;
+    if (!set && start !== null) {
+      runs.push([start, i]);
+      start = null;
+    }
+  }
+  return runs;
+};
+
+const TYPE_COLORS = {
+  alarm: 'bg-red-500',
+  motion: 'bg-yellow-400'
+};
+
+function CoverageBar({ timeline }) {
+  const channel = timeline.channels[0];
+  const segment = ([start, end], className, key) => (
+    <div
+      key={key}
+      className={`absolute inset-y-0 ${className}`}
+      style={{
+        left: `${(start / timeline.buckets) * 100}%`,
+        width: `${((end - start) / timeline.buckets) * 100}%`
+      }}
+    />
+  );
+
+  return (
+    <div className="px-6 py-4 border-b border-gray-200">
+      <div className="relative h-4 bg-gray-200 rounded overflow-hidden">
+        {bitmapRuns(channel.coverage, timeline.buckets).map((run, i) => segment(run, 'bg-green-500', `c${i}`))}
+        {Object.entries(channel.types)
+          .filter(([type]) => TYPE_COLORS[type])
+          .flatMap(([type, bitmap]) =>
+            bitmapRuns(bitmap, timeline.buckets).map((run, i) => segment(run, TYPE_COLORS[type], `${type}${i}`))
+          )}
+      </div>
+      <div className="mt-1 flex justify-between text-xs text-gray-500">
+        <span>{timeline.start_time}</span>
+        <span>{timeline.end_time}</span>
+      </div>
+    </div>
+  );
+}
+
 export default function Playback() {
   const [devices, setDevices] = useState([]);
   const [selectedDevice, setSelectedDevice] = useState(null);
@@ -20,6 +72,7 @@ export default function Playback() {
   const [endDate, setEndDate] = useState(format(new Date(), 'yyyy-MM-dd'));
   const [endTime, setEndTime] = useState('23:59');
   const [recordings, setRecordings] = useState([]);
+  const [timeline, setTimeline] = useState(null);
   const [selectedRecording, setSelectedRecording] = useState(null);
   const [isLoading, setIsLoading] = useState(false);
   const [isSearching, setIsSearching] = useState(false);
@@ -52,15 +105,26 @@ export default function Playback() {
       const startDateTime = `${startDate} ${startTime}:00`;
       const endDateTime = `${endDate} ${endTime}:00`;
 
-      const response = await axios.get(`/api/recordings/${selectedDevice}`, {
-        params: {
-          start: startDateTime,
-          end: endDateTime,
-          channel: selectedChannel
-        }
-      });
+      // La barra de cobertura viene de /timeline (bitmaps), no de la lista de archivos
+      const [response, timelineResponse] = await Promise.all([
+        axios.get(`/api/recordings/${selectedDevice}`, {
+          params: {
+            start: startDateTime,
+            end: endDateTime,
+            channel: selectedChannel
+          }
+        }),
+        axios.get(`/api/recordings/${selectedDevice}/timeline`, {
+          params: {
+            start: startDateTime,
+            end: endDateTime,
+            channels: selectedChannel
+          }
+        }).catch(() => null)
+      ]);
 
       setRecordings(response.data.recordings);
+      setTimeline(timelineResponse ? timelineResponse.data : null);
       
       if (response.data.recordings.length === 0) {
         toast.info('No se encontraron grabaciones en el rango seleccionado');
@@ -247,6 +311,8 @@ export default function Playback() {
                 </h3>
               </div>
 
+              {timeline && <CoverageBar timeline={timeline} />}
+
               {recordings.length === 0 ? (
                 <div className="text-center py-12">
                   <VideoCameraIcon className="mx-auto h-12 w-12 text-gray-400" />
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Benchmark de consultas de línea de tiempo sobre la tabla de grabaciones
+
+Carga filas sintéticas en Postgres (generate_series, sin pasar por Python),
+aplica las migraciones (índice único y GiST) y mide crud.get_recordings para
+un día de un canal al azar. Objetivo: p95 < 10 ms con 50M filas.
+
+Uso:
+    make bench-recordings ROWS=50000000
+    DATABASE_URL=postgresql://... python scripts/bench-recordings.py --rows 50000000
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import os
+import time
+from datetime import datetime, timedelta
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+from sqlalchemy import text
+from app.database import engine, SessionLocal
+from app.migrations import run_migrations
+from app import crud
+
+# device_id de las filas sintéticas: no se mezclan con dispositivos reales
+BENCH_DEVICE_OFFSET = 1_000_000
+BENCH_START = datetime(2024, 1, 1)
+
+def load_rows(rows, devices, channels, file_minutes):
+    """Insertar las filas que falten, un dispositivo por transacción"""
+    per_channel = rows // (devices * channels)
+    with engine.begin() as conn:
+        existing = conn.execute(
+            text("SELECT count(*) FROM recordings WHERE device_id >= :offset"),
+            {"offset": BENCH_DEVICE_OFFSET}
+        ).scalar()
+    if existing >= per_channel * devices * channels:
+        print(f"✅ {existing:,} filas ya cargadas")
+        return per_channel
+    
+    print(f"📥 Cargando {per_channel * devices * channels:,} filas ({devices} dispositivos x {channels} canales)...")
+    started = time.monotonic()
+    for device in range(devices):
+        with engine.begin() as conn:
+            conn.execute(text("""
+                INSERT INTO recordings (device_id, channel, start_time, end_time, file_path, file_size, recording_type, meta, created_at)
+                SELECT :device_id, ch, :start + n * :step, :start + (n + 1) * :step,
+                       'bench', 1048576, 'normal', '{}'::json, now()
+                FROM generate_series(1, :channels) AS ch, generate_series(0, :per_channel - 1) AS n
+                ON CONFLICT DO NOTHING
+            """), {
+                "device_id": BENCH_DEVICE_OFFSET + device,
+                "start": BENCH_START,
+                "step": timedelta(minutes=file_minutes),
+                "channels": channels,
+                "per_channel": per_channel
+            })
+        if (device + 1) % 10 == 0:
+            print(f"   {device + 1}/{devices} dispositivos ({time.monotonic() - started:.0f}s)")
+    
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE recordings"))
+    print(f"✅ Carga completada en {time.monotonic() - started:.0f}s")
+    return per_channel
+
+def random_query(devices, channels, days):
+    device_id = BENCH_DEVICE_OFFSET + random.randrange(devices)
+    channel = random.randint(1, channels)
+    day = BENCH_START + timedelta(days=random.randrange(max(1, days)))
+    return device_id, channel, day, day + timedelta(days=1)
+
+def run_queries(queries, devices, channels, days):
+    """Latencias (ms) de la consulta de línea de tiempo de un día"""
+    db = SessionLocal()
+    latencies = []
+    rows = 0
+    try:
+        # Calentar la caché de conexiones y del planificador
+        for _ in range(10):
+            device_id, channel, start, end = random_query(devices, channels, days)
+            crud.get_recordings(db, device_id, start, end, channel=channel)
+        
+        for _ in range(queries):
+            device_id, channel, start, end = random_query(devices, channels, days)
+            started = time.perf_counter()
+            rows += len(crud.get_recordings(db, device_id, start, end, channel=channel))
+            latencies.append((time.perf_counter() - started) * 1000)
+    finally:
+        db.close()
+    return latencies, rows / max(1, queries)
+
+def explain(devices, channels, days):
+    device_id, channel, start, end = random_query(devices, channels, days)
+    with engine.connect() as conn:
+        plan = conn.execute(text("""
+            EXPLAIN (ANALYZE, BUFFERS)
+            SELECT * FROM recordings
+            WHERE device_id = :device_id AND channel = :channel
+              AND tsrange(start_time, end_time, '[)') && tsrange(:start, :end, '[)')
+            ORDER BY start_time
+        """), {"device_id": device_id, "channel": channel, "start": start, "end": end})
+        return "\n".join(row[0] for row in plan)
+
+def cleanup():
+    with engine.begin() as conn:
+        deleted = conn.execute(
+            text("DELETE FROM recordings WHERE device_id >= :offset"),
+            {"offset": BENCH_DEVICE_OFFSET}
+        ).rowcount
+    print(f"🧹 {deleted:,} filas sintéticas eliminadas")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la tabla recordings")
+    parser.add_argument("--rows", type=int, default=50_000_000)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--channels", type=int, default=16)
+    parser.add_argument("--file-minutes", type=int, default=10, help="Duración de cada archivo sintético")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--target-ms", type=float, default=10.0, help="p95 máximo aceptado")
+    parser.add_argument("--cleanup", action="store_true", help="Eliminar las filas sintéticas y salir")
+    args = parser.parse_args()
+    
+    if engine.dialect.name != "postgresql":
+        print("❌ El benchmark requiere Postgres (DATABASE_URL)")
+        return 1
+    
+    if args.cleanup:
+        cleanup()
+        return 0
+    
+    run_migrations()
+    per_channel = load_rows(args.rows, args.devices, args.channels, args.file_minutes)
+    days = per_channel * args.file_minutes // 1440
+    
+    latencies, rows = run_queries(args.queries, args.devices, args.channels, days)
+    latencies.sort()
+    p50 = statistics.median(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    
+    print(f"\n📊 {args.queries} consultas de un día ({rows:.0f} filas de media)")
+    print(f"   p50 {p50:.2f} ms | p95 {p95:.2f} ms | p99 {p99:.2f} ms | max {latencies[-1]:.2f} ms")
+    print(f"\n{explain(args.devices, args.channels, days)}\n")
+    
+    if p95 >= args.target_ms:
+        print(f"❌ p95 por encima del objetivo ({args.target_ms} ms)")
+        return 1
+    print(f"✅ p95 por debajo del objetivo ({args.target_ms} ms)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())